@@ -0,0 +1,2 @@
+"""Benchmarks for the samaritan bot. Run from the repository root, e.g. python -m bench.captcha_render
+"""
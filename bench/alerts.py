@@ -0,0 +1,80 @@
+"""Measures checking n price alerts against a new price, as the price moves in a random walk: scanning every
+alert, and finding the crossed ones in an AlertIndex. Fired alerts are set again, so n alerts are always set.
+"""
+import argparse
+import random
+
+from core.alert.index import AlertIndex, ABOVE, BELOW, CHANGE, bounds
+from bench import harness
+
+SUITE = 'alerts'
+PRICE = 1e-6
+
+
+def random_alert(price: float) -> dict:
+    kind = random.choice((ABOVE, BELOW, CHANGE))
+    if kind == CHANGE:
+        return {'kind': kind, 'threshold': random.uniform(0.01, 0.5), 'base': price}
+    distance = random.uniform(0.01, 0.5) * price
+    return {'kind': kind, 'threshold': price + distance if kind == ABOVE else price - distance, 'base': price}
+
+
+def crossed(alert: dict, price: float) -> bool:
+    rising, falling = bounds(alert)
+    return rising is not None and price >= rising or falling is not None and price <= falling
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, nargs='+', default=[1000, 100000], help='numbers of alerts set')
+    parser.add_argument('--step', type=float, default=0.01, help='standard deviation of a price move')
+    parser.add_argument('--ops', type=int, default=1000, help='prices checked per case')
+    parser.add_argument('-o', '--output', help='results file, defaults to bench/results/alerts-<commit>.json')
+    parser.add_argument('-b', '--baseline', help='results file of an earlier run to compare against')
+    args = parser.parse_args()
+
+    results = []
+    for n in args.n:
+        alerts = {str(i): random_alert(PRICE) for i in range(n)}
+        index = AlertIndex()
+        for key, alert in alerts.items():
+            index.add(key, alert)
+        price = [PRICE]
+        fired = []
+
+        def move():
+            # sets the alerts fired by the last check again, around the current price
+            for key in fired:
+                alerts[key] = random_alert(price[0])
+                index.add(key, alerts[key])
+            fired.clear()
+            price[0] *= 1 + random.gauss(0, args.step)
+            return price[0]
+
+        def scan(p):
+            fired.extend(key for key, alert in alerts.items() if crossed(alert, p))
+
+        def lookup(p):
+            fired.extend(key for key, _ in index.fire(p))
+
+        for name, check in [('scan', scan), ('index', lookup)]:
+            checked = fired_total = 0
+
+            def counted(p):
+                nonlocal checked, fired_total
+                check(p)
+                checked += 1
+                fired_total += len(fired)
+
+            result = harness.measure(f'check.{name}.n{n}', counted, args.ops, setup=move)
+            result['fired_per_check'] = fired_total / checked
+            results.append(result)
+
+    harness.report(results, harness.load(args.baseline) if args.baseline else None)
+    for result in results:
+        print(f"{result['name']:<28} {result['fired_per_check']:>8.2f} alerts fired per check")
+    print('Results written to', harness.save(SUITE, results, args.output))
+
+
+if __name__ == '__main__':
+    main()
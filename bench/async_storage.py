@@ -0,0 +1,73 @@
+"""Measures bursts of concurrent captcha status lookups, as when many members join at once: on MongoConn from
+a pool of worker threads, like python-telegram-bot's dispatcher, and on AsyncMongoConn as coroutines of one
+event loop. Needs a running MongoDB server holding no bot data, as both connections use the bot's own
+databases. The benchmark's chat is dropped afterwards.
+"""
+import argparse
+import asyncio
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import MongoClient
+
+from core.db.async_mongo_db import AsyncMongoConn
+from core.db.mongo_db import MongoConn
+from bench import harness
+
+SUITE = 'async_storage'
+CHAT_ID = -100
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--mongo', default='mongodb://localhost:27017', help='MongoDB connection string')
+    parser.add_argument('-n', type=int, default=10000, help='members in the chat')
+    parser.add_argument('--burst', type=int, default=256, help='concurrent lookups per operation')
+    parser.add_argument('--workers', type=int, default=4, help='worker threads of the blocking variant')
+    parser.add_argument('--ops', type=int, default=50, help='bursts per case')
+    parser.add_argument('-o', '--output', help='results file, defaults to bench/results/async_storage-<commit>.json')
+    parser.add_argument('-b', '--baseline', help='results file of an earlier run to compare against')
+    args = parser.parse_args()
+
+    client = MongoClient(args.mongo)
+    members = client['chats_members'][str(CHAT_ID)]
+    members.drop()
+    members.insert_many([{'_id': user_id, 'captcha_completed': True} for user_id in range(args.n)])
+
+    def burst():
+        return [random.randrange(args.n) for _ in range(args.burst)]
+
+    db = MongoConn(args.mongo)
+    results = []
+    with ThreadPoolExecutor(args.workers) as workers:
+        results.append(harness.measure(
+            f'captcha.burst{args.burst}.threads{args.workers}',
+            lambda: list(workers.map(lambda user_id: db.get_captcha_status(CHAT_ID, user_id), burst())), args.ops))
+
+    async def run_async():
+        adb = await AsyncMongoConn(args.mongo).open()
+        loop = asyncio.get_running_loop()
+
+        async def lookups():
+            return await asyncio.gather(*(adb.get_captcha_status(CHAT_ID, user_id) for user_id in burst()))
+
+        def gather():
+            # harness.measure is synchronous, it runs in a thread and each burst is awaited on the loop
+            return asyncio.run_coroutine_threadsafe(lookups(), loop).result()
+
+        results.append(await loop.run_in_executor(
+            None, lambda: harness.measure(f'captcha.burst{args.burst}.asyncio', gather, args.ops)))
+        await adb.close()
+
+    try:
+        asyncio.run(run_async())
+    finally:
+        members.drop()
+        db.close()
+
+    harness.report(results, harness.load(args.baseline) if args.baseline else None)
+    print('Results written to', harness.save(SUITE, results, args.output))
+
+
+if __name__ == '__main__':
+    main()
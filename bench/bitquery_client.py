@@ -0,0 +1,86 @@
+"""Measures Bitquery queries against a local stand-in of the GraphQL endpoint with a fixed latency and a
+simulated TLS handshake per new connection: posting every query on a new connection, as run_query used to,
+and through the pooled BitqueryClient. Then checks the client's failure handling: the share of queries
+succeeding when the endpoint answers 503 to some of them, the latency of a query to an endpoint that hangs,
+and of a query rejected by the open circuit breaker.
+"""
+import argparse
+
+import requests
+
+from core.bitquery.client import BitqueryClient, CircuitBreaker, QueryFailed
+from bench import harness
+from bench.fakes import LocalGraphQL
+
+SUITE = 'bitquery_client'
+QUERY = '{ ethereum(network: bsc) { dexTrades { tradeIndex } } }'
+
+
+def post(url: str) -> dict:
+    response = requests.post(url, json={'query': QUERY}, headers={'X-API-KEY': 'bench'})
+    if response.status_code != 200:
+        raise QueryFailed(f'status {response.status_code}')
+    return response.json()
+
+
+def success_rate(query, n: int) -> float:
+    succeeded = 0
+    for _ in range(n):
+        try:
+            query()
+            succeeded += 1
+        except QueryFailed:
+            pass
+    return succeeded / n
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--latency', type=float, default=20, help='endpoint latency in ms')
+    parser.add_argument('--handshake', type=float, default=100, help='simulated TLS handshake in ms')
+    parser.add_argument('--fail-rate', type=float, default=0.3, help='share of queries answered with 503')
+    parser.add_argument('--timeout', type=float, default=0.5, help='read timeout of the hanging case in seconds')
+    parser.add_argument('--ops', type=int, default=50, help='queries per case')
+    parser.add_argument('-o', '--output', help='results file, defaults to bench/results/bitquery_client-<commit>.json')
+    parser.add_argument('-b', '--baseline', help='results file of an earlier run to compare against')
+    args = parser.parse_args()
+
+    results = []
+    with LocalGraphQL(latency=args.latency / 1000, handshake=args.handshake / 1000) as endpoint:
+        client = BitqueryClient(api_key='bench', url=endpoint.url, backoff=0.01)
+        for name, query in [('unpooled', lambda: post(endpoint.url)), ('pooled', lambda: client.query(QUERY))]:
+            connections, queries = endpoint.connections, endpoint.requests
+            result = harness.measure(f'query.{name}', query, args.ops, warmup=1)
+            result['connections_per_query'] = \
+                (endpoint.connections - connections) / (endpoint.requests - queries)
+            results.append(result)
+
+        endpoint.fail_rate = args.fail_rate
+        for name, query in [('unpooled', lambda: post(endpoint.url)), ('pooled', lambda: client.query(QUERY))]:
+            print(f'{name:<10} {success_rate(query, args.ops):>6.0%} of queries succeeded with '
+                  f'{args.fail_rate:.0%} answered 503')
+        endpoint.fail_rate = 0
+
+        endpoint.hang = True
+        hanging = BitqueryClient(api_key='bench', url=endpoint.url, read_timeout=args.timeout, retries=0,
+                                 breaker=CircuitBreaker(threshold=args.ops + 100))
+        results.append(harness.measure('query.hanging', lambda: success_rate(lambda: hanging.query(QUERY), 1),
+                                       max(1, args.ops // 10), warmup=0))
+        endpoint.hang = False
+        print(f'pooled     {client.stats()}')
+
+    broken = BitqueryClient(api_key='bench', url=endpoint.url, retries=0, breaker=CircuitBreaker(threshold=3))
+    success_rate(lambda: broken.query(QUERY), 3)
+    results.append(harness.measure('query.circuit_open', lambda: success_rate(lambda: broken.query(QUERY), 1),
+                                   args.ops))
+    print(f'broken     {broken.stats()}')
+
+    harness.report(results, harness.load(args.baseline) if args.baseline else None)
+    for result in results:
+        if 'connections_per_query' in result:
+            print(f"{result['name']:<28} {result['connections_per_query']:>10.2f} connections per query")
+    print('Results written to', harness.save(SUITE, results, args.output))
+
+
+if __name__ == '__main__':
+    main()
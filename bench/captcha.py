@@ -0,0 +1,86 @@
+"""Benchmarks the captcha subsystem: generating challenges, rendering and encoding their images, building
+their keyboards, and the full deeplink -> callback -> completed flow of a user solving a captcha against
+a fake Bot. Results are written to bench/results as JSON, pass --baseline to compare against an earlier run.
+"""
+import argparse
+import itertools
+from types import SimpleNamespace
+
+from core.captcha.challenge import Challenge, preload_glyphs, NUMPY
+from core.captcha.challenger import Challenger
+from core.captcha.signing import CallbackSigner
+from core.utils.utils import send_image, build_menu, encode_image
+from bench import harness
+from bench.fakes import FakeBot, FakeDb, context, command_update, callback_update
+
+SUITE = 'captcha'
+CHAT_ID = -1001234567890
+
+
+def click_answer(bot: FakeBot, answer: int) -> str:
+    for row in bot.last_markup.inline_keyboard:
+        for button in row:
+            if button.text == str(answer):
+                return button.callback_data
+
+
+def solve_captcha(challenger: Challenger, bot: FakeBot, user_id: int):
+    ctx = context(bot, args=[f'captcha_{CHAT_ID}'])
+    up = command_update(user_id, f'/start captcha_{CHAT_ID}')
+    challenger.captcha_deeplink(up, ctx)
+
+    session = challenger.current_captchas.get(CHAT_ID, user_id)
+    message = SimpleNamespace(chat_id=session.priv_chat_id, message_id=session.priv_msg_id,
+                              reply_markup=bot.last_markup)
+    up = callback_update(user_id, click_answer(bot, session.answer), message)
+    if challenger.signer:
+        challenger.captcha_signed_callback(up, ctx)
+    else:
+        challenger.captcha_callback(up, ctx)
+    assert challenger.db.get_captcha_status(CHAT_ID, user_id)
+
+
+def cases(n: int):
+    ch = Challenge()
+    numpy_ch = Challenge(NUMPY)
+    img = ch.gen_img()
+    signer = CallbackSigner('bench')
+    callback = f'captcha_{CHAT_ID}_42'
+    buttons = Challenge().gen_markup(callback).inline_keyboard[1:]
+    buttons = [button for row in buttons for button in row]
+    bot = FakeBot()
+    user_ids = itertools.count(1)
+
+    yield harness.measure('challenge.new', ch.new, n * 10)
+    yield harness.measure('challenge.gen_img.pillow', ch.gen_img, n)
+    yield harness.measure('challenge.gen_img.numpy', numpy_ch.gen_img, n)
+    yield harness.measure('image.encode_jpeg', lambda: encode_image(img), n)
+    yield harness.measure('send_image', lambda: send_image(command_update(1), context(bot), img), n)
+    yield harness.measure('markup.build_menu', lambda: build_menu(buttons, n_cols=3, header_buttons=buttons[0]),
+                          n * 10)
+    yield harness.measure('markup.gen_markup', lambda: ch.gen_markup(callback), n * 10)
+    yield harness.measure('markup.gen_signed_markup', lambda: ch.gen_signed_markup(signer, CHAT_ID, 42, 0), n * 10)
+
+    challenger = Challenger(FakeDb())
+    yield harness.measure('flow.solve', lambda user_id: solve_captcha(challenger, bot, user_id), n,
+                          setup=lambda: next(user_ids))
+    challenger = Challenger(FakeDb(), signer=signer)
+    yield harness.measure('flow.solve.signed', lambda user_id: solve_captcha(challenger, bot, user_id), n,
+                          setup=lambda: next(user_ids))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=200, help='operations per case, cheap cases run 10x as many')
+    parser.add_argument('-o', '--output', help='results file, defaults to bench/results/captcha-<commit>.json')
+    parser.add_argument('-b', '--baseline', help='results file of an earlier run to compare against')
+    args = parser.parse_args()
+
+    preload_glyphs()
+    results = list(cases(args.n))
+    harness.report(results, harness.load(args.baseline) if args.baseline else None)
+    print('Results written to', harness.save(SUITE, results, args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+"""Compares captcha images rendered per second on a single core: the font loaded from disk for every image,
+the cached glyphs, and the cached glyphs with the numpy noise renderer.
+"""
+import argparse
+import os
+import time
+
+from PIL import ImageFont
+
+from core.captcha.challenge import Challenge, font_name, preload_glyphs, PILLOW, NUMPY
+
+
+class UncachedChallenge(Challenge):
+    """Challenge drawing its text the way it used to: loading the font from disk for every image.
+    """
+    @staticmethod
+    def _draw_text(img, draw, xy, text, fill, size):
+        draw.text(xy, text, fill=fill, font=ImageFont.truetype(font_name, size))
+
+
+def images_per_second(challenge_cls, n: int, renderer: str = PILLOW) -> float:
+    challenges = [challenge_cls(renderer) for _ in range(n)]
+    start = time.perf_counter()
+    for ch in challenges:
+        ch.gen_img()
+    return n / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=500, help='images to render per run')
+    args = parser.parse_args()
+
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, {min(os.sched_getaffinity(0))})
+    preload_glyphs()
+
+    before = images_per_second(UncachedChallenge, args.n)
+    cached = images_per_second(Challenge, args.n)
+    vectorized = images_per_second(Challenge, args.n, NUMPY)
+    print(f'truetype per image:     {before:8.1f} images/s')
+    print(f'cached glyphs:          {cached:8.1f} images/s ({cached / before:.2f}x)')
+    print(f'cached glyphs + numpy:  {vectorized:8.1f} images/s ({vectorized / before:.2f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Measures the queries made on member joins and leaves against a chat with many members, first as collection
+scans and then with the indexes the IndexManager creates. One inviter holds a large share of all referrals,
+to show that joins and leaves through their link cost the same as any other. Needs a running MongoDB server,
+the benchmark works in a scratch database which is dropped afterwards.
+"""
+import argparse
+import random
+from datetime import datetime
+
+from pymongo import MongoClient, DESCENDING
+
+from core.db.indexes import IndexManager, REFERRAL_INDEXES
+from bench import harness
+
+SUITE = 'chat_members'
+GROUP_ID = -100
+
+
+def populate(members, referrals, n: int, referrers: float = 0.2, top_share: float = 0.2, batch: int = 10000):
+    """Inserts n members, a share of which has invite links with referrals, like a chat after a contest.
+    The first member is the top inviter, holding top_share of all members as referrals.
+    """
+    members.drop()
+    referrals.drop()
+    docs, edges = [], []
+
+    def flush():
+        if docs:
+            members.insert_many(docs, ordered=False)
+        if edges:
+            referrals.insert_many(edges, ordered=False)
+        docs.clear()
+        edges.clear()
+
+    for user_id in range(n):
+        doc = {'_id': user_id, 'captcha_completed': True, 'chat_id': user_id}
+        if user_id == 0 or random.random() < referrers:
+            invitees = range(1, int(n * top_share)) if user_id == 0 else random.sample(range(n), random.randint(1, 5))
+            doc.update(invite_link=f'https://t.me/+bench{user_id}', refs_size=len(invitees))
+            edges.extend({'group_id': GROUP_ID, 'inviter': user_id, 'invite_link': doc['invite_link'],
+                          'invitee': invitee, 'at': datetime.utcnow()} for invitee in invitees)
+        docs.append(doc)
+        if len(docs) >= batch or len(edges) >= batch:
+            flush()
+    flush()
+
+
+def cases(members, referrals, n: int, ops: int, suffix: str):
+    links = [doc['invite_link'] for doc in members.find({'invite_link': {'$exists': True}}, {'invite_link': 1})]
+    top_link = members.find_one({'_id': 0})['invite_link']
+    new_users = iter(range(n, n + 4 * ops + 100))
+
+    # the queries of MongoConn.set_new_ref, remove_ref and get_members_pts
+    def join(link):
+        referrals.insert_one({'group_id': GROUP_ID, 'inviter': None, 'invite_link': link,
+                              'invitee': next(new_users), 'at': datetime.utcnow()})
+        members.update_one({'invite_link': link}, {'$inc': {'refs_size': 1}}, upsert=True)
+
+    def leave(user_id):
+        edge = referrals.find_one_and_delete({'group_id': GROUP_ID, 'invitee': user_id}, sort=[('at', DESCENDING)])
+        if edge:
+            members.update_one({'invite_link': edge['invite_link'], 'refs_size': {'$gt': 0}},
+                               {'$inc': {'refs_size': -1}})
+
+    def leaderboard():
+        return [doc['_id'] for doc in members.find({'refs_size': {'$gt': 0}}, {'refs_size': 1})]
+
+    yield harness.measure(f'join.{suffix}', lambda: join(random.choice(links)), ops)
+    yield harness.measure(f'join.top_inviter.{suffix}', lambda: join(top_link), ops)
+    yield harness.measure(f'leave.{suffix}', lambda: leave(random.randrange(n)), ops)
+    yield harness.measure(f'leaderboard.{suffix}', leaderboard, max(1, ops // 10), warmup=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--mongo', default='mongodb://localhost:27017', help='MongoDB connection string')
+    parser.add_argument('-n', type=int, default=100000, help='members in the chat')
+    parser.add_argument('--ops', type=int, default=200, help='joins and leaves per case')
+    parser.add_argument('-o', '--output', help='results file, defaults to bench/results/chat_members-<commit>.json')
+    parser.add_argument('-b', '--baseline', help='results file of an earlier run to compare against')
+    args = parser.parse_args()
+
+    client = MongoClient(args.mongo)
+    db = client['bench_chat_members']
+    members, referrals = db[str(GROUP_ID)], db['referrals']
+    try:
+        populate(members, referrals, args.n)
+        results = list(cases(members, referrals, args.n, args.ops, 'scan'))
+        IndexManager().ensure(members)
+        IndexManager(REFERRAL_INDEXES).ensure(referrals)
+        results += list(cases(members, referrals, args.n, args.ops, 'indexed'))
+    finally:
+        client.drop_database(db)
+
+    harness.report(results, harness.load(args.baseline) if args.baseline else None)
+    print('Results written to', harness.save(SUITE, results, args.output))
+
+
+if __name__ == '__main__':
+    main()
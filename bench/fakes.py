@@ -0,0 +1,250 @@
+"""In-memory stand-ins for telegram's Bot and the Mongo connection, so handlers can be driven end to end
+without any network round trips, and a local stand-in for the Bitquery GraphQL endpoint. Only the calls made
+by the code under test are implemented.
+"""
+import functools
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+
+class FakeBot:
+    """Answers every call instantly with the minimal message a handler reads back. Uploaded photos are
+    read to the end, as python-telegram-bot would do before sending them, and the last keyboard sent is kept
+    so a benchmark can click its buttons. The texts of sent messages are kept in order.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.last_markup = None
+        self.texts = []
+        self._ids = itertools.count(1)
+
+    def _message(self, chat_id, photo=None):
+        self.calls += 1
+        if hasattr(photo, 'read'):
+            photo.read()
+        message_id = next(self._ids)
+        return SimpleNamespace(chat_id=chat_id, message_id=message_id,
+                               photo=[SimpleNamespace(file_id=f'file_{message_id}')])
+
+    def send_photo(self, chat_id, photo, reply_markup=None, **kwargs):
+        self.last_markup = reply_markup
+        return self._message(chat_id, photo)
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.texts.append(text)
+        return self._message(chat_id)
+
+    def edit_message_media(self, chat_id, message_id, media, reply_markup=None, **kwargs):
+        self.last_markup = reply_markup
+        return self._message(chat_id, media.media)
+
+    def get_chat(self, chat_id):
+        self.calls += 1
+        return SimpleNamespace(id=chat_id, full_name='Bench chat', invite_link='https://t.me/joinchat/bench')
+
+    def _ok(self, *args, **kwargs):
+        self.calls += 1
+        return True
+
+    delete_message = restrict_chat_member = unban_chat_member = kick_chat_member = _ok
+
+
+class FakeDb:
+    """Keeps captcha statuses and deadlines in dicts, and returns a fixed text for every handler.
+    """
+
+    def __init__(self):
+        self.status = {}
+        self.private_chats = {}
+        self.deadlines = {}
+
+    def get_captcha_status(self, chat_id, user_id):
+        return self.status.get((str(chat_id), str(user_id)), False)
+
+    def get_completed_captchas(self, chat_id, user_ids):
+        return {int(user_id) for user_id in user_ids if self.get_captcha_status(chat_id, user_id)}
+
+    def set_captcha_status(self, chat_id, user_id, status):
+        self.status[(str(chat_id), str(user_id))] = status
+
+    def set_private_chat_id(self, chat_id, user_id, private_chat_id):
+        self.private_chats[(str(chat_id), str(user_id))] = private_chat_id
+
+    def set_deadline(self, key, action, due, data, instance=None):
+        self.deadlines[key] = (action, due, data)
+
+    def remove_deadlines(self, keys):
+        for key in keys:
+            self.deadlines.pop(key, None)
+
+    def get_deadlines(self, instance=None):
+        return []
+
+    def remove_ref(self, chat_id, user_id):
+        pass
+
+    def get_text_by_handler(self, handler):
+        return handler
+
+
+def context(bot: FakeBot, args=None):
+    return SimpleNamespace(bot=bot, args=args or [])
+
+
+def command_update(user_id: int, text: str = ''):
+    """Update of a private /start command sent by the user.
+    """
+    user = SimpleNamespace(id=user_id, name=f'user{user_id}')
+    chat = SimpleNamespace(id=user_id)
+    message = SimpleNamespace(message_id=1, chat_id=user_id, text=text, from_user=user)
+    return SimpleNamespace(effective_user=user, effective_chat=chat, message=message, effective_message=message)
+
+
+def callback_update(user_id: int, data: str, message):
+    """Update of the user clicking a button with the given data on a private message.
+    """
+    user = SimpleNamespace(id=user_id, name=f'user{user_id}')
+    chat = SimpleNamespace(id=message.chat_id)
+    query = SimpleNamespace(data=data, message=message, answer=lambda *args, **kwargs: True)
+    return SimpleNamespace(effective_user=user, effective_chat=chat, message=None, effective_message=message,
+                           callback_query=query)
+
+
+class SimulatedMongo:
+    """Context manager pointing MongoConn at an in-memory mongomock server, where every collection call costs
+    a simulated network round trip. Round trips are counted, calls mongomock makes internally are not.
+    Connections opened in the context share one server, so a restarted MongoConn finds what the last one wrote.
+    Requires mongomock, which is only needed for benchmarks and tests and is installed from requirements-dev.txt.
+    """
+    methods = ('find_one', 'find', 'insert_one', 'insert_many', 'update_one', 'update_many', 'replace_one',
+               'bulk_write', 'delete_one', 'delete_many', 'find_one_and_update', 'count_documents',
+               'aggregate', 'create_index', 'create_indexes', 'drop')
+
+    def __init__(self, rtt: float = 0.001):
+        self.rtt = rtt
+        self.round_trips = 0
+        self._depth = 0
+        self._originals = {}
+
+    def __enter__(self):
+        import mongomock
+        from core.db import mongo_db
+
+        self._collection = mongomock.collection.Collection
+        for name in self.methods:
+            self._originals[name] = getattr(self._collection, name)
+            method = _bulk_write if name == 'bulk_write' else self._originals[name]
+            setattr(self._collection, name, self._wrap(method))
+        self._mongo_db = mongo_db
+        self._client = mongo_db.MongoClient
+        mongo_db.MongoClient = functools.partial(mongomock.MongoClient, _store=mongomock.store.ServerStore())
+        return self
+
+    def __exit__(self, *exc):
+        for name, original in self._originals.items():
+            setattr(self._collection, name, original)
+        self._mongo_db.MongoClient = self._client
+
+    def _wrap(self, method):
+        def call(collection, *args, **kwargs):
+            if not self._depth:
+                self.round_trips += 1
+                time.sleep(self.rtt)
+            self._depth += 1
+            try:
+                return method(collection, *args, **kwargs)
+            finally:
+                self._depth -= 1
+        return call
+
+
+def _bulk_write(collection, requests, ordered=True, **kwargs):
+    # mongomock's own bulk_write does not understand the operations of recent pymongo versions
+    from pymongo import InsertOne, UpdateOne, UpdateMany, ReplaceOne, DeleteOne, DeleteMany
+
+    for request in requests:
+        if isinstance(request, InsertOne):
+            collection.insert_one(request._doc)
+        elif isinstance(request, UpdateOne):
+            collection.update_one(request._filter, request._doc, upsert=request._upsert)
+        elif isinstance(request, UpdateMany):
+            collection.update_many(request._filter, request._doc, upsert=request._upsert)
+        elif isinstance(request, ReplaceOne):
+            collection.replace_one(request._filter, request._doc, upsert=request._upsert)
+        elif isinstance(request, DeleteOne):
+            collection.delete_one(request._filter)
+        elif isinstance(request, DeleteMany):
+            collection.delete_many(request._filter)
+
+
+class LocalGraphQL:
+    """Context manager serving a GraphQL endpoint on localhost, answering every query with an empty list of
+    trades after a fixed latency. A new connection costs a simulated TLS handshake, a share of the queries can
+    be answered with 503, the endpoint can hang until hang is cleared, and scripted responses can be queued as
+    (status, body, headers), answered in order before the default one, to exercise the client's failure
+    handling. Connections and requests are counted.
+    """
+
+    def __init__(self, latency: float = 0.0, handshake: float = 0.0):
+        self.latency = latency
+        self.handshake = handshake
+        self.fail_rate = 0.0
+        self.hang = False
+        self.script = []
+        self.connections = 0
+        self.requests = 0
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                stand_in.connections += 1
+                time.sleep(stand_in.handshake)
+
+            def do_POST(self):
+                stand_in.requests += 1
+                self.rfile.read(int(self.headers['Content-Length']))
+                while stand_in.hang:
+                    time.sleep(0.05)
+                time.sleep(stand_in.latency)
+                headers = {}
+                if stand_in.script:
+                    status, body, headers = stand_in.script.pop(0)
+                elif random.random() < stand_in.fail_rate:
+                    status, body = 503, b'Service Unavailable'
+                else:
+                    status, body = 200, json.dumps({'data': {'ethereum': {'dexTrades': []}}}).encode()
+                self.send_response(status)
+                headers.setdefault('Content-Length', str(len(body)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                try:
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client gave up waiting, as it does on a read timeout
+                    self.close_connection = True
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self._server.server_address[1]}/'
+
+    def __enter__(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,113 @@
+"""Shared measuring and reporting for the benchmark suites. Every case is timed per operation, reported as
+ops/sec with p50/p99 latency and peak memory, and a suite's results are written to a JSON file tagged with
+the commit they were measured on, so runs of different commits can be compared.
+"""
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Callable, List
+
+"""Directory the results are written to by default
+"""
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+
+def measure(name: str, fn: Callable, n: int, setup: Callable = None, warmup: int = 10) -> dict:
+    """Times n calls of fn, then repeats them with tracemalloc to find the peak memory of a call.
+    Memory is traced in a separate pass, as tracing slows down every allocation.
+
+    :param name: Name of the case
+    :param fn: Operation to measure, called with the result of setup if given
+    :param n: Number of operations to time
+    :param setup: Untimed callable preparing the argument of each operation
+    :param warmup: Untimed operations run first
+    :return: Result of the case
+    """
+    def run(count):
+        for _ in range(count):
+            arg = setup() if setup else None
+            start = time.perf_counter()
+            fn(arg) if setup else fn()
+            samples.append(time.perf_counter() - start)
+
+    samples = []
+    run(warmup)
+    samples = []
+    run(n)
+    total = sum(samples)
+
+    tracemalloc.start()
+    peak = 0
+    for _ in range(min(n, 50)):
+        arg = setup() if setup else None
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        fn(arg) if setup else fn()
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - baseline)
+    tracemalloc.stop()
+
+    samples.sort()
+    return {
+        'name': name,
+        'n': n,
+        'ops_per_sec': n / total if total else float('inf'),
+        'p50_us': percentile(samples, 0.50) * 1e6,
+        'p99_us': percentile(samples, 0.99) * 1e6,
+        'peak_kib': peak / 1024,
+    }
+
+
+def percentile(sorted_samples: List[float], q: float) -> float:
+    return sorted_samples[min(len(sorted_samples) - 1, int(q * len(sorted_samples)))]
+
+
+def report(results: List[dict], baseline: dict = None):
+    """Prints results as a table, with the change in ops/sec against a baseline run if given.
+    """
+    before = {r['name']: r for r in baseline['results']} if baseline else {}
+    print(f'{"case":<28} {"ops/s":>10} {"p50 us":>10} {"p99 us":>10} {"peak KiB":>10}')
+    for r in results:
+        line = f'{r["name"]:<28} {r["ops_per_sec"]:>10.1f} {r["p50_us"]:>10.1f} {r["p99_us"]:>10.1f} ' \
+               f'{r["peak_kib"]:>10.1f}'
+        if r['name'] in before:
+            line += f'  {r["ops_per_sec"] / before[r["name"]]["ops_per_sec"] - 1:+.1%}'
+        print(line)
+
+
+def save(suite: str, results: List[dict], path: str = None) -> str:
+    """Writes a suite's results to a JSON file, by default results/<suite>-<commit>.json.
+
+    :return: Path of the written file
+    """
+    commit = git_commit()
+    if not path:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f'{suite}-{commit[:10]}.json')
+    with open(path, 'w') as f:
+        json.dump({
+            'suite': suite,
+            'commit': commit,
+            'timestamp': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'results': results,
+        }, f, indent=2)
+    return path
+
+
+def load(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
@@ -0,0 +1,44 @@
+"""Benchmarks the contest leaderboard of a chat with many participants: sorting every member's points per
+/leaderboard call, as the contestor used to, against the Leaderboard kept ranked as referrals come and go.
+Results are written to bench/results as JSON, pass --baseline to compare against an earlier run.
+"""
+import argparse
+import random
+
+from core.db.leaderboard import Leaderboard
+from bench import harness
+
+SUITE = 'leaderboard'
+
+
+def cases(n: int, ops: int):
+    scores = {user_id: random.randint(1, 1000) for user_id in range(n)}
+    members = [{'id': user_id, 'pts': pts} for user_id, pts in scores.items()]
+    board = Leaderboard(scores)
+
+    def sort_top():
+        scoreboard = sorted(members, key=lambda i: i['pts'], reverse=True)
+        return scoreboard[:50], next((x for x in scoreboard if x['id'] == n // 2), None)
+
+    yield harness.measure('top50.sort', sort_top, max(1, ops // 100), warmup=1)
+    yield harness.measure('top50.board', lambda: board.top(50), ops)
+    yield harness.measure('rank.board', lambda: board.rank(random.randrange(n)), ops)
+    yield harness.measure('update.board', lambda: board.update(random.randrange(n), random.choice((1, -1))), ops)
+    yield harness.measure('load.board', lambda: Leaderboard(scores), 3, warmup=0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=1000000, help='participants of the contest')
+    parser.add_argument('--ops', type=int, default=10000, help='operations per case')
+    parser.add_argument('-o', '--output', help='results file, defaults to bench/results/leaderboard-<commit>.json')
+    parser.add_argument('-b', '--baseline', help='results file of an earlier run to compare against')
+    args = parser.parse_args()
+
+    results = list(cases(args.n, args.ops))
+    harness.report(results, harness.load(args.baseline) if args.baseline else None)
+    print('Results written to', harness.save(SUITE, results, args.output))
+
+
+if __name__ == '__main__':
+    main()
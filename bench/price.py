@@ -0,0 +1,65 @@
+"""Measures /price and /mc under bursts of concurrent requests against a simulated Bitquery API with a fixed
+latency: fetching the price on every request as the handlers used to, and serving it from the shared snapshot.
+Reports the remote queries each variant made, next to the latency a user sees.
+"""
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from core.bitquery.snapshot import Snapshot
+from bench import harness
+
+SUITE = 'price'
+
+
+class SimulatedBitquery:
+    """Answers price queries after a fixed latency and counts them.
+    """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.queries = 0
+
+    def fetch_price(self) -> float:
+        self.queries += 1
+        time.sleep(self.latency)
+        return 0.000001
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--latency', type=float, default=300, help='simulated Bitquery latency in ms')
+    parser.add_argument('--burst', type=int, default=10, help='concurrent /price and /mc requests per burst')
+    parser.add_argument('--interval', type=float, default=0.5, help='seconds between bursts')
+    parser.add_argument('--ttl', type=float, default=5.0, help='snapshot ttl in seconds')
+    parser.add_argument('-n', type=int, default=20, help='bursts per case')
+    parser.add_argument('-o', '--output', help='results file, defaults to bench/results/price-<commit>.json')
+    parser.add_argument('-b', '--baseline', help='results file of an earlier run to compare against')
+    args = parser.parse_args()
+
+    results = []
+    with ThreadPoolExecutor(args.burst) as workers:
+        def burst(fetch):
+            return lambda _: list(workers.map(lambda _: fetch(), range(args.burst)))
+
+        def pause():
+            time.sleep(args.interval)
+
+        direct = SimulatedBitquery(args.latency / 1000)
+        snapshot_api = SimulatedBitquery(args.latency / 1000)
+        snapshot = Snapshot(snapshot_api.fetch_price, ttl=args.ttl)
+        for name, api, fn in [('direct', direct, burst(direct.fetch_price)),
+                              ('snapshot', snapshot_api, burst(lambda: snapshot.get().value))]:
+            result = harness.measure(f'burst{args.burst}.{name}', fn, args.n, setup=pause, warmup=0)
+            # measure runs every burst twice, once timed and once tracing memory
+            result['queries_per_burst'] = api.queries / (args.n + min(args.n, 50))
+            results.append(result)
+
+    harness.report(results, harness.load(args.baseline) if args.baseline else None)
+    for result in results:
+        print(f"{result['name']:<24} {result['queries_per_burst']:>8.2f} Bitquery queries per burst")
+    print('Results written to', harness.save(SUITE, results, args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Measures the price queries for k tokens: the query q_price used to send per token, selecting every field of
+a trade, a query per token selecting only the fields the ingester reads, and a single aliased query for all
+tokens. Reports the request and response bytes and round trips per refresh, and times decoding the responses
+and extracting the prices from them.
+"""
+import argparse
+import json
+
+from core.bitquery.queries import batch_trades_query
+from bench import harness
+from bench.trades import SimulatedChain, TOKEN
+
+SUITE = 'queries'
+
+"""The query q_price sent, with the trade fields it selected
+"""
+LEGACY_QUERY = """
+            query{
+  ethereum(network: bsc) {
+    dexTrades(
+      options: {limit: 10, desc: "block.height"}
+      exchangeName: {is: "Pancake v2"}
+      baseCurrency: {is: "%s"}
+    ) {
+      transaction {
+        hash
+      }
+      smartContract {
+        address {
+          address
+        }
+        contractType
+        currency {
+          name
+        }
+      }
+      tradeIndex
+      date {
+        date
+      }
+      block {
+        height
+      }
+      buyAmount
+      buyAmountInUsd: buyAmount(in: USD)
+      buyCurrency {
+        symbol
+        address
+      }
+      sellAmount
+      sellAmountInUsd: sellAmount(in: USD)
+      sellCurrency {
+        symbol
+        address
+      }
+      sellAmountInUsd: sellAmount(in: USD)
+      tradeAmount(in: USD)
+      transaction {
+        gasValue
+        gasPrice
+        gas
+      }
+    }
+  }
+}
+        """
+
+
+def prices(trades: list) -> list:
+    return [t['sellAmountInUsd'] / t['buyAmount'] if t['buyCurrency']['address'] == TOKEN
+            else t['buyAmountInUsd'] / t['sellAmount'] for t in trades]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--tokens', type=int, nargs='+', default=[1, 5], help='numbers of tokens to price')
+    parser.add_argument('--trades', type=int, default=10, help='trades per token and response')
+    parser.add_argument('--ops', type=int, default=2000, help='responses decoded per case')
+    parser.add_argument('-o', '--output', help='results file, defaults to bench/results/queries-<commit>.json')
+    parser.add_argument('-b', '--baseline', help='results file of an earlier run to compare against')
+    args = parser.parse_args()
+
+    full, minimal = SimulatedChain(args.trades, full=True), SimulatedChain(args.trades)
+    full.mine()
+    minimal.mine()
+
+    def body(trades: dict) -> str:
+        return json.dumps({'data': {'ethereum': trades}})
+
+    results = []
+    for k in args.tokens:
+        aliases = [f't{i}' for i in range(k)]
+        legacy = [(LEGACY_QUERY % TOKEN, body({'dexTrades': full.trades}))] * k
+        single = [(batch_trades_query({'t0': (TOKEN, 0, 0, args.trades)}), body({'t0': minimal.trades}))] * k
+        batched = [(batch_trades_query({alias: (TOKEN, 0, 0, args.trades) for alias in aliases}),
+                    body({alias: minimal.trades for alias in aliases}))]
+
+        for name, requests in [('legacy', legacy), ('minimal', single), ('batched', batched)]:
+            def parse():
+                return [prices(trades) for _, response in requests
+                        for trades in json.loads(response)['data']['ethereum'].values()]
+
+            result = harness.measure(f'{name}.tokens{k}', parse, args.ops)
+            result['round_trips'] = len(requests)
+            result['request_bytes'] = sum(len(query) for query, _ in requests)
+            result['response_bytes'] = sum(len(response) for _, response in requests)
+            results.append(result)
+
+    harness.report(results, harness.load(args.baseline) if args.baseline else None)
+    print(f'{"case":<28} {"round trips":>12} {"request B":>10} {"response B":>11}')
+    for r in results:
+        print(f"{r['name']:<28} {r['round_trips']:>12} {r['request_bytes']:>10} {r['response_bytes']:>11}")
+    print('Results written to', harness.save(SUITE, results, args.output))
+
+
+if __name__ == '__main__':
+    main()
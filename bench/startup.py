@@ -0,0 +1,85 @@
+"""Measures bot startup against a simulated Mongo server with a fixed round trip time: seeding the default
+handlers field by field as it used to be done, in one bulk write, and skipped by the stored hash, and a cold
+start of Samaritan up to the point where it would start polling.
+"""
+import argparse
+import logging
+import os
+import tempfile
+
+from core.db.mongo_db import MongoConn
+from core.default_commands import commands
+from bench import harness
+from bench.fakes import SimulatedMongo
+
+SUITE = 'startup'
+
+
+def seed_per_field(db: MongoConn):
+    """Seeds the default handlers the way it used to be done, with one update per field.
+    """
+    for key, value in commands.items():
+        for inner_key, inner_val in value.items():
+            db.default_handlers.update_one({'_id': key}, {'$set': {inner_key: inner_val}}, upsert=True)
+
+
+def empty_db() -> MongoConn:
+    db = MongoConn('mongodb://bench')
+    db.default_handlers.drop()
+    db.meta.drop()
+    return db
+
+
+def cold_start(token_path: str, db_path: str):
+    from core.samaritan import Samaritan
+
+    samaritan = Samaritan(tg_api_path=token_path, db_api_path=db_path, log_level=logging.WARNING,
+                          captcha_pool_depth=0)
+    samaritan.captcha_pool.start()
+    samaritan.captcha_pool.stop()
+    samaritan.render_executor.shutdown()
+
+
+def round_trips(mongo: SimulatedMongo, fn, arg) -> int:
+    before = mongo.round_trips
+    fn(arg)
+    return mongo.round_trips - before
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=20, help='runs per case')
+    parser.add_argument('--rtt', type=float, default=1.0, help='simulated round trip time in ms')
+    parser.add_argument('-o', '--output', help='results file, defaults to bench/results/startup-<commit>.json')
+    parser.add_argument('-b', '--baseline', help='results file of an earlier run to compare against')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # the key files the bot reads on startup
+        token_path, db_path = os.path.join(tmp, 'api_key'), os.path.join(tmp, 'mongo_api')
+        for path, content in ((token_path, '123456:bench-token'), (db_path, 'mongodb://bench')):
+            with open(path, 'w') as f:
+                f.write(content)
+
+        with SimulatedMongo(rtt=args.rtt / 1000) as mongo:
+            seeded = MongoConn('mongodb://bench')
+            cases = [
+                ('seed.per_field', seed_per_field, empty_db),
+                ('seed.bulk_write', lambda db: db.set_default_handlers(), empty_db),
+                ('seed.hash_skip', lambda db: db.set_default_handlers(), lambda: seeded),
+                ('samaritan.cold_start', lambda _: cold_start(token_path, db_path), lambda: None),
+            ]
+            results = []
+            for name, fn, setup in cases:
+                result = harness.measure(name, fn, args.n, setup=setup, warmup=1)
+                result['round_trips'] = round_trips(mongo, fn, setup())
+                results.append(result)
+
+    harness.report(results, harness.load(args.baseline) if args.baseline else None)
+    for result in results:
+        print(f'{result["name"]:<28} {result["round_trips"]:>4} round trips')
+    print('Results written to', harness.save(SUITE, results, args.output))
+
+
+if __name__ == '__main__':
+    main()
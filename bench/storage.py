@@ -0,0 +1,87 @@
+"""Compares the storage backends on the calls the bot makes per chat member: captcha status reads and writes,
+joins and leaves through invite links, and the contest leaderboard, against a chat of n members. The Mongo
+backend runs against a simulated server with a fixed round trip time, so no backend needs a running service.
+"""
+import argparse
+import os
+import random
+import tempfile
+
+from core.db import connect, MEMORY, SQLITE, MONGO, Storage
+from bench import harness
+from bench.fakes import SimulatedMongo
+
+SUITE = 'storage'
+CHAT_ID = -100
+
+
+def populate(db: Storage, n: int, referrers: float = 0.2) -> list:
+    """Adds n members who solved their captcha, a share of which has an invite link. Returns the links.
+    """
+    links = []
+    for user_id in range(n):
+        db.set_captcha_status(CHAT_ID, user_id, True)
+        if random.random() < referrers:
+            links.append(f'https://t.me/+bench{user_id}')
+            db.set_invite_link_by_id(CHAT_ID, links[-1], user_id)
+    return links
+
+
+def cases(db: Storage, backend: str, links: list, n: int, ops: int):
+    new_users = iter(range(n, n + 4 * ops + 100))
+    joined = []
+
+    def join():
+        user_id = next(new_users)
+        db.set_new_ref(CHAT_ID, random.choice(links), user_id)
+        joined.append(user_id)
+
+    def leave():
+        if joined:
+            db.remove_ref(CHAT_ID, joined.pop(random.randrange(len(joined))))
+
+    yield harness.measure(f'captcha.get.{backend}', lambda: db.get_captcha_status(CHAT_ID, random.randrange(n)), ops)
+    yield harness.measure(f'captcha.set.{backend}',
+                          lambda: db.set_captcha_status(CHAT_ID, random.randrange(n), True), ops)
+    yield harness.measure(f'join.{backend}', join, ops)
+    yield harness.measure(f'leave.{backend}', leave, ops)
+    yield harness.measure(f'members_pts.top50.{backend}', lambda: db.get_members_pts(CHAT_ID, 50),
+                          max(1, ops // 10), warmup=1)
+    yield harness.measure(f'handler_text.{backend}', lambda: db.get_text_by_handler('website'), ops)
+
+
+def run(backend: str, path: str, n: int, ops: int):
+    db = connect(backend, path)
+    try:
+        return list(cases(db, backend, populate(db, n), n, ops))
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=10000, help='members in the chat')
+    parser.add_argument('--ops', type=int, default=1000, help='operations per case')
+    parser.add_argument('--rtt', type=float, default=0.5, help='simulated Mongo round trip time in ms')
+    parser.add_argument('--backends', nargs='+', default=[MEMORY, SQLITE, MONGO], help='backends to compare')
+    parser.add_argument('-o', '--output', help='results file, defaults to bench/results/storage-<commit>.json')
+    parser.add_argument('-b', '--baseline', help='results file of an earlier run to compare against')
+    args = parser.parse_args()
+
+    results = []
+    for backend in args.backends:
+        if backend == SQLITE:
+            with tempfile.TemporaryDirectory() as tmp:
+                results += run(backend, os.path.join(tmp, 'samaritan.db'), args.n, args.ops)
+        elif backend == MONGO:
+            with SimulatedMongo(rtt=args.rtt / 1000):
+                results += run(backend, 'mongodb://bench', args.n, args.ops)
+        else:
+            results += run(backend, None, args.n, args.ops)
+
+    harness.report(results, harness.load(args.baseline) if args.baseline else None)
+    print('Results written to', harness.save(SUITE, results, args.output))
+
+
+if __name__ == '__main__':
+    main()
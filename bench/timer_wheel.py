@@ -0,0 +1,57 @@
+"""Measures the timer wheel with many pending captcha deadlines: cost to schedule, cancel and fire,
+and memory held per pending deadline.
+"""
+import argparse
+import random
+import time
+import tracemalloc
+
+from core import CAPTCHA_TIMEOUT, BAN_DURATION
+from core.utils.timer_wheel import TimerWheel
+
+
+def noop(ctx, *args):
+    pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=50000, help='pending deadlines')
+    args = parser.parse_args()
+
+    delays = [random.choice((CAPTCHA_TIMEOUT, BAN_DURATION)).total_seconds() * random.random() for _ in range(args.n)]
+
+    tracemalloc.start()
+    wheel = TimerWheel()
+    for user_id, delay in enumerate(delays):
+        wheel.schedule(('kick', -100, user_id), delay, noop, -100, user_id)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    wheel = TimerWheel()
+    start = time.perf_counter()
+    for user_id, delay in enumerate(delays):
+        wheel.schedule(('kick', -100, user_id), delay, noop, -100, user_id)
+    schedule = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for user_id in range(0, args.n, 2):
+        wheel.cancel(('kick', -100, user_id))
+    cancel = time.perf_counter() - start
+    cancelled = (args.n + 1) // 2
+
+    # pretend the whole ban window has passed, so every remaining deadline fires in one batch
+    wheel._origin -= BAN_DURATION.total_seconds() + 1
+    start = time.perf_counter()
+    wheel.tick(None)
+    fire = time.perf_counter() - start
+
+    print(f'pending deadlines:  {args.n}')
+    print(f'schedule:           {schedule / args.n * 1e6:8.2f} us/op')
+    print(f'cancel:             {cancel / cancelled * 1e6:8.2f} us/op')
+    print(f'fire:               {fire / (args.n - cancelled) * 1e6:8.2f} us/op ({wheel.fired} in one tick)')
+    print(f'memory:             {memory / args.n:8.0f} bytes/deadline')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""Measures price refreshes against a simulated Bitquery API on a chain producing new trades: refetching the
+latest 10 trades with every field the old query selected and averaging them, as fetch_price used to, and
+ingesting only the trades of new blocks into the TradeStore. Reports the response bytes per refresh, and the
+latency of VWAP and OHLC over a store of n trades.
+"""
+import argparse
+import json
+import random
+import time
+
+import numpy as np
+
+from core.bitquery.trades import TradeStore, TradeIngester, PRICE_WINDOW
+from bench import harness
+
+SUITE = 'trades'
+TOKEN = '0x' + 'b' * 40
+
+"""Fields of a trade the old price query selected besides those the ingester needs
+"""
+OLD_FIELDS = {
+    'transaction': {'hash': '0x' + '0' * 64, 'gasValue': 0.0005, 'gasPrice': 5.0, 'gas': 150000},
+    'smartContract': {'address': {'address': '0x' + '0' * 40}, 'contractType': 'DEX',
+                      'currency': {'name': 'Pancake LPs'}},
+    'date': {'date': '2021-06-01'},
+    'sellCurrency': {'symbol': 'WBNB', 'address': '0x' + '0' * 40},
+    'tradeAmount': 12.5,
+}
+
+
+class SimulatedChain:
+    """Produces trades at a fixed number per block, and answers dexTrades queries the way Bitquery would,
+    measuring the size of every response.
+    """
+
+    def __init__(self, trades_per_block: int, full: bool = False):
+        self.trades_per_block = trades_per_block
+        self.full = full
+        self.trades = []
+        self.height = 0
+        self.queries = 0
+        self.response_bytes = 0
+
+    def mine(self, blocks: int = 1):
+        for _ in range(blocks):
+            self.height += 1
+            for index in range(self.trades_per_block):
+                amount = random.uniform(1e6, 1e9)
+                trade = {'tradeIndex': '0', 'transaction': {'hash': f'0x{self.height:032x}{index:032x}'},
+                         'block': {'height': self.height, 'timestamp': {'unixtime': time.time()}},
+                         'buyAmount': amount, 'buyAmountInUsd': amount * 1e-6,
+                         'buyCurrency': {'address': TOKEN},
+                         'sellAmount': amount * 2e-9, 'sellAmountInUsd': amount * 1e-6 * random.uniform(0.98, 1.02)}
+                if self.full:
+                    trade.update(OLD_FIELDS, transaction={**OLD_FIELDS['transaction'], **trade['transaction']})
+                    trade['buyCurrency']['symbol'] = 'SAMA'
+                self.trades.append(trade)
+
+    def fetch(self, from_height, offset: int, limit: int) -> list:
+        if from_height is None:
+            trades = self.trades[::-1][:limit]
+        else:
+            trades = [t for t in self.trades if t['block']['height'] >= from_height][offset:offset + limit]
+        self.queries += 1
+        self.response_bytes += len(json.dumps({'data': {'ethereum': {'dexTrades': trades}}}))
+        return trades
+
+
+def refetch_price(chain: SimulatedChain) -> float:
+    prices = []
+    for trade in chain.fetch(None, 0, 10):
+        prices.append(trade['sellAmountInUsd'] / trade['buyAmount'])
+    return sum(prices) / len(prices)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=20000, help='trades in the store for the window cases')
+    parser.add_argument('--trades-per-block', type=int, default=2, help='new trades between refreshes')
+    parser.add_argument('--ops', type=int, default=500, help='refreshes and lookups per case')
+    parser.add_argument('-o', '--output', help='results file, defaults to bench/results/trades-<commit>.json')
+    parser.add_argument('-b', '--baseline', help='results file of an earlier run to compare against')
+    args = parser.parse_args()
+
+    results = []
+    refetch_chain = SimulatedChain(args.trades_per_block, full=True)
+    refetch_chain.mine(10)
+    ingest_chain = SimulatedChain(args.trades_per_block)
+    ingest_chain.mine(10)
+    ingester = TradeIngester(lambda requests: {'SAMA': ingest_chain.fetch(*requests['SAMA'])}, {'SAMA': TOKEN})
+    store = ingester.stores['SAMA']
+    ingester.ingest()
+
+    for name, chain, refresh in [('refetch10', refetch_chain, lambda _: refetch_price(refetch_chain)),
+                                 ('ingest', ingest_chain,
+                                  lambda _: (ingester.ingest(), store.current_price(PRICE_WINDOW)))]:
+        queries, response_bytes = chain.queries, chain.response_bytes
+        result = harness.measure(f'refresh.{name}', refresh, args.ops, setup=chain.mine, warmup=0)
+        # measure runs every refresh twice, once timed and once tracing memory
+        result['bytes_per_refresh'] = (chain.response_bytes - response_bytes) / (chain.queries - queries)
+        results.append(result)
+
+    now = time.time()
+    full = TradeStore()
+    # a trade per second, up to now
+    full.append(np.arange(args.n), now - args.n + np.arange(1, args.n + 1),
+                np.random.uniform(0.9e-6, 1.1e-6, args.n), np.random.uniform(1e6, 1e9, args.n))
+    for window in (PRICE_WINDOW, 24 * 60 * 60):
+        results.append(harness.measure(f'vwap.{window}s.n{args.n}', lambda: full.vwap(window, now), args.ops))
+        results.append(harness.measure(f'ohlc.{window}s.n{args.n}', lambda: full.ohlc(window, now), args.ops))
+
+    harness.report(results, harness.load(args.baseline) if args.baseline else None)
+    for result in results:
+        if 'bytes_per_refresh' in result:
+            print(f"{result['name']:<28} {result['bytes_per_refresh']:>10.0f} response bytes per refresh")
+    print('Results written to', harness.save(SUITE, results, args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -34,10 +34,16 @@ CAPTCHA = 'captcha'
 """
 DEFAULT_DELAY = timedelta(seconds=30)
 
+"""Time to complete a captcha before being kicked, and how long failing it bans for
+"""
+CAPTCHA_TIMEOUT = timedelta(seconds=120)
+BAN_DURATION = timedelta(seconds=7200)
+
 """Deeplink/callback constants
 """
 CALLBACK_DIVIDER = '_'
 CAPTCHA_CALLBACK_PREFIX = 'completed'
+SIGNED_CAPTCHA_CALLBACK_PREFIX = 'signed'
 CAPTCHA_PREFIX = 'captcha'
 INVITE_PREFIX = 'invite'
 LOUNGE_PREFIX = 'lounge'
@@ -0,0 +1,151 @@
+import secrets
+import time
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+from telegram import Update
+from telegram.ext import CallbackContext, CommandHandler
+
+from core.alert.index import AlertIndex, ABOVE, BELOW, CHANGE
+from core.alert.sender import RateLimitedSender
+from core.bitquery.graphcli import GraphQLClient
+from core.bitquery.snapshot import Quote
+from core.db import Storage
+from core.samaritable import Samaritable
+from core.utils.utils import log_entexit, send_message, fallback_chat_id, fallback_user_id
+
+"""Alerts a member can have set in a chat at once
+"""
+ALERT_MAX_PER_USER = 5
+
+ALERT_USAGE = 'Get notified when the price moves, instead of checking /price:\n' \
+              '/alert above <price> [token]\n' \
+              '/alert below <price> [token]\n' \
+              '/alert change <percent>% [token]\n' \
+              '/alert list - your alerts in this chat\n' \
+              '/alert clear - remove them'
+
+
+def format_usd(price: float) -> str:
+    return f'{price:.12f}'.rstrip('0').rstrip('.') + ' $'
+
+
+class Alerter(Samaritable):
+    """Price alerts of chat members. Alerts are checked against every price the shared price snapshot fetches,
+    so the price is polled once for all of them, and crossed alerts are found in a per token AlertIndex.
+    Fired alerts are removed and announced in their chat through a RateLimitedSender.
+    """
+
+    def __init__(self,
+                 db: Storage,
+                 graphql: GraphQLClient,
+                 sender: RateLimitedSender):
+        super().__init__(db)
+        self.graphql = graphql
+        self.sender = sender
+        self.indexes = {symbol: AlertIndex() for symbol in graphql.tokens}
+        self.fired = 0
+        for alert in db.get_alerts():
+            if alert['token'] in self.indexes:
+                self.indexes[alert['token']].add(alert['_id'], alert)
+        graphql.price_snapshot.listeners.append(self.check)
+
+    @log_entexit
+    def alert(self, up: Update, ctx: CallbackContext):
+        chat_id = fallback_chat_id(up)
+        user_id = fallback_user_id(up)
+        args = [arg.lower() for arg in ctx.args]
+        if not args:
+            send_message(up, ctx, ALERT_USAGE)
+        elif args[0] == 'list':
+            alerts = self.member_alerts(chat_id, user_id)
+            send_message(up, ctx, '\n'.join(self.describe(alert) for _, alert in alerts) if alerts
+                         else 'You have no alerts set in this chat')
+        elif args[0] == 'clear':
+            keys = [key for key, _ in self.member_alerts(chat_id, user_id)]
+            self.remove(keys)
+            send_message(up, ctx, f'Removed {len(keys)} alerts')
+        elif args[0] in (ABOVE, BELOW, CHANGE) and len(args) in (2, 3):
+            self.add(up, ctx, chat_id, user_id, args[0], args[1], args[2].upper() if len(args) == 3 else None)
+        else:
+            send_message(up, ctx, f'Invalid arguments: {ctx.args} for alert command\n\n' + ALERT_USAGE)
+
+    def add(self, up: Update, ctx: CallbackContext, chat_id, user_id, kind: str, value: str, symbol: str = None):
+        symbol = symbol or self.graphql.primary
+        if symbol not in self.indexes:
+            send_message(up, ctx, f'Unknown token {symbol}, prices are tracked for {", ".join(self.indexes)}')
+            return
+        try:
+            threshold = float(value.rstrip('%')) / 100 if kind == CHANGE else float(value)
+        except ValueError:
+            send_message(up, ctx, f'Invalid {"percentage" if kind == CHANGE else "price"}: {value}')
+            return
+        if threshold <= 0:
+            send_message(up, ctx, 'The alert needs a positive value')
+            return
+        if len(self.member_alerts(chat_id, user_id)) >= ALERT_MAX_PER_USER:
+            send_message(up, ctx, f'You already have {ALERT_MAX_PER_USER} alerts set, /alert clear removes them')
+            return
+        quote = self.graphql.get_quote(up, ctx)
+        if quote is None:
+            return
+        price = quote.value.get(symbol)
+        if price is None:
+            send_message(up, ctx, f'No trades of {symbol} seen yet')
+            return
+        if kind == ABOVE and price >= threshold or kind == BELOW and price <= threshold:
+            send_message(up, ctx, f'{symbol} is at {format_usd(price)} already')
+            return
+
+        alert = {'chat_id': int(chat_id), 'user_id': int(user_id), 'name': up.effective_user.name, 'token': symbol,
+                 'kind': kind, 'threshold': threshold, 'base': price, 'created': time.time()}
+        key = f'{chat_id}:{user_id}:{secrets.token_hex(4)}'
+        self.db.set_alert(key, alert)
+        self.indexes[symbol].add(key, alert)
+        send_message(up, ctx, f'Alert set: {self.describe(alert)}')
+
+    def remove(self, keys: List[str]):
+        for key in keys:
+            for index in self.indexes.values():
+                index.remove(key)
+        self.db.remove_alerts(keys)
+
+    def member_alerts(self, chat_id, user_id) -> List[Tuple[str, dict]]:
+        return [(key, alert) for index in self.indexes.values() for key, alert in list(index.alerts.items())
+                if alert['chat_id'] == int(chat_id) and alert['user_id'] == int(user_id)]
+
+    @staticmethod
+    def describe(alert: dict, price: float = None) -> str:
+        if alert['kind'] == CHANGE:
+            text = f"{alert['token']} moving {alert['threshold']:.1%} from {format_usd(alert['base'])}"
+        else:
+            text = f"{alert['token']} {alert['kind']} {format_usd(alert['threshold'])}"
+        if price is not None:
+            text += f', now at {format_usd(price)}'
+            if alert['kind'] == CHANGE:
+                text += f" ({price / alert['base'] - 1:+.1%})"
+        return text
+
+    def check(self, quote: Quote):
+        """Fires the alerts crossed by a new quote. Called by the price snapshot with every price it fetches.
+        """
+        fired: Dict[int, List[str]] = defaultdict(list)
+        keys = []
+        for symbol, price in quote.value.items():
+            index = self.indexes.get(symbol)
+            if not index:
+                continue
+            for key, alert in index.fire(price):
+                keys.append(key)
+                fired[alert['chat_id']].append(f"🔔 {alert['name']}: {self.describe(alert, price)}")
+        if not keys:
+            return
+        self.db.remove_alerts(keys)
+        self.fired += len(keys)
+        self.log.info('Fired %d price alerts in %d chats', len(keys), len(fired))
+        for chat_id, texts in fired.items():
+            for text in texts:
+                self.sender.send(chat_id, text)
+
+    def add_handlers(self, dp):
+        dp.add_handler(CommandHandler('alert', self.alert))
@@ -0,0 +1,73 @@
+import itertools
+import math
+import threading
+from bisect import bisect_left, bisect_right, insort
+from typing import Dict, List, Optional, Tuple
+
+"""Kinds of alerts: fired when the price rises to a threshold, falls to one, or changes by a fraction of the
+price the alert was set at
+"""
+ABOVE = 'above'
+BELOW = 'below'
+CHANGE = 'change'
+
+
+def bounds(alert: dict) -> Tuple[Optional[float], Optional[float]]:
+    """Returns the prices an alert fires at, rising and falling, None if it does not fire in that direction.
+    """
+    if alert['kind'] == ABOVE:
+        return alert['threshold'], None
+    if alert['kind'] == BELOW:
+        return None, alert['threshold']
+    return alert['base'] * (1 + alert['threshold']), alert['base'] * (1 - alert['threshold'])
+
+
+class AlertIndex:
+    """Price alerts of a token, by the prices they fire at. Rising and falling thresholds are kept in a sorted
+    list each, so a new price finds the alerts it crossed with a binary search, and no other alert is looked at.
+    """
+
+    def __init__(self):
+        self.alerts: Dict[str, dict] = {}
+        # (price, sequence, key), the sequence orders equal prices without comparing keys
+        self._rising = []
+        self._falling = []
+        self._entries = {}
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.alerts)
+
+    def add(self, key: str, alert: dict):
+        with self._lock:
+            self._remove(key)
+            rising, falling = bounds(alert)
+            sequence = next(self._sequence)
+            entries = []
+            if rising is not None:
+                entries.append((self._rising, (rising, sequence, key)))
+            if falling is not None:
+                entries.append((self._falling, (falling, sequence, key)))
+            for thresholds, entry in entries:
+                insort(thresholds, entry)
+            self.alerts[key] = alert
+            self._entries[key] = entries
+
+    def remove(self, key: str) -> Optional[dict]:
+        with self._lock:
+            return self._remove(key)
+
+    def _remove(self, key: str) -> Optional[dict]:
+        for thresholds, entry in self._entries.pop(key, []):
+            del thresholds[bisect_left(thresholds, entry)]
+        return self.alerts.pop(key, None)
+
+    def fire(self, price: float) -> List[Tuple[str, dict]]:
+        """Removes and returns the alerts the price crossed, as (key, alert).
+        """
+        with self._lock:
+            rose = bisect_right(self._rising, (price, math.inf))
+            fell = bisect_left(self._falling, (price, -math.inf))
+            keys = {key for _, _, key in self._rising[:rose]} | {key for _, _, key in self._falling[fell:]}
+            return [(key, self._remove(key)) for key in keys]
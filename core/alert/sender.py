@@ -0,0 +1,91 @@
+import logging
+import threading
+import time
+
+from telegram import Bot
+from telegram.error import RetryAfter, TelegramError
+
+"""Messages sent per second across all chats, below Telegram's limit of 30
+"""
+SEND_RATE = 25
+
+"""Seconds between messages to the same chat, Telegram allows 20 messages per minute in a group
+"""
+CHAT_SEND_INTERVAL = 3
+
+
+class RateLimitedSender:
+    """Sends messages from a background thread, at most rate per second and one per chat_interval seconds to
+    the same chat. Messages queued for a chat while it waits are joined into one.
+    """
+
+    def __init__(self, bot: Bot, rate: float = SEND_RATE, chat_interval: float = CHAT_SEND_INTERVAL):
+        self.log = logging.getLogger('samaritan.ratelimitedsender')
+        self.bot = bot
+        self.interval = 1 / rate
+        self.chat_interval = chat_interval
+        self.sent = 0
+        self.failed = 0
+        self._pending = {}
+        self._chat_next = {}
+        self._next = 0.0
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='alert-sender', daemon=True)
+        self._thread.start()
+
+    def send(self, chat_id, text: str):
+        with self._cond:
+            self._pending.setdefault(chat_id, []).append(text)
+            self._cond.notify()
+
+    def stop(self, timeout: float = 5):
+        """Stops once the queued messages are sent, or after timeout seconds.
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._pending:
+                        if self._stopped:
+                            return
+                        self._cond.wait()
+                        continue
+                    # the chat waiting the shortest, in the order they were queued
+                    chat_id = min(self._pending, key=lambda chat: self._chat_next.get(chat, 0))
+                    wait = max(self._chat_next.get(chat_id, 0), self._next) - time.monotonic()
+                    if wait <= 0:
+                        texts = self._pending.pop(chat_id)
+                        break
+                    self._cond.wait(wait)
+            self._deliver(chat_id, texts)
+
+    def _deliver(self, chat_id, texts: list):
+        try:
+            self.bot.send_message(chat_id, '\n'.join(texts), disable_web_page_preview=True)
+            self.sent += 1
+        except RetryAfter as e:
+            self.log.warning('Flood limit reached sending to %s, retrying in %ss', chat_id, e.retry_after)
+            with self._cond:
+                self._pending[chat_id] = texts + self._pending.get(chat_id, [])
+                self._next = time.monotonic() + e.retry_after
+            return
+        except TelegramError as e:
+            self.failed += 1
+            self.log.warning('Sending %d alerts to %s failed: %s', len(texts), chat_id, e)
+        now = time.monotonic()
+        with self._cond:
+            self._next = now + self.interval
+            self._chat_next[chat_id] = now + self.chat_interval
+            for chat, at in list(self._chat_next.items()):
+                if at < now:
+                    del self._chat_next[chat]
@@ -1,16 +1,12 @@
-import requests
+from core.bitquery.client import BitqueryClient, QueryFailed, CircuitOpen
 
-from core.utils.utils import read_api
-
-api_key = read_api('bitquery_api')
+"""Client shared by every query, created on the first one
+"""
+client = None
 
 
 def run_query(query):
-    headers = {'X-API-KEY': api_key}
-    request = requests.post('https://graphql.bitquery.io/',
-                            json={'query': query}, headers=headers)
-    if request.status_code == 200:
-        return request.json()
-    else:
-        raise Exception('Query failed and return code is {}.      {}'.format(request.status_code,
-                                                                             query))
+    global client
+    if client is None:
+        client = BitqueryClient()
+    return client.query(query)
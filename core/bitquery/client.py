@@ -0,0 +1,241 @@
+import logging
+import random
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from core.utils.utils import read_api
+
+"""GraphQL endpoint of Bitquery, and the file holding the API key
+"""
+BITQUERY_URL = 'https://graphql.bitquery.io/'
+BITQUERY_API_KEY_FILE = 'bitquery_api'
+
+"""Seconds to wait for a connection, and for the response once connected
+"""
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 20
+
+"""Retries of a failed query, and the base and maximum seconds of the jittered exponential backoff between them
+"""
+MAX_RETRIES = 2
+RETRY_BACKOFF = 0.5
+RETRY_BACKOFF_MAX = 8
+
+"""Keep-alive connections held to the endpoint
+"""
+POOL_SIZE = 4
+
+"""Consecutive failed queries that open the circuit, and seconds it stays open before a trial query is let through
+"""
+BREAKER_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 60
+
+"""Number of latest query latencies kept for the stats
+"""
+LATENCY_SAMPLES = 1000
+
+"""Status codes worth retrying, as the next attempt may succeed
+"""
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+"""Errors worth retrying: the connection failed, timed out or broke off while the response was read
+"""
+RETRY_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+
+class QueryFailed(Exception):
+    """Raised when a query fails after its retries, or is answered with GraphQL errors only.
+    """
+
+
+class CircuitOpen(QueryFailed):
+    """Raised without querying while the circuit breaker is open.
+    """
+
+
+class CircuitBreaker:
+    """Fails queries fast after threshold consecutive failures. After reset_timeout seconds a single trial
+    query is let through, its success closes the circuit again, its failure keeps it open for another timeout.
+    """
+
+    def __init__(self, threshold: int = BREAKER_THRESHOLD, reset_timeout: float = BREAKER_RESET_TIMEOUT):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if time.monotonic() - self.opened_at >= self.reset_timeout else 'open'
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self._trial or time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self._trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self) -> bool:
+        """Counts a failed query.
+
+        :return: whether the circuit was opened by it
+        """
+        with self._lock:
+            self.failures += 1
+            was_open = self.opened_at is not None and not self._trial
+            if self._trial or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+            self._trial = False
+            return self.opened_at is not None and not was_open
+
+
+class BitqueryClient:
+    """Sends GraphQL queries to Bitquery over a pool of keep-alive connections. Every attempt is bounded by
+    connect and read timeouts, connection errors, timeouts and 429 and 5xx responses are retried with jittered
+    exponential backoff, and a circuit breaker stops querying an endpoint that keeps failing.
+    """
+
+    def __init__(self,
+                 api_key: str = None,
+                 url: str = BITQUERY_URL,
+                 connect_timeout: float = CONNECT_TIMEOUT,
+                 read_timeout: float = READ_TIMEOUT,
+                 retries: int = MAX_RETRIES,
+                 backoff: float = RETRY_BACKOFF,
+                 backoff_max: float = RETRY_BACKOFF_MAX,
+                 pool_size: int = POOL_SIZE,
+                 breaker: CircuitBreaker = None):
+        """
+        :param api_key: Bitquery API key, read from BITQUERY_API_KEY_FILE on the first query if not given
+        """
+        self.log = logging.getLogger('samaritan.bitqueryclient')
+        self.api_key = api_key
+        self.url = url
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.session = requests.Session()
+        # retries are done here, so they are counted and share the breaker
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.queries = 0
+        self.attempts = 0
+        self.failures = 0
+        self.rejected = 0
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def query(self, query: str) -> dict:
+        """Runs a GraphQL query.
+
+        :param query: The query
+        :return: the decoded response
+        :raise CircuitOpen: if the breaker is open
+        :raise QueryFailed: if every attempt failed, or the response holds errors and no data
+        """
+        if self.api_key is None:
+            self.api_key = read_api(BITQUERY_API_KEY_FILE)
+        if not self.breaker.allow():
+            self.rejected += 1
+            raise CircuitOpen(f'Bitquery circuit open after {self.breaker.failures} failed queries')
+        self.queries += 1
+        start = time.perf_counter()
+        succeeded = False
+        try:
+            response = self._post(query)
+            succeeded = True
+        finally:
+            # whatever was raised, the outcome is recorded, so a trial query cannot leave the breaker half-open
+            self._latencies.append(time.perf_counter() - start)
+            if succeeded:
+                self.breaker.record_success()
+            else:
+                self.failures += 1
+                if self.breaker.record_failure():
+                    self.log.warning('Opened the Bitquery circuit for %ss after %d failed queries',
+                                     self.breaker.reset_timeout, self.breaker.failures)
+        if response.get('errors') and not response.get('data'):
+            raise QueryFailed(f"Query failed: {response['errors']}")
+        return response
+
+    def _post(self, query: str) -> dict:
+        for attempt in range(self.retries + 1):
+            self.attempts += 1
+            start = time.perf_counter()
+            retry_after = None
+            try:
+                response = self.session.post(self.url, json={'query': query}, headers={'X-API-KEY': self.api_key},
+                                             timeout=self.timeout)
+                body = response.json() if response.status_code == 200 else None
+            except RETRY_ERRORS as e:
+                error = f'{type(e).__name__}: {e}'
+            except (requests.RequestException, ValueError) as e:
+                raise QueryFailed(f'Query failed with {type(e).__name__}: {e}') from e
+            else:
+                self.log.debug('Bitquery answered %s in %.0f ms, attempt %d', response.status_code,
+                               (time.perf_counter() - start) * 1000, attempt + 1)
+                if response.status_code == 200:
+                    if not isinstance(body, dict):
+                        raise QueryFailed(f'Query answered with a {type(body).__name__} instead of an object')
+                    return body
+                error = f'status {response.status_code}'
+                if response.status_code not in RETRY_STATUSES:
+                    raise QueryFailed(f'Query failed with {error}')
+                retry_after = self._retry_after(response)
+            if attempt == self.retries:
+                raise QueryFailed(f'Query failed with {error} after {attempt + 1} attempts')
+            delay = retry_after if retry_after is not None else self._backoff(attempt)
+            self.log.info('Bitquery query failed with %s, retrying in %.1fs', error, delay)
+            time.sleep(delay)
+
+    def _backoff(self, attempt: int) -> float:
+        # full jitter, so clients failing together don't retry together
+        return random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt))
+
+    def _retry_after(self, response) -> Optional[float]:
+        try:
+            return min(self.backoff_max, float(response.headers['Retry-After']))
+        except (KeyError, ValueError):
+            return None
+
+    def stats(self) -> dict:
+        """Returns query counts, p50, p99 and max latency in ms of the latest queries including their retries,
+        and the breaker state.
+        """
+        latencies = sorted(self._latencies)
+
+        def percentile(q):
+            return latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000 if latencies else None
+
+        return {
+            'queries': self.queries,
+            'attempts': self.attempts,
+            'failures': self.failures,
+            'rejected': self.rejected,
+            'p50_ms': percentile(0.50),
+            'p99_ms': percentile(0.99),
+            'max_ms': latencies[-1] * 1000 if latencies else None,
+            'breaker': self.breaker.state,
+        }
+
+    def close(self):
+        self.session.close()
@@ -1,116 +1,148 @@
-from statistics import mean
+from typing import Dict, Optional, Tuple
 
 from telegram import Update
 from telegram.ext import CallbackContext, CommandHandler
+from telegram.utils.helpers import escape_markdown
 
 from core import MARKDOWN_V2
 from core.bitquery import run_query
-from core.db import MongoConn
+from core.bitquery.queries import batch_trades_query
+from core.bitquery.snapshot import Snapshot, Quote, PRICE_TTL
+from core.bitquery.trades import TradeIngester, PRICE_WINDOW
+from core.db import Storage
 from core.samaritable import Samaritable
 from core.utils.utils import log_entexit, send_message
-from core.utils.utils_bot import format_price, format_mc
+from core.utils.utils_bot import format_price, format_mc, format_age
+
+"""Addresses of the tokens priced, by symbol. The first one is priced by /price and /mc without arguments
+"""
+TOKENS = {'SAMA': '0xb255cddf7fbaf1cbcc57d16fe2eaffffdbf5a8be'}
+
+"""Total supply of the tokens by symbol, their market cap is derived from the price. /mc answers for these only
+"""
+TOKEN_SUPPLY = {'SAMA': 1273628335437}
+
+"""Seconds a command waits for the very first price, before answering that prices are unavailable
+"""
+PRICE_WAIT = 10
+
+PRICE_UNAVAILABLE_TEXT = 'The price is unavailable right now, please try again in a minute'
 
 
 class GraphQLClient(Samaritable):
 
     def __init__(self,
-                 db: MongoConn):
+                 db: Storage,
+                 price_ttl: float = PRICE_TTL,
+                 price_window: float = PRICE_WINDOW,
+                 tokens: Dict[str, str] = None,
+                 supplies: Dict[str, float] = None):
         super().__init__(db)
-        self.sama_addr = '0xb255cddf7fbaf1cbcc57d16fe2eaffffdbf5a8be'
+        self.tokens = {symbol.upper(): address.lower() for symbol, address in (tokens or TOKENS).items()}
+        self.supplies = {symbol.upper(): supply for symbol, supply in (supplies or TOKEN_SUPPLY).items()}
+        self.primary = next(iter(self.tokens))
+        self.price_window = price_window
+        self.ingester = TradeIngester(self.q_trades, self.tokens)
+        self.trades = self.ingester.stores
+        self.price_snapshot = Snapshot(self.fetch_prices, ttl=price_ttl, name='price')
 
     @log_entexit
     def price(self, up: Update, ctx: CallbackContext):
-        price = self.fetch_price()
-        text = self.db.get_text_by_handler('price') + format_price(price)
-        send_message(up, ctx, text, parse_mode=MARKDOWN_V2)
+        symbol = ctx.args[0].upper() if ctx.args else self.primary
+        if symbol not in self.tokens:
+            send_message(up, ctx, f'Unknown token {symbol}, prices are tracked for {", ".join(self.tokens)}')
+            return
+        quote = self.get_quote(up, ctx)
+        if quote is None:
+            return
+        if symbol not in quote.value:
+            send_message(up, ctx, f'No trades of {symbol} seen yet')
+            return
+        send_message(up, ctx, self._handler_text('price', symbol) + format_price(quote.value[symbol]) +
+                     self._age_marker(quote), parse_mode=MARKDOWN_V2)
 
     @log_entexit
     def mc(self, up: Update, ctx: CallbackContext):
-        mc = self.fetch_mc()
-        send_message(up, ctx, self.db.get_text_by_handler('mc') + format_mc(mc), parse_mode=MARKDOWN_V2)
+        symbol = ctx.args[0].upper() if ctx.args else self.primary
+        if symbol not in self.tokens or symbol not in self.supplies:
+            send_message(up, ctx, f'Unknown token {symbol}, market caps are tracked for '
+                                  f'{", ".join(s for s in self.tokens if s in self.supplies)}')
+            return
+        quote = self.get_quote(up, ctx)
+        if quote is None:
+            return
+        if symbol not in quote.value:
+            send_message(up, ctx, f'No trades of {symbol} seen yet')
+            return
+        mc = quote.value[symbol] * self.supplies[symbol]
+        send_message(up, ctx, self._handler_text('mc', symbol) + format_mc(mc) + self._age_marker(quote),
+                     parse_mode=MARKDOWN_V2)
+
+    def get_quote(self, up: Update, ctx: CallbackContext) -> Optional[Quote]:
+        """Returns the latest prices to answer a command with. If no price could be fetched yet, answers that
+        prices are unavailable instead.
+
+        :param up: Incoming telegram.Update
+        :param ctx: CallbackContext for bot
+        :return: the quote, or None if the command was answered
+        """
+        try:
+            return self.price_snapshot.get(timeout=PRICE_WAIT)
+        except Exception as e:
+            self.log.warning('No price to answer with: %s', e)
+            send_message(up, ctx, PRICE_UNAVAILABLE_TEXT)
+            return None
+
+    def _handler_text(self, handler: str, symbol: str) -> str:
+        return self.db.get_text_by_handler(handler).replace('{symbol}', escape_markdown(symbol, version=2))
+
+    def _age_marker(self, quote: Quote) -> str:
+        return format_age(quote.age) if quote.stale and self.price_snapshot.failing else ''
 
     @log_entexit
-    def fetch_price(self):
-        prices = []
-        response = self.q_price()
-        for trade in self._dex_trades(response):
-            if self.is_buy(trade):
-                buy_amount = trade['buyAmount']
-                sell_amount_usd = trade['sellAmountInUsd']
-                prices.append(sell_amount_usd / buy_amount)
-            else:
-                buy_amount_usd = trade['buyAmountInUsd']
-                sell_amount = trade['sellAmount']
-                prices.append(buy_amount_usd / sell_amount)
-
-        return mean(prices)
+    def fetch_prices(self) -> Dict[str, float]:
+        """Ingests the new trades of every token, and returns the prices of those traded so far by symbol.
+
+        :raise LookupError: if the primary token has not been traded yet
+        """
+        self.ingester.ingest()
+        prices = {symbol: store.current_price(self.price_window) for symbol, store in self.trades.items() if store}
+        if self.primary not in prices:
+            raise LookupError(f'No trades of {self.primary} ingested yet')
+        return prices
+
+    def refresh_price(self, ctx: CallbackContext = None):
+        """Ingests new trades and refreshes the price snapshot in the background, so it is fresh when asked for.
+        Can be run as a repeating job.
+        """
+        self.price_snapshot.refresh()
+
+    @log_entexit
+    def fetch_price(self) -> float:
+        return self.price_snapshot.get().value[self.primary]
 
     @log_entexit
     def fetch_mc(self):
-        return self.fetch_price() * 1273628335437
+        return self.fetch_price() * self.supplies[self.primary]
 
     @log_entexit
-    def q_price(self) -> dict:
-        query = """
-            query{
-  ethereum(network: bsc) {
-    dexTrades(
-      options: {limit: 10, desc: "block.height"}
-      exchangeName: {is: "Pancake v2"}
-      baseCurrency: {is: "%s"}
-    ) {
-      transaction {
-        hash
-      }
-      smartContract {
-        address {
-          address
-        }
-        contractType
-        currency {
-          name
-        }
-      }
-      tradeIndex
-      date {
-        date
-      }
-      block {
-        height
-      }
-      buyAmount
-      buyAmountInUsd: buyAmount(in: USD)
-      buyCurrency {
-        symbol
-        address
-      }
-      sellAmount
-      sellAmountInUsd: sellAmount(in: USD)
-      sellCurrency {
-        symbol
-        address
-      }
-      sellAmountInUsd: sellAmount(in: USD)
-      tradeAmount(in: USD)
-      transaction {
-        gasValue
-        gasPrice
-        gas
-      }
-    }
-  }
-}
-        """ % self.sama_addr
-        return run_query(query)
+    def q_trades(self, requests: Dict[str, Tuple[Optional[int], int, int]]) -> Dict[str, list]:
+        """Queries the Pancake v2 trades of several tokens in one request, see TradeIngester.
+
+        :param requests: The from_height, offset and limit of each token's trades by symbol
+        :return: the trades by symbol
+        """
+        # symbols need not be valid GraphQL names
+        aliases = {f't{i}': symbol for i, symbol in enumerate(requests)}
+        query = batch_trades_query({alias: (self.tokens[symbol],) + requests[symbol]
+                                    for alias, symbol in aliases.items()})
+        trades = self._ethereum(run_query(query))
+        return {symbol: trades[alias] for alias, symbol in aliases.items()}
 
     def add_handlers(self, dp):
         dp.add_handler(CommandHandler('price', self.price))
         dp.add_handler(CommandHandler('mc', self.mc))
 
     @log_entexit
-    def is_buy(self, trade):
-        return trade['buyCurrency']['symbol'] == 'SAMA'
-
-    @log_entexit
-    def _dex_trades(self, path: dict):
-        return path['data']['ethereum']['dexTrades']
+    def _ethereum(self, path: dict):
+        return path['data']['ethereum']
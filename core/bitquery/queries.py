@@ -0,0 +1,69 @@
+from typing import Dict, Optional, Tuple
+
+"""Fields of a trade the ingester reads, nothing else is requested
+"""
+TRADE_FIELDS = """
+      tradeIndex
+      transaction {
+        hash
+      }
+      block {
+        height
+        timestamp {
+          unixtime
+        }
+      }
+      buyAmount
+      buyAmountInUsd: buyAmount(in: USD)
+      buyCurrency {
+        address
+      }
+      sellAmount
+      sellAmountInUsd: sellAmount(in: USD)"""
+
+"""Network and exchange the trades are queried on
+"""
+NETWORK = 'bsc'
+EXCHANGE = 'Pancake v2'
+
+
+def dex_trades(alias: str, address: str, from_height: Optional[int], offset: int, limit: int,
+               exchange: str = EXCHANGE) -> str:
+    """Builds an aliased dexTrades field of a token. Selects the trades from a block height on, oldest first, or
+    the latest trades, newest first, if from_height is None.
+
+    :param alias: Name the trades are returned under
+    :param address: Address of the token
+    :param from_height: Block height of the oldest trades
+    :param offset: Trades to skip, when paging
+    :param limit: Maximum number of trades
+    :param exchange: Exchange the trades were made on
+    """
+    if from_height is None:
+        options = f'desc: "block.height", limit: {limit}'
+        height = ''
+    else:
+        options = f'asc: ["block.height", "tradeIndex"], limit: {limit}, offset: {offset}'
+        height = f'\n      height: {{gteq: {from_height}}}'
+    return f"""
+    {alias}: dexTrades(
+      options: {{{options}}}
+      exchangeName: {{is: "{exchange}"}}
+      baseCurrency: {{is: "{address}"}}{height}
+    ) {{{TRADE_FIELDS}
+    }}"""
+
+
+def batch_trades_query(requests: Dict[str, Tuple[str, Optional[int], int, int]], network: str = NETWORK) -> str:
+    """Builds a single query selecting the trades of several tokens, each under its own alias.
+
+    :param requests: The address, from_height, offset and limit of each token's trades by alias
+    :param network: Network the tokens are on
+    :return: the query, its ethereum object holds the trades by alias
+    """
+    fields = ''.join(dex_trades(alias, *request) for alias, request in requests.items())
+    return f"""
+query {{
+  ethereum(network: {network}) {{{fields}
+  }}
+}}"""
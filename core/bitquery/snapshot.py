@@ -0,0 +1,127 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List, Optional
+
+"""Seconds a fetched price is served as fresh. Older prices are still served while a refresh runs
+"""
+PRICE_TTL = 30
+
+"""Seconds to wait after a failed refresh before trying again, so an unavailable API is not retried on every
+request that sees the stale price
+"""
+PRICE_ERROR_BACKOFF = 10
+
+
+class Quote:
+    """A fetched value and when it was fetched.
+    """
+
+    def __init__(self, value, fetched_at: float, ttl: float):
+        self.value = value
+        self.fetched_at = fetched_at
+        self.ttl = ttl
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.fetched_at
+
+    @property
+    def stale(self) -> bool:
+        return self.age >= self.ttl
+
+
+class Snapshot:
+    """Caches the result of an expensive fetch for everyone who asks, for ttl seconds. Concurrent refreshes are
+    collapsed into one. Once a value was fetched, it is served immediately even when stale, while a refresh runs
+    in the background, and stays served if the refresh fails. Only the very first fetch is waited for.
+    Listeners are called with every quote fetched, after it is served.
+    """
+
+    def __init__(self,
+                 fetch: Callable,
+                 ttl: float = PRICE_TTL,
+                 error_backoff: float = PRICE_ERROR_BACKOFF,
+                 name: str = 'snapshot'):
+        self.log = logging.getLogger(f'samaritan.{name}')
+        self.fetch = fetch
+        self.ttl = ttl
+        self.error_backoff = error_backoff
+        self.name = name
+        self.quote: Optional[Quote] = None
+        self.refreshes = 0
+        self.errors = 0
+        self.listeners: List[Callable[[Quote], None]] = []
+        self._failed_at = None
+        self._inflight: Optional[Future] = None
+        self._lock = threading.Lock()
+
+    def get(self, timeout: float = None) -> Quote:
+        """Returns the latest quote, refreshing it if it is stale.
+
+        :param timeout: Seconds to wait for the first fetch, if there is no quote yet
+        :return: the quote, check stale and age when serving it
+        :raise Exception: whatever the first fetch raised, if there is no quote yet
+        :raise TimeoutError: if the first fetch takes longer than timeout
+        """
+        quote = self.quote
+        if quote is not None:
+            if quote.stale:
+                self.refresh()
+            return quote
+        return self.refresh().result(timeout)
+
+    @property
+    def failing(self) -> bool:
+        """Whether the last refresh failed, and the quote is served past its ttl.
+        """
+        return self._failed_at is not None
+
+    def refresh(self) -> Future:
+        """Starts a refresh in the background, unless one is running already or the last one failed less than
+        error_backoff seconds ago.
+
+        :return: future of the refreshed quote
+        """
+        with self._lock:
+            if self._inflight is not None:
+                return self._inflight
+            if self.quote is not None and self._failed_at is not None and \
+                    time.monotonic() - self._failed_at < self.error_backoff:
+                future = Future()
+                future.set_result(self.quote)
+                return future
+            self._inflight = future = Future()
+        threading.Thread(target=self._refresh, args=(future,), name=f'{self.name}-refresh', daemon=True).start()
+        return future
+
+    def _refresh(self, future: Future):
+        try:
+            self.quote = Quote(self.fetch(), time.monotonic(), self.ttl)
+            self._failed_at = None
+            self.refreshes += 1
+            result = self.quote
+        except Exception as e:
+            self._failed_at = time.monotonic()
+            self.errors += 1
+            if self.quote is None:
+                self.log.warning('Fetching %s failed: %s', self.name, e)
+            else:
+                self.log.warning('Refreshing %s failed, serving a quote aged %.0fs: %s', self.name, self.quote.age, e)
+            result = e
+        with self._lock:
+            self._inflight = None
+        if isinstance(result, Exception) and self.quote is None:
+            future.set_exception(result)
+        else:
+            future.set_result(self.quote)
+        if not isinstance(result, Exception):
+            self._notify(result)
+
+    def _notify(self, quote: Quote):
+        for listener in self.listeners:
+            try:
+                listener(quote)
+            except Exception as e:
+                self.log.error('Notifying %s of a new %s failed: %s', listener, self.name, e, exc_info=True)
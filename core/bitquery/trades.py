@@ -0,0 +1,247 @@
+import logging
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+"""Number of trades the store holds. When it is full, the oldest half is dropped
+"""
+TRADE_CAPACITY = 50000
+
+"""Number of latest trades fetched when the store is empty
+"""
+TRADE_BACKFILL = 1000
+
+"""Number of trades fetched per query while catching up
+"""
+INGEST_PAGE = 1000
+
+"""Seconds between ingestions of new trades
+"""
+INGEST_INTERVAL = 20
+
+"""Seconds of trades the price is the volume weighted average of
+"""
+PRICE_WINDOW = 10 * 60
+
+
+class TradeStore:
+    """Trades in columns of NumPy arrays, in order of block height. Running sums of volume and USD volume make
+    the VWAP of any trailing window a binary search and two subtractions, OHLC a slice of the price column.
+    """
+
+    def __init__(self, capacity: int = TRADE_CAPACITY):
+        self.capacity = capacity
+        self.size = 0
+        self.height = np.zeros(capacity, dtype=np.int64)
+        self.time = np.zeros(capacity, dtype=np.float64)
+        self.price = np.zeros(capacity, dtype=np.float64)
+        self.volume = np.zeros(capacity, dtype=np.float64)
+        self._cum_volume = np.zeros(capacity, dtype=np.float64)
+        self._cum_usd = np.zeros(capacity, dtype=np.float64)
+        # running sums up to the first trade held, the trades before it were dropped
+        self._base_volume = 0.0
+        self._base_usd = 0.0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def last_height(self) -> Optional[int]:
+        return int(self.height[self.size - 1]) if self.size else None
+
+    @property
+    def last_price(self) -> Optional[float]:
+        return float(self.price[self.size - 1]) if self.size else None
+
+    def append(self, height: Iterable[int], timestamp: Iterable[float], price: Iterable[float],
+               volume: Iterable[float]) -> int:
+        """Appends trades newer than any held.
+
+        :param height: Block heights of the trades
+        :param timestamp: Unix times of their blocks
+        :param price: USD prices
+        :param volume: Traded amounts of the token
+        :return: the number of trades appended
+        """
+        height = np.asarray(height, dtype=np.int64)[-self.capacity:]
+        timestamp = np.asarray(timestamp, dtype=np.float64)[-self.capacity:]
+        price = np.asarray(price, dtype=np.float64)[-self.capacity:]
+        volume = np.asarray(volume, dtype=np.float64)[-self.capacity:]
+        k = len(height)
+        if not k:
+            return 0
+        with self._lock:
+            self._make_room(k)
+            start, end = self.size, self.size + k
+            self.height[start:end] = height
+            self.time[start:end] = timestamp
+            self.price[start:end] = price
+            self.volume[start:end] = volume
+            self._cum_volume[start:end] = self._cum_before(self._cum_volume, self._base_volume) + np.cumsum(volume)
+            self._cum_usd[start:end] = self._cum_before(self._cum_usd, self._base_usd) + np.cumsum(price * volume)
+            self.size = end
+        return k
+
+    def _cum_before(self, cum: np.ndarray, base: float) -> float:
+        return cum[self.size - 1] if self.size else base
+
+    def _make_room(self, k: int):
+        if self.capacity - self.size >= k:
+            return
+        # dropping at least half keeps appends amortized constant time
+        drop = min(self.size, max(k - (self.capacity - self.size), self.size // 2))
+        self._base_volume = self._cum_volume[drop - 1]
+        self._base_usd = self._cum_usd[drop - 1]
+        kept = self.size - drop
+        for column in (self.height, self.time, self.price, self.volume, self._cum_volume, self._cum_usd):
+            column[:kept] = column[drop:self.size]
+        self.size = kept
+
+    def _window_start(self, window: float, now: float = None) -> int:
+        since = (time.time() if now is None else now) - window
+        return int(np.searchsorted(self.time[:self.size], since, side='left'))
+
+    def vwap(self, window: float, now: float = None) -> Optional[float]:
+        """Returns the volume weighted average price of the trades of the last window seconds, None if there
+        were none.
+        """
+        with self._lock:
+            start = self._window_start(window, now)
+            if start == self.size:
+                return None
+            end = self.size - 1
+            volume = self._cum_volume[end] - (self._cum_volume[start - 1] if start else self._base_volume)
+            usd = self._cum_usd[end] - (self._cum_usd[start - 1] if start else self._base_usd)
+            return float(usd / volume) if volume else None
+
+    def ohlc(self, window: float, now: float = None) -> Optional[dict]:
+        """Returns open, high, low and close price, volume and number of the trades of the last window seconds,
+        None if there were none.
+        """
+        with self._lock:
+            start = self._window_start(window, now)
+            if start == self.size:
+                return None
+            prices = self.price[start:self.size]
+            return {
+                'open': float(prices[0]),
+                'high': float(prices.max()),
+                'low': float(prices.min()),
+                'close': float(prices[-1]),
+                'volume': float(self.volume[start:self.size].sum()),
+                'trades': len(prices),
+            }
+
+    def current_price(self, window: float = PRICE_WINDOW, now: float = None) -> float:
+        """Returns the VWAP of the last window seconds, or the last price if nothing was traded since.
+
+        :raise LookupError: if the store holds no trades
+        """
+        price = self.vwap(window, now)
+        if price is None:
+            price = self.last_price
+        if price is None:
+            raise LookupError('No trades ingested yet')
+        return price
+
+
+class TradeIngester:
+    """Fetches the trades of new blocks of several tokens into a TradeStore each, in one request per round.
+    An empty store is backfilled with the latest trades, afterwards the trades from the last block fetched on
+    are queried: that block may have been indexed only in part, so it is read again and the trades fetched
+    before are dropped. Tokens with more new trades than fit a page are paged through in further rounds.
+    """
+
+    def __init__(self,
+                 fetch: Callable[[Dict[str, Tuple[Optional[int], int, int]]], Dict[str, list]],
+                 tokens: Dict[str, str],
+                 page: int = INGEST_PAGE,
+                 backfill: int = TRADE_BACKFILL):
+        """
+        :param fetch: Called with the block height, offset and limit of every token queried by symbol, returns
+         their dexTrades by symbol: those from the height on in ascending order, or the latest in descending
+         order if the height is None
+        :param tokens: Addresses of the tokens priced by symbol
+        :param page: Trades per token and query while catching up
+        :param backfill: Trades fetched into an empty store
+        """
+        self.log = logging.getLogger('samaritan.tradeingester')
+        self.fetch = fetch
+        self.tokens = {symbol: address.lower() for symbol, address in tokens.items()}
+        self.stores = {symbol: TradeStore() for symbol in self.tokens}
+        self.page = page
+        self.backfill = backfill
+        self.queries = 0
+        self.trades = 0
+        # the height of the last block fetched of every token, and the trades fetched of it, whether stored or not
+        self._cursors: Dict[str, Tuple[int, Set[Tuple[str, str]]]] = {}
+        self._lock = threading.Lock()
+
+    def ingest(self) -> Dict[str, int]:
+        """Fetches and stores the trades of every token since the last ingestion.
+
+        :return: the number of trades stored by symbol
+        """
+        with self._lock:
+            added = {symbol: 0 for symbol in self.tokens}
+            requests = {}
+            for symbol in self.tokens:
+                since = self._cursors[symbol][0] if symbol in self._cursors else None
+                requests[symbol] = (since, 0, self.backfill if since is None else self.page)
+            while requests:
+                self.queries += 1
+                pages = self.fetch(requests)
+                pending = {}
+                for symbol, (since, offset, limit) in requests.items():
+                    trades = pages[symbol]
+                    # the backfill is fetched newest first
+                    unseen = self._unseen(symbol, trades[::-1] if since is None else trades)
+                    added[symbol] += self._append(symbol, unseen)
+                    if since is not None and len(trades) == limit:
+                        pending[symbol] = (since, offset + limit, limit)
+                requests = pending
+            self.trades += sum(added.values())
+        for symbol, count in added.items():
+            if count:
+                self.log.debug('Ingested %d %s trades up to block %s', count, symbol, self.stores[symbol].last_height)
+        return added
+
+    def _unseen(self, symbol: str, trades: List[dict]) -> List[dict]:
+        """Drops the trades fetched before, and moves the cursor of the token past the rest.
+
+        :param trades: Trades in ascending order of block height, none below the cursor's
+        """
+        height, seen = self._cursors.get(symbol, (None, set()))
+        unseen = []
+        for trade in trades:
+            trade_height = trade['block']['height']
+            key = (trade['transaction']['hash'], trade['tradeIndex'])
+            if trade_height == height and key in seen:
+                continue
+            if height is None or trade_height > height:
+                height, seen = trade_height, set()
+            seen.add(key)
+            unseen.append(trade)
+        if height is not None:
+            self._cursors[symbol] = (height, seen)
+        return unseen
+
+    def _append(self, symbol: str, trades: Iterable[dict]) -> int:
+        address = self.tokens[symbol]
+        height, timestamp, price, volume = [], [], [], []
+        for trade in trades:
+            if trade['buyCurrency']['address'].lower() == address:
+                amount, usd = trade['buyAmount'], trade['sellAmountInUsd']
+            else:
+                amount, usd = trade['sellAmount'], trade['buyAmountInUsd']
+            if not amount or not usd:
+                # Bitquery prices some trades at 0 USD, they would drag the average down
+                continue
+            height.append(trade['block']['height'])
+            timestamp.append(trade['block']['timestamp']['unixtime'])
+            price.append(usd / amount)
+            volume.append(amount)
+        return self.stores[symbol].append(height, timestamp, price, volume)
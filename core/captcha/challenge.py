@@ -1,12 +1,14 @@
 import random
+import time
+from functools import lru_cache
 
-from PIL import ImageDraw, ImageFont
+import numpy as np
+from PIL import ImageDraw, ImageFont, ImageColor
 from PIL import Image
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import CallbackContext
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
 from core import CAPTCHA_PREFIX, CAPTCHA_CALLBACK_PREFIX, CALLBACK_DIVIDER
-from core.utils.utils import log_curr_captchas, log_entexit, send_image, build_menu
+from core.utils.utils import build_menu, encode_image
 
 colors = ["black", "red", "blue", "green", (64, 107, 76), (0, 87, 128), (0, 3, 82)]
 fill_color = [(64, 107, 76), (0, 87, 128), (0, 3, 82), (191, 0, 255), (72, 189, 0), (189, 107, 0), (189, 41, 0)]
@@ -22,14 +24,69 @@ lines_max = int(11 * multiplier)
 points_min = int(11 * multiplier)
 points_max = int(50 * multiplier)
 
+"""Font and glyphs used for the challenge text
+"""
+font_name = "assets/fonts/SansitaSwashed-VariableFont_wght.ttf"
+font_sizes = range(int(font_size * 0.7), int(font_size * 1.2) + 1)
+glyph_chars = '0123456789+-×÷=?'
+
+"""Renderers for the noise layer
+"""
+PILLOW = 'pillow'
+NUMPY = 'numpy'
+DEFAULT_RENDERER = PILLOW
+
+"""Point colors of the numpy renderer as RGB rows
+"""
+noise_palette = np.array([ImageColor.getrgb(c) if isinstance(c, str) else c for c in colors], dtype=np.uint8)
+_rng = np.random.default_rng()
+
+
+@lru_cache(maxsize=None)
+def get_font(size: int) -> ImageFont.FreeTypeFont:
+    """Process-wide cache of the captcha font, keyed by size.
+
+    :param size: Font size
+    :return: Loaded font
+    """
+    return ImageFont.truetype(font_name, size)
+
+
+@lru_cache(maxsize=None)
+def get_glyph(char: str, size: int):
+    """Rasterizes a single character into an alpha mask once per size, so drawing the
+    challenge text becomes a series of pastes.
+
+    :param char: Character to rasterize
+    :param size: Font size
+    :return: Tuple of mask, offset of the mask from the pen position and horizontal advance
+    """
+    font = get_font(size)
+    left, top, right, bottom = font.getbbox(char)
+    mask = Image.new('L', (max(right - left, 1), max(bottom - top, 1)), 0)
+    ImageDraw.Draw(mask).text((-left, -top), char, fill=255, font=font)
+    return mask, (left, top), font.getlength(char)
+
+
+def preload_glyphs():
+    """Rasterizes every glyph the challenges can contain, in every size they can be drawn in.
+    """
+    for size in font_sizes:
+        for char in glyph_chars:
+            get_glyph(char, size)
+
 
 class Challenge:
-    def __init__(self):
+    def __init__(self, renderer: str = DEFAULT_RENDERER):
+        if renderer not in (PILLOW, NUMPY):
+            raise ValueError(f'Unknown captcha renderer: {renderer}')
+        self.renderer = renderer
         self._a = 0
         self._b = 0
         self._op = '+'
         self._ans = 0
         self._choices = []
+        self.img = None
         self.new()
 
     def __str__(self):
@@ -65,13 +122,10 @@ class Challenge:
         self._choices = choices
 
     def gen_img(self) -> Image:
-        """Generates captcha image with random lines and points using pillow.
+        """Generates captcha image with random lines and points, using the challenge's renderer for the noise.
 
         :return: captcha image
         """
-        def get_it():
-            return random.randrange(5, get_it_max_pixels[0]), random.randrange(5, get_it_max_pixels[1])
-
         # create a img object
         img = Image.new('RGB', image_pixels, color="white")
         draw = ImageDraw.Draw(img)
@@ -81,20 +135,41 @@ class Challenge:
 
         # get the text color
         text_colors = random.choice(colors)
-        font_name = "assets/fonts/SansitaSwashed-VariableFont_wght.ttf"
-        font = ImageFont.truetype(font_name, random.randint(int(font_size * 0.7), int(font_size * 1.2)))
-        draw.text((
-            random.randint(int(text_placement * 0.7), int(text_placement * 1.2)),
-            int(text_placement * 0.7), int(text_placement * 1.2)),
+        self._draw_text(
+            img,
+            draw,
+            (random.randint(int(text_placement * 0.7), int(text_placement * 1.2)), int(text_placement * 0.7)),
             captcha_str,
-            fill=text_colors,
-            font=font)
+            text_colors,
+            random.randint(font_sizes.start, font_sizes.stop - 1))
 
-        # draw random lines
+        self._draw_lines(draw)
+        if self.renderer == NUMPY:
+            return self._draw_points_numpy(img)
+        self._draw_points(draw)
+        return img
+
+    @staticmethod
+    def _get_it():
+        return random.randrange(5, get_it_max_pixels[0]), random.randrange(5, get_it_max_pixels[1])
+
+    @staticmethod
+    def _draw_lines(draw: ImageDraw):
+        """Draws random lines using pillow, shared by both renderers.
+
+        :param draw: ImageDraw of the image
+        """
         for i in range(5, random.randrange(lines_min, lines_max)):
-            draw.line((get_it(), get_it()), fill=random.choice(fill_color), width=random.randrange(1, 3))
+            draw.line((Challenge._get_it(), Challenge._get_it()), fill=random.choice(fill_color),
+                      width=random.randrange(1, 3))
+
+    @staticmethod
+    def _draw_points(draw: ImageDraw):
+        """Draws random points one group at a time using pillow.
 
-        # draw random points
+        :param draw: ImageDraw of the image
+        """
+        get_it = Challenge._get_it
         for i in range(10, random.randrange(points_min, points_max)):
             draw.point((get_it(), get_it(),
                         get_it(), get_it(),
@@ -103,37 +178,108 @@ class Challenge:
                         get_it(), get_it()),
                        fill=random.choice(colors))
 
-        return img
+    @staticmethod
+    def _draw_points_numpy(img: Image) -> Image:
+        """Draws the same amount and kind of points as the pillow renderer, but generates all coordinates and
+        colors in one batch and writes them to the pixel buffer in a single assignment.
 
-    def gen_img_markup(
-            self,
-            up: Update,
-            ctx: CallbackContext,
-            callback: str,
-    ):
-        """Returns a tuple of captcha image file_id uploaded to private channel
-         and KeyBoardMarkup based on a challenge
-
-        :param up: incoming update
-        :param ctx: context for bot
-        :param ch: Challenge to draw
-        :param callback: CallbackContext from bot
-        :return: Tuple of image and KeyboardMarkup
+        :param img: Image with the challenge text and lines
+        :return: Image with noise
+        """
+        n_points = max(random.randrange(points_min, points_max) - 10, 0)
+        # points come in groups of ten sharing a color
+        point_xy = _rng.integers((5, 5), get_it_max_pixels, size=(n_points * 10, 2))
+        point_color = _rng.integers(len(colors), size=n_points)
+
+        pixels = np.array(img)
+        pixels[point_xy[:, 1], point_xy[:, 0]] = np.repeat(noise_palette[point_color], 10, axis=0)
+        return Image.fromarray(pixels)
+
+    @staticmethod
+    def _draw_text(img: Image, draw: ImageDraw, xy, text: str, fill, size: int):
+        """Draws the challenge text by pasting cached glyph masks.
+
+        :param img: Image to draw on
+        :param draw: ImageDraw of the image
+        :param xy: Pen position of the first character
+        :param text: Text to draw
+        :param fill: Text color
+        :param size: Font size
+        """
+        x, y = xy
+        for char in text:
+            mask, (left, top), advance = get_glyph(char, size)
+            img.paste(fill, (int(x) + left, y + top), mask)
+            x += advance
+
+    def gen_img_bytes(self, executor=None) -> bytes:
+        """Generates the captcha image and encodes it as JPEG, in the given RenderExecutor if provided.
+
+        :param executor: RenderExecutor to render in, renders in the calling thread if not provided
+        :return: encoded captcha image
+        """
+        if executor:
+            return executor.render(self)
+        return encode_image(self.gen_img()).getvalue()
+
+    def render(self, executor=None) -> bytes:
+        """Renders and encodes the captcha image once, keeping the result for delivery.
+
+        :param executor: RenderExecutor to render in
+        :return: encoded captcha image
+        """
+        if self.img is None:
+            self.img = self.gen_img_bytes(executor)
+        return self.img
+
+    def gen_markup(self, callback: str) -> InlineKeyboardMarkup:
+        """Builds the answer KeyboardMarkup for the challenge.
+
+        :param callback: Callback data prefix for the buttons
+        :return: KeyboardMarkup with a button per choice and a refresh button
         """
         callback = callback.replace(CAPTCHA_PREFIX, CAPTCHA_CALLBACK_PREFIX)
-        img_file = self.gen_img()
-        img = send_image(up, ctx, chat_id=-1001330154006, img=img_file, reply=False).photo[0]
         buttons = [InlineKeyboardButton(
             text=str(c),
             callback_data=callback + CALLBACK_DIVIDER + str(c)) for c in self.choices()]
-        reply_markup = InlineKeyboardMarkup(build_menu(
+        return InlineKeyboardMarkup(build_menu(
             buttons=buttons,
             n_cols=3,
             header_buttons=[InlineKeyboardButton(
                 text='Refresh captcha',
                 callback_data=callback + CALLBACK_DIVIDER + str(-1))]
         ))
-        return img, reply_markup
+
+    def gen_signed_markup(self, signer, chat_id, user_id, attempts: int) -> InlineKeyboardMarkup:
+        """Builds the answer KeyboardMarkup with self-contained, signed callback data.
+
+        :param signer: CallbackSigner to sign the buttons with
+        :param chat_id: Public chat the captcha is for
+        :param user_id: User solving the captcha
+        :param attempts: Attempts the user has used so far
+        :return: KeyboardMarkup with a button per choice and a refresh button
+        """
+        nonce = random.getrandbits(16)
+        expiry = int(time.time() + signer.ttl)
+
+        def sign(choice):
+            return signer.sign(chat_id, user_id, attempts, choice, self.ans(), nonce, expiry)
+
+        buttons = [InlineKeyboardButton(text=str(c), callback_data=sign(c)) for c in self.choices()]
+        return InlineKeyboardMarkup(build_menu(
+            buttons=buttons,
+            n_cols=3,
+            header_buttons=[InlineKeyboardButton(text='Refresh captcha', callback_data=sign(-1))]
+        ))
+
+    def gen_img_markup(self, callback: str, executor=None):
+        """Returns a tuple of the captcha photo to send and KeyBoardMarkup based on a challenge.
+
+        :param callback: Callback data prefix for the buttons
+        :param executor: RenderExecutor to render in
+        :return: Tuple of image and KeyboardMarkup
+        """
+        return self.render(executor), self.gen_markup(callback)
 
     def qus(self):
         return self.__str__()
@@ -1,27 +1,53 @@
-from datetime import timedelta
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
 from typing import Union
 
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, InputMediaPhoto, Message
-from telegram.error import BadRequest
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, InputMediaPhoto
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import CallbackContext, CommandHandler, CallbackQueryHandler, Filters
 
-from core import MEMBER_PERMISSIONS, CALLBACK_DIVIDER, CAPTCHA_CALLBACK_PREFIX, MARKDOWN_V2
+from core import MEMBER_PERMISSIONS, CALLBACK_DIVIDER, CAPTCHA_CALLBACK_PREFIX, MARKDOWN_V2, CAPTCHA_TIMEOUT, \
+    BAN_DURATION, SIGNED_CAPTCHA_CALLBACK_PREFIX
 from core.captcha.challenge import Challenge
-from core.db import MongoConn
+from core.captcha.pool import ChallengePool
+from core.captcha.renderer import RenderExecutor, RenderFailed
+from core.captcha.sessions import SessionStore, CaptchaSession
+from core.captcha.signing import CallbackSigner, InvalidCallback
+from core.db import Storage
 from core.utils.utils import send_image, send_message, log_curr_captchas, log_entexit, fallback_user_id, \
-    gen_captcha_request_deeplink, build_menu
+    fallback_chat_id, gen_captcha_request_deeplink, build_menu
+from core.utils.timer_wheel import TimerWheel
 from core.samaritable import Samaritable
 
 MAX_ATTEMPTS = 4
+BUSY_TEXT = 'Lots of captchas are being solved right now, please try again in a few seconds ⏳'
+EXPIRED_TEXT = 'This captcha has expired.'
+
+"""Deadline actions
+"""
+KICK = 'kick'
+UNBAN = 'unban'
 
 
 class Challenger(Samaritable):
 
     def __init__(self,
-                 db: MongoConn):
+                 db: Storage,
+                 pool: ChallengePool = None,
+                 executor: RenderExecutor = None,
+                 sessions: SessionStore = None,
+                 deadlines: TimerWheel = None,
+                 signer: CallbackSigner = None,
+                 instance: str = None):
         super().__init__(db)
         self.db = db
-        self.current_captchas = {}
+        self.pool = pool
+        self.executor = executor
+        self.current_captchas = sessions if sessions else SessionStore()
+        self.deadlines = deadlines if deadlines else TimerWheel()
+        self.signer = signer
+        self.instance = instance
 
     @log_entexit
     def request_captcha(self, up: Update, ctx: CallbackContext):
@@ -34,17 +60,17 @@ class Challenger(Samaritable):
             ctx=ctx,
             text=self.captcha_text(up),
             reply_markup=reply_markup)
-        if not self.current_captchas.get(up.effective_user.id, None):
-            self.current_captchas[fallback_user_id(up)] = {
-                "pub_msg": msg,
-                "attempts": 0}
+        chat_id = fallback_chat_id(up)
+        user_id = fallback_user_id(up)
+        if not self.current_captchas.get(chat_id, user_id):
+            self.current_captchas.open(chat_id, user_id, pub_msg_id=msg.message_id)
 
     @log_curr_captchas
     @log_entexit
     def captcha_deeplink(self, up: Update, ctx: CallbackContext) -> None:
         """Entrance handle callback for captcha deeplinks. Generates new challenge,
-        presents it to the user, and saves the sent msg in current_captchas to retrieve the id
-        later when checking for answer.
+        presents it to the user, and saves the sent msg's ids and the answer in current_captchas
+        to check against later.
 
         :param up: Incoming telegram.Update
         :param ctx: CallbackContext for bot
@@ -53,40 +79,43 @@ class Challenger(Samaritable):
         payload = ctx.args[0].split(CALLBACK_DIVIDER)
         chat_id = payload[1]
         user_id = fallback_user_id(up)
-        payload_aggr = ctx.args[0] + CALLBACK_DIVIDER + str(user_id)
-        pub_msg = self._get_captcha_by_user(user_id).get('pub_msg')
-        self.log.debug('Captcha deeplink:{ chat_id: %s, user_id: %s, pub_msg_id: %s }',
+        session = self.current_captchas.get(chat_id, user_id)
+        self.log.debug('Captcha deeplink:{ chat_id: %s, user_id: %s, session: %s }',
                        str(chat_id),
                        str(user_id),
-                       str(pub_msg.message_id))
+                       session)
         if self.db.get_captcha_status(chat_id, user_id):
             send_message(up, ctx, text='You have already completed your captcha! ', reply=False)
 
-        elif not self._get_captcha_by_user(user_id).get('priv_msg'):
-            ch = Challenge()
-            img, reply_markup = ch.gen_img_markup(up, ctx, payload_aggr)
+        elif not session or not session.priv_msg_id:
+            try:
+                ch = self.new_challenge()
+                img, reply_markup = self.gen_img_markup(ch, chat_id, user_id)
+            except RenderFailed:
+                send_message(up, ctx, text=BUSY_TEXT, reply=False)
+                return
             msg = send_image(
                 up,
                 ctx,
                 img=img,
-                caption=self.extend_captcha_caption(user_id),
+                caption=self.extend_captcha_caption(session),
                 parse_mode=MARKDOWN_V2,
                 reply_markup=reply_markup,
                 reply=False)
-            self._get_captcha_by_user(user_id).update(
-                priv_msg=msg,
-                ch=ch,
+            session = self.current_captchas.open(
+                chat_id, user_id,
+                priv_chat_id=msg.chat_id,
+                priv_msg_id=msg.message_id,
+                answer=ch.ans(),
                 attempts=0)
             self.db.set_private_chat_id(chat_id, user_id, up.effective_chat.id)
             self.db.set_captcha_status(chat_id, user_id, False)
             self.kick_if_incomplete(up, ctx,
                                     chat_id=chat_id,
-                                    priv_chat_id=msg.chat_id,
+                                    priv_chat_id=session.priv_chat_id,
                                     user_id=user_id,
-                                    pub_msg=pub_msg,
-                                    priv_msg=msg)
-        else:
-            ch = self._get_captcha_by_user(user_id)['ch']
+                                    pub_msg_id=session.pub_msg_id,
+                                    priv_msg_id=session.priv_msg_id)
 
     @log_curr_captchas
     @log_entexit
@@ -99,109 +128,170 @@ class Challenger(Samaritable):
         :return: None
         """
         payload = up.callback_query.data.split(CALLBACK_DIVIDER)
+        chat_id = payload[1]
         user_id = payload[2]
         ans = payload[-1]
         self.log.debug('Captcha callback:{user_id: %s, answer: %s}', str(user_id), str(ans))
-        if int(ans) == -1:
-            self.captcha_refresh(up, ctx, payload)
-        elif int(ans) == self._get_captcha_by_user(user_id)['ch'].ans():
-            self.captcha_completed(up, ctx, payload)
-        else:
-            self.captcha_failed(up, ctx, payload)
+        session = self.current_captchas.get(chat_id, user_id)
+        if not session:
+            up.callback_query.answer(EXPIRED_TEXT)
+            return
+        try:
+            if int(ans) == -1:
+                self.captcha_refresh(up, ctx, payload, session)
+            elif int(ans) == session.answer:
+                self.captcha_completed(up, ctx, payload, session)
+            else:
+                self.captcha_failed(up, ctx, payload, session)
+        except RenderFailed:
+            up.callback_query.answer(BUSY_TEXT)
 
     @log_curr_captchas
     @log_entexit
-    def captcha_refresh(self, up: Update, ctx: CallbackContext, payload) -> None:
+    def captcha_signed_callback(self, up: Update, ctx: CallbackContext) -> None:
+        """Stateless counterpart of captcha_callback. Everything needed to judge the answer is taken from
+        the signed callback data and the message the button belongs to, so any instance can handle the click.
+
+        :param up: Incoming telegram.Update
+        :param ctx: CallbackContext from bot
+        :return: None
+        """
+        if not self.on_keyboard(up.callback_query):
+            self.log.debug('Rejected captcha callback: button is not on the current keyboard')
+            up.callback_query.answer(EXPIRED_TEXT)
+            return
+        try:
+            callback = self.signer.verify(up.callback_query.data)
+        except InvalidCallback as e:
+            self.log.debug('Rejected captcha callback: %s', e)
+            up.callback_query.answer(EXPIRED_TEXT)
+            return
+        if callback.user_id != up.effective_user.id:
+            up.callback_query.answer(EXPIRED_TEXT)
+            return
+
+        # only the public welcome message is unknown to other instances, it is cleaned up if issued locally
+        local = self.current_captchas.get(callback.chat_id, callback.user_id)
+        session = CaptchaSession(callback.chat_id, callback.user_id,
+                                 deadline=time.monotonic() + callback.expiry - time.time())
+        session.pub_msg_id = local.pub_msg_id if local else None
+        session.priv_chat_id = up.callback_query.message.chat_id
+        session.priv_msg_id = up.callback_query.message.message_id
+        session.attempts = callback.attempts
+        payload = [SIGNED_CAPTCHA_CALLBACK_PREFIX, str(callback.chat_id), str(callback.user_id), str(callback.choice)]
+        self.log.debug('Signed captcha callback:{user_id: %s, answer: %s}', callback.user_id, callback.choice)
+        try:
+            if callback.choice == -1:
+                self.captcha_refresh(up, ctx, payload, session)
+            elif callback.correct:
+                self.captcha_completed(up, ctx, payload, session)
+            else:
+                self.captcha_failed(up, ctx, payload, session)
+        except RenderFailed:
+            up.callback_query.answer(BUSY_TEXT)
+
+    @staticmethod
+    def on_keyboard(query) -> bool:
+        """Tells whether the clicked callback data is a button of the keyboard the message shows now. Signed data
+        stays valid until it expires, so a button of a keyboard replaced since could be sent again for another
+        guess, with the attempts it was signed with.
+
+        :param query: Incoming telegram.CallbackQuery
+        :return: True if the button is on the message's keyboard
+        """
+        markup = query.message.reply_markup if query.message else None
+        return bool(markup) and any(button.callback_data == query.data
+                                    for row in markup.inline_keyboard for button in row)
+
+    @log_curr_captchas
+    @log_entexit
+    def captcha_refresh(self, up: Update, ctx: CallbackContext, payload, session: CaptchaSession) -> None:
         """Handles captcha refreshes. Displays a new captcha without incrementing the
         user's attempts.
 
         :param up: Incoming telegram.Update
         :param ctx: CallbackContext from bot
         :param payload: passed on data from CallbackQuery
+        :param session: the user's captcha session
         :return: None
         """
         chat_id = payload[1]
         user_id = payload[2]
-        priv_msg = self._get_priv_msg(user_id)
-        new_ch = Challenge()
+        new_ch = self.new_challenge()
 
-        img, reply_markup = new_ch.gen_img_markup(
-            up, ctx, self.gen_captcha_callback(chat_id, user_id))
+        img, reply_markup = self.gen_img_markup(new_ch, chat_id, user_id, session.attempts)
 
-        msg = ctx.bot.edit_message_media(
-            chat_id=priv_msg.chat_id,
-            message_id=priv_msg.message_id,
+        ctx.bot.edit_message_media(
+            chat_id=session.priv_chat_id,
+            message_id=session.priv_msg_id,
             media=InputMediaPhoto(
                 media=img,
-                caption=self.extend_captcha_caption(user_id),
+                caption=self.extend_captcha_caption(session),
                 parse_mode=MARKDOWN_V2),
             reply_markup=reply_markup,
         )
-        self._get_captcha_by_user(user_id)['msg'] = msg
-        self._get_captcha_by_user(user_id)['ch'] = new_ch
+        session.answer = new_ch.ans()
 
     @log_curr_captchas
     @log_entexit
-    def captcha_failed(self, up: Update, ctx: CallbackContext, payload) -> None:
+    def captcha_failed(self, up: Update, ctx: CallbackContext, payload, session: CaptchaSession) -> None:
         """Handles incorrect captcha responses. The captcha image and KeyboardMarkup is
         replaced with a new challenge's.
 
         :param up: Incoming telegram.Update
         :param ctx: CallbackContext from bot
         :param payload: passed on data from CallbackQuery
+        :param session: the user's captcha session
         :return: None
         """
         chat_id = payload[1]
         user_id = payload[2]
-        priv_msg = self._get_priv_msg(user_id)
-        priv_chat_id = self._get_priv_msg(user_id).chat_id
-        pub_msg = self._get_public_msg(user_id)
-        new_ch = Challenge()
         self.log.debug('Captcha failed:{ chat_id: %s, user_id: %s, pub_msg_id: %s, priv_msg_id: %s}',
                        str(chat_id),
                        str(user_id),
-                       str(pub_msg.message_id),
-                       str(priv_msg.message_id))
+                       str(session.pub_msg_id),
+                       str(session.priv_msg_id))
 
-        self._get_captcha_by_user(user_id)['attempts'] += 1
-        img, reply_markup = new_ch.gen_img_markup(
-            up, ctx, self.gen_captcha_callback(chat_id, user_id))
+        attempts_left = MAX_ATTEMPTS - session.attempts - 1
+        if attempts_left > 0:
+            new_ch = self.new_challenge()
+            img, reply_markup = self.gen_img_markup(new_ch, chat_id, user_id, session.attempts + 1)
+        session.attempts += 1
 
         up.callback_query.answer(self.db.get_text_by_handler('captcha_failed'))
         try:
-            if MAX_ATTEMPTS - self._get_captcha_by_user(user_id)['attempts'] > 0:
-                msg = ctx.bot.edit_message_media(
-                    chat_id=priv_msg.chat_id,
-                    message_id=priv_msg.message_id,
+            if attempts_left > 0:
+                ctx.bot.edit_message_media(
+                    chat_id=session.priv_chat_id,
+                    message_id=session.priv_msg_id,
                     media=InputMediaPhoto(
                         media=img,
-                        caption=self.extend_captcha_caption(user_id),
+                        caption=self.extend_captcha_caption(session),
                         parse_mode=MARKDOWN_V2),
                     reply_markup=reply_markup,
                 )
-                self._get_captcha_by_user(user_id)['priv_msg'] = msg
-                self._get_captcha_by_user(user_id)['ch'] = new_ch
+                session.answer = new_ch.ans()
             else:
                 self.log.debug('Attempts drained')
-                self.kick_and_restrict(up, ctx, chat_id, user_id, pub_msg, priv_msg, priv_chat_id)(ctx)
+                self.kick_and_restrict(ctx, chat_id, user_id,
+                                       session.pub_msg_id, session.priv_msg_id, session.priv_chat_id)(ctx)
         except BadRequest as e:
             self.log.exception(e)
 
     @log_curr_captchas
     @log_entexit
-    def captcha_completed(self, up: Update, ctx: CallbackContext, payload) -> None:
+    def captcha_completed(self, up: Update, ctx: CallbackContext, payload, session: CaptchaSession) -> None:
         """Handles a correct captcha, gives user back their rights, and replaces captcha with
         informational message.
 
         :param up: Incoming telegram.Update
         :param ctx: CallbackContext from bot
         :param payload: passed on data from CallbackQuery
+        :param session: the user's captcha session
         :return: None
         """
         chat_id = payload[1]
         user_id = payload[2]
-        priv_msg = self._get_priv_msg(user_id)
-        pub_msg = self._get_public_msg(user_id)
         self.log.debug('Payload: %s', payload)
         ctx.bot.restrict_chat_member(chat_id, user_id, permissions=MEMBER_PERMISSIONS)
         ctx.bot.unban_chat_member(chat_id, user_id, only_if_banned=True)
@@ -209,14 +299,15 @@ class Challenger(Samaritable):
         try:
             ctx.bot.delete_message(
                 chat_id=up.effective_chat.id,
-                message_id=priv_msg.message_id)
-            ctx.bot.delete_message(
-                chat_id=chat_id,
-                message_id=pub_msg.message_id
-            )
+                message_id=session.priv_msg_id)
+            if session.pub_msg_id:
+                ctx.bot.delete_message(
+                    chat_id=chat_id,
+                    message_id=session.pub_msg_id
+                )
         except BadRequest:
             self.log.debug(f'Message %s not found in %s with id: %s',
-                           str(priv_msg.message_id),
+                           str(session.priv_msg_id),
                            ctx.bot.get_chat(chat_id).full_name,
                            str(chat_id))
         url = ctx.bot.get_chat(chat_id).invite_link
@@ -231,7 +322,8 @@ class Challenger(Samaritable):
             disable_web_page_preview=True,
         )
         self.db.set_captcha_status(chat_id, user_id, True)
-        self.current_captchas.pop(str(user_id), None)
+        self.current_captchas.close(chat_id, user_id)
+        self.cancel_deadline(KICK, chat_id, user_id)
 
     @log_curr_captchas
     @log_entexit
@@ -241,17 +333,18 @@ class Challenger(Samaritable):
                            chat_id: Union[str, int],
                            priv_chat_id: Union[str, int],
                            user_id: Union[str, int],
-                           priv_msg: Message,
-                           pub_msg: Message) -> None:
-        def once(ctx: CallbackContext):
-            if not self.db.get_captcha_status(chat_id, user_id):
-                for element in [chat_id, priv_chat_id, user_id, priv_chat_id, user_id, priv_msg.message_id,
-                                pub_msg.message_id]:
-                    if isinstance(element, int):
-                        str(element)
-                    self.kick_and_restrict(up, ctx, chat_id, user_id, pub_msg, priv_msg, priv_chat_id)
-
-        ctx.job_queue.run_once(callback=once, when=timedelta(seconds=120))
+                           priv_msg_id: int,
+                           pub_msg_id: int) -> None:
+        self.schedule_deadline(KICK, CAPTCHA_TIMEOUT,
+                               chat_id=int(chat_id),
+                               user_id=int(user_id),
+                               priv_chat_id=int(priv_chat_id),
+                               pub_msg_id=pub_msg_id,
+                               priv_msg_id=priv_msg_id)
+
+    def kick(self, ctx: CallbackContext, chat_id, user_id, pub_msg_id, priv_msg_id, priv_chat_id):
+        if not self.db.get_captcha_status(chat_id, user_id):
+            self.kick_and_restrict(ctx, chat_id, user_id, pub_msg_id, priv_msg_id, priv_chat_id)(ctx)
 
     @log_entexit
     def unban(self, ctx: CallbackContext, chat_id, user_id):
@@ -262,32 +355,122 @@ class Challenger(Samaritable):
         return unban_in
 
     @log_entexit
-    def kick_and_restrict(self, up, ctx: CallbackContext, chat_id, user_id, pub_msg, priv_msg, priv_chat_id,):
+    def kick_and_restrict(self, ctx: CallbackContext, chat_id, user_id, pub_msg_id, priv_msg_id, priv_chat_id,):
         def inner(ctx: CallbackContext):
             self.log.debug('Kicking %s from %s, and deleting %s from %s and %s from %s',
-                           user_id, chat_id, pub_msg.message_id, chat_id, priv_msg.message_id, priv_chat_id)
+                           user_id, chat_id, pub_msg_id, chat_id, priv_msg_id, priv_chat_id)
             ctx.bot.kick_chat_member(chat_id=chat_id, user_id=user_id)
-            ctx.bot.delete_message(chat_id=chat_id, message_id=pub_msg.message_id)
-            ctx.bot.delete_message(chat_id=priv_chat_id, message_id=priv_msg.message_id)
+            for msg_chat_id, msg_id in [(chat_id, pub_msg_id), (priv_chat_id, priv_msg_id)]:
+                try:
+                    if msg_id:
+                        ctx.bot.delete_message(chat_id=msg_chat_id, message_id=msg_id)
+                except BadRequest:
+                    self.log.debug('Message %s not found in %s', str(msg_id), str(msg_chat_id))
             self.db.remove_ref(chat_id=chat_id, user_id=user_id)
-            self.db.set_captcha_status(chat_id=chat_id, user_id=user_id, status=False)
-            ctx.job_queue.run_once(callback=self.unban(ctx, chat_id, user_id), when=timedelta(seconds=7200))
-            self.current_captchas.pop(chat_id, user_id)
-            send_message(up, ctx,
-                         chat_id=priv_chat_id,
-                         text=f'Captcha failed. \nYou have been banned from '
-                              f'{ctx.bot.get_chat(chat_id).full_name} for 2hrs.',
-                         parse_mode=MARKDOWN_V2,
-                         reply=False)
+            self.db.set_member_left(chat_id=chat_id, user_id=user_id)
+            self.cancel_deadline(KICK, chat_id, user_id)
+            self.schedule_deadline(UNBAN, BAN_DURATION, chat_id=int(chat_id), user_id=int(user_id))
+            self.current_captchas.close(chat_id, user_id)
+            ctx.bot.send_message(chat_id=priv_chat_id,
+                                 text=f'Captcha failed. \nYou have been banned from '
+                                      f'{ctx.bot.get_chat(chat_id).full_name} for 2hrs.')
         return inner
 
-    def extend_captcha_caption(self, user_id):
+    def schedule_deadline(self, action: str, delay: timedelta, **data):
+        """Schedules a kick or unban on the timer wheel, and journals it under this instance so it survives
+        restarts.
+
+        :param action: KICK or UNBAN
+        :param delay: Time until the action is due
+        :param data: Arguments of the action, must contain chat_id and user_id
+        """
+        key = self.deadline_key(action, data['chat_id'], data['user_id'])
+        self.db.set_deadline(key, action, datetime.utcnow() + delay, data, self.instance)
+        self.deadlines.schedule(key, delay, self.run_deadline, key, action, data)
+
+    def cancel_deadline(self, action: str, chat_id, user_id):
+        key = self.deadline_key(action, chat_id, user_id)
+        if self.deadlines.cancel(key):
+            self.db.remove_deadlines([key])
+
+    def run_deadline(self, ctx: CallbackContext, key: str, action: str, data: dict):
+        self._run_action(ctx, action, data)
+        self.db.remove_deadlines([key])
+
+    @log_entexit
+    def recover_deadlines(self, ctx: CallbackContext):
+        """Reloads the deadlines this instance journaled before a restart. Overdue actions are executed right
+        away and removed from the journal in one batch, the remaining ones are put back on the timer wheel.
+        The captcha statuses of the overdue kicks are read in one query per chat. Deadlines of other instances
+        sharing the database are left to them.
+
+        :param ctx: CallbackContext from the job queue
+        """
+        now = datetime.utcnow()
+        overdue = []
+        for deadline in self.db.get_deadlines(self.instance):
+            if deadline['due'] <= now:
+                overdue.append(deadline)
+            else:
+                self.deadlines.schedule(deadline['_id'], deadline['due'] - now, self.run_deadline,
+                                        deadline['_id'], deadline['action'], deadline['data'])
+        self.log.info('Recovered deadlines: { overdue: %s, pending: %s }', len(overdue), len(self.deadlines))
+        kicked = defaultdict(set)
+        for deadline in overdue:
+            if deadline['action'] == KICK:
+                kicked[int(deadline['data']['chat_id'])].add(int(deadline['data']['user_id']))
+        completed = {(chat_id, user_id) for chat_id, user_ids in kicked.items()
+                     for user_id in self.db.get_completed_captchas(chat_id, user_ids)}
+        for deadline in overdue:
+            data = deadline['data']
+            self._run_action(ctx, deadline['action'], data,
+                             completed=(int(data['chat_id']), int(data['user_id'])) in completed)
+        self.db.remove_deadlines([deadline['_id'] for deadline in overdue])
+
+    def _run_action(self, ctx: CallbackContext, action: str, data: dict, completed: bool = None):
+        """Runs a deadline's action.
+
+        :param completed: Whether the member completed their captcha, if already known, for a kick
+        """
+        try:
+            if action == KICK and completed is not None:
+                if not completed:
+                    self.kick_and_restrict(ctx, **data)(ctx)
+            elif action == KICK:
+                self.kick(ctx, **data)
+            elif action == UNBAN:
+                self.unban(ctx, **data)(ctx)
+            else:
+                self.log.warning('Unknown deadline action: %s', action)
+        except TelegramError as e:
+            self.log.exception(e)
+
+    def new_challenge(self) -> Challenge:
+        """Pops a ready challenge from the pool, or generates a new one if no pool is configured.
+
+        :return: Challenge to present to the user
+        """
+        return self.pool.pop() if self.pool else Challenge()
+
+    def gen_img_markup(self, ch: Challenge, chat_id, user_id, attempts: int = 0):
+        """Returns the photo and KeyboardMarkup for a challenge, with signed buttons if a signer is configured.
+
+        :param ch: Challenge to present
+        :param chat_id: Public chat the captcha is for
+        :param user_id: User solving the captcha
+        :param attempts: Attempts the user will have used when the challenge is shown
+        :return: Tuple of image and KeyboardMarkup
+        """
+        if self.signer:
+            return ch.render(self.executor), ch.gen_signed_markup(self.signer, chat_id, user_id, attempts)
+        return ch.gen_img_markup(self.gen_captcha_callback(str(chat_id), str(user_id)), self.executor)
+
+    def extend_captcha_caption(self, session: CaptchaSession = None):
         caption = str(self.db.get_text_by_handler('captcha_challenge'))
-        current_user = self.current_captchas.get(user_id, None)
-        if not current_user:
+        if not session:
             attempts_left = MAX_ATTEMPTS
         else:
-            attempts_left = MAX_ATTEMPTS - current_user.get('attempts', 0)
+            attempts_left = MAX_ATTEMPTS - session.attempts
         return caption + f"\n\n             \\>\\>\\> *__{attempts_left}__* *_ATTEMPTS LEFT_* \\<\\<\\<"
 
     @log_entexit
@@ -296,29 +479,22 @@ class Challenger(Samaritable):
                chat_id + CALLBACK_DIVIDER + \
                user_id
 
+    @staticmethod
+    def deadline_key(action: str, chat_id, user_id):
+        return f'{action}{CALLBACK_DIVIDER}{chat_id}{CALLBACK_DIVIDER}{user_id}'
+
     def add_handlers(self, dp):
+        self.deadlines.start(dp.job_queue)
+        dp.job_queue.run_once(self.recover_deadlines, when=0)
         dp.add_handler(CommandHandler('start',
                                       self.captcha_deeplink,
                                       Filters.regex(r'captcha_([_a-zA-Z0-9-]*)'),
                                       pass_args=True))
 
         dp.add_handler(CallbackQueryHandler(self.captcha_callback, pattern="completed_([_a-zA-Z0-9-]*)"))
-
-    @log_entexit
-    def _get_priv_msg(self, user_id: Union[str, int]) -> Message:
-        return self.current_captchas.get(int(user_id)).get('priv_msg')
-
-    @log_entexit
-    def _get_public_msg(self, user_id: Union[str, int]) -> Message:
-        return self.current_captchas.get(int(user_id)).get('pub_msg')
-
-    @log_entexit
-    def _get_captcha_by_user(self, user_id):
-        return self.current_captchas.get(int(user_id))
-
-    @log_entexit
-    def _pop_user(self, user_id):
-        self.current_captchas.pop(int(user_id))
+        if self.signer:
+            dp.add_handler(CallbackQueryHandler(self.captcha_signed_callback,
+                                                pattern=SIGNED_CAPTCHA_CALLBACK_PREFIX + "_([_a-zA-Z0-9-]*)"))
 
     @staticmethod
     def captcha_text(up: Update):
@@ -0,0 +1,114 @@
+import logging
+import threading
+from queue import Queue, Empty, Full
+
+from core.captcha.challenge import Challenge, preload_glyphs, DEFAULT_RENDERER
+from core.captcha.renderer import RenderExecutor, RenderQueueFull
+
+"""Number of ready-to-serve challenges kept in the pool
+"""
+POOL_DEPTH = 50
+
+"""Seconds between two refills
+"""
+POOL_REFILL_INTERVAL = 0.05
+
+"""Seconds to back off after a failed render
+"""
+POOL_ERROR_BACKOFF = 5.0
+
+
+class ChallengePool:
+    """Bounded pool of challenges, whose images have already been rendered and encoded.
+    A background worker keeps the pool topped up, so handlers only have to pop a challenge and send it.
+    When the pool runs dry, challenges are generated on the spot and counted as misses.
+    """
+
+    def __init__(self,
+                 depth: int = POOL_DEPTH,
+                 refill_interval: float = POOL_REFILL_INTERVAL,
+                 error_backoff: float = POOL_ERROR_BACKOFF,
+                 renderer: str = DEFAULT_RENDERER,
+                 executor: RenderExecutor = None):
+        self.log = logging.getLogger('samaritan.challengepool')
+        self.depth = depth
+        self.refill_interval = refill_interval
+        self.error_backoff = error_backoff
+        self.renderer = renderer
+        self.executor = executor
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._queue = Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._worker = None
+
+    def start(self):
+        """Starts the background refill worker, if it is not already running.
+        """
+        if self._worker and self._worker.is_alive():
+            return
+        self._stop.clear()
+        self._worker = threading.Thread(target=self._refill, name='challenge_pool', daemon=True)
+        self._worker.start()
+        self.log.info('Challenge pool started: { depth: %s, refill_interval: %s, renderer: %s }',
+                      self.depth, self.refill_interval, self.renderer)
+
+    def stop(self):
+        self._stop.set()
+
+    def pop(self) -> Challenge:
+        """Returns a ready-to-serve challenge. Falls back to generating and rendering one if the pool is empty.
+
+        :return: Challenge with a rendered image
+        """
+        try:
+            ch = self._queue.get_nowait()
+            self._count('hits')
+        except Empty:
+            self._count('misses')
+            ch = self._prepare()
+        self.log.debug('Challenge pool: %s', self.stats())
+        return ch
+
+    def stats(self) -> dict:
+        return {
+            'size': self._queue.qsize(),
+            'depth': self.depth,
+            'hits': self.hits,
+            'misses': self.misses,
+            'refills': self.refills,
+            'errors': self.errors,
+        }
+
+    def _prepare(self) -> Challenge:
+        ch = Challenge(self.renderer)
+        ch.render(self.executor)
+        return ch
+
+    def _refill(self):
+        preload_glyphs()
+        while not self._stop.is_set():
+            if self._queue.full():
+                self._stop.wait(self.refill_interval)
+                continue
+            try:
+                self._queue.put_nowait(self._prepare())
+                self._count('refills')
+            except Full:
+                pass
+            except RenderQueueFull:
+                self._count('errors')
+                self.log.debug('Challenge pool refill skipped, render queue is full')
+            except Exception as e:
+                # a render that timed out or lost its worker must not end the refills
+                self._count('errors')
+                self.log.warning('Challenge pool refill failed: %s', e)
+                self._stop.wait(self.error_backoff)
+            self._stop.wait(self.refill_interval)
+
+    def _count(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
@@ -0,0 +1,129 @@
+import logging
+import multiprocessing
+import os
+import random
+import threading
+from concurrent.futures import ProcessPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from core.captcha import challenge
+from core.captcha.challenge import Challenge, preload_glyphs
+from core.utils.utils import encode_image
+
+"""Number of rendering processes
+"""
+RENDER_WORKERS = os.cpu_count() or 1
+
+"""Maximum number of captchas queued or rendering at once, before submissions are refused
+"""
+RENDER_MAX_PENDING = 4 * RENDER_WORKERS
+
+"""Seconds a submission waits for a free slot before the queue is considered full
+"""
+RENDER_SUBMIT_TIMEOUT = 2.0
+
+"""Seconds to wait for a rendered image
+"""
+RENDER_TIMEOUT = 10.0
+
+
+class RenderFailed(Exception):
+    """Raised when a captcha could not be rendered in the pool: it timed out, its worker died or it raised.
+    """
+
+
+class RenderQueueFull(RenderFailed):
+    """Raised when the render queue stays full for longer than the submit timeout.
+    """
+
+
+def _init_worker():
+    """Reseeds the random generators, so the workers don't draw identical noise, and rasterizes the glyphs once.
+    """
+    random.seed()
+    challenge._rng = np.random.default_rng()
+    preload_glyphs()
+
+
+def render_jpeg(ch: Challenge) -> bytes:
+    """Renders and encodes a challenge. Executed inside the worker processes.
+
+    :param ch: Challenge to render
+    :return: encoded captcha image
+    """
+    return encode_image(ch.gen_img()).getvalue()
+
+
+class RenderExecutor:
+    """Renders captcha images in a pool of processes, so CPU-bound rendering neither holds the GIL
+    for the dispatcher threads nor is limited to a single core. The number of pending renders is bounded,
+    callers are pushed back with RenderQueueFull when it stays exhausted. Renders that fail raise RenderFailed,
+    a pool broken by a dead worker is replaced, so the next render gets a fresh one.
+    """
+
+    def __init__(self,
+                 workers: int = RENDER_WORKERS,
+                 max_pending: int = RENDER_MAX_PENDING,
+                 submit_timeout: float = RENDER_SUBMIT_TIMEOUT,
+                 timeout: float = RENDER_TIMEOUT):
+        self.log = logging.getLogger('samaritan.renderexecutor')
+        self.workers = workers
+        self.max_pending = max_pending
+        self.submit_timeout = submit_timeout
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._executor = self._new_executor()
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.workers,
+                                   mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_init_worker)
+
+    def submit(self, ch: Challenge) -> Future:
+        """Queues a challenge for rendering, blocking up to submit_timeout for a free slot.
+
+        :param ch: Challenge to render
+        :return: Future resolving to the encoded captcha image
+        """
+        if not self._slots.acquire(timeout=self.submit_timeout):
+            self.log.warning('Render queue full: { max_pending: %s }', self.max_pending)
+            raise RenderQueueFull(f'{self.max_pending} captchas already pending')
+        try:
+            future = self._executor.submit(render_jpeg, ch)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future
+
+    def render(self, ch: Challenge) -> bytes:
+        """Renders a challenge in the pool and waits for the result.
+
+        :param ch: Challenge to render
+        :return: encoded captcha image
+        :raise RenderFailed: if the render timed out, failed or the queue is full
+        """
+        executor = self._executor
+        try:
+            return self.submit(ch).result(self.timeout)
+        except RenderFailed:
+            raise
+        except BrokenProcessPool as e:
+            self._replace(executor)
+            raise RenderFailed('render worker died') from e
+        except Exception as e:
+            raise RenderFailed(f'render failed: {e!r}') from e
+
+    def _replace(self, broken: ProcessPoolExecutor):
+        with self._lock:
+            if self._executor is not broken:
+                return
+            self.log.warning('Render pool broken, starting a new one')
+            self._executor = self._new_executor()
+        broken.shutdown(wait=False)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
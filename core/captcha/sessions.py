@@ -0,0 +1,124 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Union
+
+from core import CAPTCHA_TIMEOUT
+
+"""Seconds a captcha session lives after it was opened or last renewed
+"""
+SESSION_TTL = CAPTCHA_TIMEOUT.total_seconds()
+
+"""Maximum number of concurrent captcha sessions, the oldest are evicted beyond this
+"""
+SESSION_MAX_SIZE = 20000
+
+
+class CaptchaSession:
+    """State of a single user's captcha in a chat. Only holds the ids needed to answer, edit and clean up.
+    """
+    __slots__ = ('chat_id', 'user_id', 'pub_msg_id', 'priv_chat_id', 'priv_msg_id', 'answer', 'attempts', 'deadline')
+
+    def __init__(self, chat_id: int, user_id: int, deadline: float):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.pub_msg_id = None
+        self.priv_chat_id = None
+        self.priv_msg_id = None
+        self.answer = None
+        self.attempts = 0
+        self.deadline = deadline
+
+    def __repr__(self):
+        return 'CaptchaSession({})'.format(', '.join(f'{k}={getattr(self, k)}' for k in self.__slots__))
+
+
+class SessionStore:
+    """Captcha sessions keyed by (chat_id, user_id). Sessions expire after a fixed ttl, tied to the captcha's
+    kick window, and the store never holds more than max_size sessions. Since every session gets the same ttl
+    and renewing moves it to the back, the store stays ordered by deadline, so expiry and eviction pop from the front.
+    """
+
+    def __init__(self,
+                 ttl: float = SESSION_TTL,
+                 max_size: int = SESSION_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.opened = 0
+        self.closed = 0
+        self.expired = 0
+        self.evicted = 0
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def open(self, chat_id: Union[str, int], user_id: Union[str, int], **fields) -> CaptchaSession:
+        """Returns the live session for the user, renewing its deadline, or opens a new one.
+
+        :param chat_id: Public chat the captcha is for
+        :param user_id: User solving the captcha
+        :param fields: Session fields to set
+        :return: the session
+        """
+        key = int(chat_id), int(user_id)
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            session = self._sessions.get(key)
+            if session:
+                self._sessions.move_to_end(key)
+            else:
+                session = CaptchaSession(*key, deadline=now + self.ttl)
+                self._sessions[key] = session
+                self.opened += 1
+            session.deadline = now + self.ttl
+            for field, value in fields.items():
+                setattr(session, field, value)
+            while len(self._sessions) > self.max_size:
+                self._sessions.popitem(last=False)
+                self.evicted += 1
+        return session
+
+    def get(self, chat_id: Union[str, int], user_id: Union[str, int]) -> Optional[CaptchaSession]:
+        """Returns the live session for the user in a chat, if any.
+        """
+        key = int(chat_id), int(user_id)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session and session.deadline <= time.monotonic():
+                del self._sessions[key]
+                self.expired += 1
+                return None
+            return session
+
+    def close(self, chat_id: Union[str, int], user_id: Union[str, int]) -> Optional[CaptchaSession]:
+        """Removes and returns the session for the user in a chat, if any.
+        """
+        with self._lock:
+            session = self._sessions.pop((int(chat_id), int(user_id)), None)
+            if session:
+                self.closed += 1
+            return session
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._sessions),
+            'max_size': self.max_size,
+            'opened': self.opened,
+            'closed': self.closed,
+            'expired': self.expired,
+            'evicted': self.evicted,
+        }
+
+    def _expire(self, now: float):
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if session.deadline > now:
+                break
+            self._sessions.popitem(last=False)
+            self.expired += 1
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __str__(self):
+        return str(self.stats())
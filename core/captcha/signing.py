@@ -0,0 +1,103 @@
+import base64
+import binascii
+import hashlib
+import hmac
+import struct
+import time
+from typing import Union
+
+from core import CAPTCHA_TIMEOUT, SIGNED_CAPTCHA_CALLBACK_PREFIX, CALLBACK_DIVIDER
+
+"""chat_id, user_id, attempts, expiry, choice, nonce
+"""
+_fields = struct.Struct('>qqBIbH')
+_ANSWER_TAG_SIZE = 6
+_SIGNATURE_SIZE = 8
+_prefix = SIGNED_CAPTCHA_CALLBACK_PREFIX + CALLBACK_DIVIDER
+
+
+class InvalidCallback(Exception):
+    """Raised for callback data that is malformed, tampered with or expired.
+    """
+
+
+class SignedCallback:
+    """Verified contents of a signed captcha button.
+    """
+    __slots__ = ('chat_id', 'user_id', 'attempts', 'expiry', 'choice', 'correct')
+
+    def __init__(self, chat_id: int, user_id: int, attempts: int, expiry: int, choice: int, correct: bool):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.attempts = attempts
+        self.expiry = expiry
+        self.choice = choice
+        self.correct = correct
+
+
+class CallbackSigner:
+    """Encodes everything needed to judge a captcha click into the button's callback_data, authenticated
+    with an HMAC, so any bot instance can validate a click without looking anything up.
+
+    Every button of a challenge carries a tag committing to the correct answer, which can only be
+    reproduced with the secret. A click is correct when the tag recomputed for the clicked choice matches.
+    The encoded data is 58 bytes, within telegram's 64 byte limit.
+    """
+
+    def __init__(self,
+                 secret: Union[str, bytes],
+                 ttl: float = CAPTCHA_TIMEOUT.total_seconds()):
+        self._key = secret.strip().encode() if isinstance(secret, str) else secret
+        self.ttl = ttl
+
+    def sign(self, chat_id, user_id, attempts: int, choice: int, answer: int, nonce: int, expiry: int = None) -> str:
+        """Builds the callback_data for a single button.
+
+        :param chat_id: Public chat the captcha is for
+        :param user_id: User solving the captcha
+        :param attempts: Attempts the user has used so far
+        :param choice: Value of the button, -1 for refresh
+        :param answer: Correct answer of the challenge
+        :param nonce: Random number shared by the buttons of one challenge
+        :param expiry: Unix time after which the button is rejected, defaults to now + ttl
+        :return: callback_data
+        """
+        expiry = expiry if expiry else int(time.time() + self.ttl)
+        fields = _fields.pack(int(chat_id), int(user_id), attempts, expiry, choice, nonce)
+        body = fields + self._answer_tag(fields, answer)
+        token = body + self._mac(b'sig', body)[:_SIGNATURE_SIZE]
+        return _prefix + base64.urlsafe_b64encode(token).rstrip(b'=').decode()
+
+    def verify(self, data: str) -> SignedCallback:
+        """Authenticates callback_data produced by sign, and judges the clicked choice.
+
+        :param data: callback_data of the clicked button
+        :return: the verified callback
+        """
+        if not data.startswith(_prefix):
+            raise InvalidCallback('Not a signed captcha callback')
+        encoded = data[len(_prefix):]
+        try:
+            token = base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4))
+        except (binascii.Error, ValueError):
+            raise InvalidCallback('Malformed callback data')
+        if len(token) != _fields.size + _ANSWER_TAG_SIZE + _SIGNATURE_SIZE:
+            raise InvalidCallback('Malformed callback data')
+
+        body, signature = token[:-_SIGNATURE_SIZE], token[-_SIGNATURE_SIZE:]
+        if not hmac.compare_digest(signature, self._mac(b'sig', body)[:_SIGNATURE_SIZE]):
+            raise InvalidCallback('Invalid signature')
+        fields, tag = body[:_fields.size], body[_fields.size:]
+        chat_id, user_id, attempts, expiry, choice, _ = _fields.unpack(fields)
+        if expiry < time.time():
+            raise InvalidCallback('Callback expired')
+        correct = choice >= 0 and hmac.compare_digest(tag, self._answer_tag(fields, choice))
+        return SignedCallback(chat_id, user_id, attempts, expiry, choice, correct)
+
+    def _answer_tag(self, fields: bytes, answer: int) -> bytes:
+        # the clicked choice is part of the fields, so it is blanked out to get the same tag for every button
+        unchosen = fields[:-3] + b'\x00' + fields[-2:]
+        return self._mac(b'ans', unchosen + struct.pack('>b', answer))[:_ANSWER_TAG_SIZE]
+
+    def _mac(self, purpose: bytes, msg: bytes) -> bytes:
+        return hmac.new(self._key, purpose + msg, hashlib.sha256).digest()
@@ -1,7 +1,7 @@
 from telegram import Update
 from telegram.ext import CallbackContext, CommandHandler
 
-from core.db import MongoConn
+from core.db import Storage
 from core.samaritable import Samaritable
 from core.utils.utils import log_entexit, fallback_chat_id, fallback_user_id, send_message
 
@@ -9,32 +9,30 @@ from core.utils.utils import log_entexit, fallback_chat_id, fallback_user_id, se
 class Contestor(Samaritable):
 
     def __init__(self,
-                 db: MongoConn):
+                 db: Storage):
         super().__init__(db)
         self.db = db
 
     @log_entexit
     def leaderboard(self, up: Update, ctx: CallbackContext):
         limit = 10
-        counter = 1
         chat_id = fallback_chat_id(up)
         user_id = fallback_user_id(up)
         msg = f'🏆 INVITE CONTEST LEADERBOARD 🏆\n\n'
-        scoreboard = sorted(self.db.get_members_pts(chat_id=chat_id), key=lambda i: i['pts'])
+        scoreboard = self.db.get_leaderboard(chat_id)
 
         try:
             if len(ctx.args) > 0:
                 limit = int(ctx.args[0])
                 if limit > 50:
                     limit = 50
-            for member in scoreboard[:limit]:
-                msg += f'{str(counter) + ".":<3} {chat_id.get_member(member["id"]).user.name:<20}' \
-                       f' with {member["pts"]} {"pts"}\n'
-                counter += 1
+            for counter, (member_id, pts) in enumerate(scoreboard.top(limit), 1):
+                msg += f'{str(counter) + ".":<3} {ctx.bot.get_chat_member(chat_id, member_id).user.name:<20}' \
+                       f' with {pts} {"pts"}\n'
 
-            caller = next((x for x in scoreboard if x['id'] == user_id.id), None)
+            caller = scoreboard.rank(user_id)
             if caller:
-                msg += f'\nYour score: {scoreboard.index(caller) + 1}. with {caller["pts"]:<3} {"pts"}'
+                msg += f'\nYour score: {caller[0]}. with {caller[1]:<3} {"pts"}'
             send_message(up, ctx, msg, disable_notification=True, reply=False)
 
         except ValueError:
@@ -2,7 +2,7 @@ from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import CallbackContext, CommandHandler, Filters
 
 from core import PRIVATE, CALLBACK_DIVIDER
-from core.db import MongoConn
+from core.db import Storage
 from core.samaritable import Samaritable
 from core.utils.utils import log_entexit, fallback_user_id, fallback_chat_id, send_message, gen_invite_request_deeplink, \
     build_menu
@@ -11,7 +11,7 @@ from core.utils.utils import log_entexit, fallback_user_id, fallback_chat_id, se
 class Inviter(Samaritable):
 
     def __init__(self,
-                 db: MongoConn):
+                 db: Storage):
         super().__init__(db)
         self.db = db
 
@@ -1,13 +1,21 @@
-import sqlite3
-from sqlite3 import Error
+from .storage import Storage, MONGO, SQLITE, MEMORY
 from .mongo_db import MongoConn
+from .sqlite_db import SqliteConn
+from .memory_db import MemoryConn
 
 
-def init_connection(path):
-    connection = None
-    try:
-        connection = sqlite3.connect(path)
-        print(f'connected successfully to {path}')
-    except Error as e:
-        print(f'Connection error: {e}')
-    return connection
+def connect(backend: str = MONGO, path: str = None, **kwargs) -> Storage:
+    """Opens the storage of a backend.
+
+    :param backend: MONGO, SQLITE or MEMORY
+    :param path: Connection string for MONGO, database file for SQLITE, unused for MEMORY
+    :param kwargs: Options of the backend, e.g. write_behind and members_layout of MongoConn
+    :return: the storage
+    """
+    if backend == MONGO:
+        return MongoConn(path, **kwargs)
+    elif backend == SQLITE:
+        return SqliteConn(path or ':memory:', **kwargs)
+    elif backend == MEMORY:
+        return MemoryConn(**kwargs)
+    raise ValueError(f'Unknown storage backend: {backend}')
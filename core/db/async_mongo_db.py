@@ -0,0 +1,280 @@
+from datetime import datetime
+from typing import List
+
+from pymongo import AsyncMongoClient, ASCENDING, DESCENDING, UpdateOne
+
+from core.db.indexes import IndexManager, REFERRAL_INDEXES
+from core.db.leaderboard import Leaderboard
+from core.db.members import member_layout, PER_CHAT
+from core.db.storage import StorageCaches, DEFAULT_HANDLERS_META_ID
+
+"""Connection pool of the async client. Coroutines waiting for a connection share the pool, so its size,
+not the number of threads, caps the queries in flight
+"""
+MAX_POOL_SIZE = 100
+MIN_POOL_SIZE = 0
+MAX_CONNECTING = 2
+
+"""Milliseconds an idle pooled connection is kept, a query waits for a free connection, and the client waits
+for a server to become available
+"""
+MAX_IDLE_TIME_MS = 60000
+WAIT_QUEUE_TIMEOUT_MS = 5000
+SERVER_SELECTION_TIMEOUT_MS = 10000
+
+
+class AsyncMongoConn(StorageCaches):
+    """MongoConn for asyncio, on pymongo's AsyncMongoClient. Offers the same methods as coroutines, so many
+    handler coroutines can wait on the database at once instead of each holding a worker thread.
+    The handler, leaderboard and invite link caches are shared with Storage, only their queries are awaited here.
+    The schema is migrated by MongoConn, open only ensures the indexes exist.
+    AsyncMongoClient needs pymongo 4.13 or later, which needs Python 3.9, so it is installed from
+    requirements-async.txt rather than with the bot.
+    """
+
+    def __init__(self,
+                 path: str = None,
+                 members_layout: str = PER_CHAT,
+                 max_pool_size: int = MAX_POOL_SIZE,
+                 min_pool_size: int = MIN_POOL_SIZE,
+                 max_connecting: int = MAX_CONNECTING,
+                 max_idle_time_ms: int = MAX_IDLE_TIME_MS,
+                 wait_queue_timeout_ms: int = WAIT_QUEUE_TIMEOUT_MS,
+                 server_selection_timeout_ms: int = SERVER_SELECTION_TIMEOUT_MS):
+        super().__init__()
+        self.members_layout = members_layout
+        self._init_conn(path, maxPoolSize=max_pool_size, minPoolSize=min_pool_size, maxConnecting=max_connecting,
+                        maxIdleTimeMS=max_idle_time_ms, waitQueueTimeoutMS=wait_queue_timeout_ms,
+                        serverSelectionTimeoutMS=server_selection_timeout_ms)
+
+    def _init_conn(self, path, **pool_options):
+        self.client = AsyncMongoClient(path, **pool_options)
+        self.main_db = self.client['main']
+        self.chat_members_coll = self.client['chats_members']
+        self.chat_settings_coll = self.client['chats_settings']
+        self.members = member_layout(self.members_layout, self.main_db, self.chat_members_coll)
+        self.handlers = self.main_db['handlers']
+        self.default_handlers = self.main_db['default_handlers']
+        self.admins = self.main_db['admins']
+        self.meta = self.main_db['meta']
+        self.deadlines = self.main_db['deadlines']
+        self.referrals = self.main_db['referrals']
+
+    async def open(self) -> 'AsyncMongoConn':
+        """Ensures the indexes of the shared collections and seeds the default handlers.
+
+        :return: the connection
+        """
+        await self.deadlines.create_index([('instance', ASCENDING), ('due', ASCENDING)])
+        await IndexManager(REFERRAL_INDEXES).ensure_async(self.referrals)
+        await self.set_default_handlers()
+        return self
+
+    async def close(self):
+        await self.client.close()
+
+    async def _chat_members(self, chat_id):
+        return await self.members.indexes.ensure_async(self.members.unindexed(chat_id))
+
+    async def _find_member(self, chat_id, user_id, query: dict = None):
+        doc = await (await self._chat_members(chat_id)).find_one({**self.members.key(chat_id, user_id),
+                                                                   **(query or {})})
+        legacy = getattr(self.members, 'legacy', None)
+        if doc is None and legacy:
+            doc = await (await legacy.indexes.ensure_async(legacy.unindexed(chat_id))).find_one(
+                {**legacy.key(chat_id, user_id), **(query or {})})
+        return doc
+
+    async def _set_member_fields(self, chat_id, user_id: int, fields: dict):
+        await (await self._chat_members(chat_id)).update_one(self.members.key(chat_id, user_id),
+                                                             {'$set': fields}, upsert=True)
+
+    # members and referrals
+
+    async def set_invite_link_by_id(self, chat_id, link, user_id):
+        await self._set_member_fields(chat_id, int(user_id), {'invite_link': link})
+        self._cache_invite_owner(link, int(user_id))
+
+    async def set_new_ref(self, chat_id, link, new_ref_user_id):
+        """Records a referral as its own edge document, and increments the inviter's reference counter.
+        """
+        edge = {'group_id': int(chat_id),
+                'inviter': await self.get_user_by_invite(chat_id, link),
+                'invite_link': link,
+                'invitee': int(new_ref_user_id),
+                'at': datetime.utcnow()}
+        await self.referrals.insert_one(edge)
+        await (await self._chat_members(chat_id)).update_one(self.members.scope(chat_id, {'invite_link': link}),
+                                                             {'$inc': {'refs_size': 1}}, upsert=True)
+        self._update_leaderboard(chat_id, edge['inviter'], 1)
+
+    async def remove_ref(self, chat_id, user_id):
+        """Deletes the latest referral of a user who left, and decrements the inviter's reference counter.
+        """
+        edge = await self.referrals.find_one_and_delete({'group_id': int(chat_id), 'invitee': int(user_id)},
+                                                        sort=[('at', DESCENDING)])
+        if edge:
+            await (await self._chat_members(chat_id)).update_one(
+                self.members.scope(chat_id, {'invite_link': edge['invite_link'], 'refs_size': {'$gt': 0}}),
+                {'$inc': {'refs_size': -1}})
+            inviter = edge['inviter']
+            if inviter is None:
+                inviter = await self.get_user_by_invite(chat_id, edge['invite_link'])
+            self._update_leaderboard(chat_id, inviter, -1)
+
+    async def get_members_pts(self, chat_id, limit: int = 0) -> List[dict]:
+        """Returns the members with references, best first, sorted by the refs_size index.
+
+        :param chat_id: Chat of the contest
+        :param limit: Number of members to return, 0 for all
+        """
+        c = (await self._chat_members(chat_id)).find(self.members.scope(chat_id, {'refs_size': {'$gt': 0}}),
+                                                     {'refs_size': 1, 'user_id': 1})
+        return [{'id': self.members.user_id(doc), 'pts': doc['refs_size']}
+                async for doc in c.sort('refs_size', DESCENDING).limit(limit)]
+
+    async def get_leaderboard(self, chat_id) -> Leaderboard:
+        """Returns the chat's contest leaderboard, see Storage.get_leaderboard.
+        """
+        board = self._cached_leaderboard(chat_id)
+        if board is None:
+            board = self._cache_leaderboard(chat_id, await self.get_members_pts(chat_id))
+        return board
+
+    async def get_user_by_invite(self, chat_id, link):
+        """Returns the user an invite link belongs to, links never change their owner so they are cached.
+        """
+        user_id = self._cached_invite_owner(link)
+        if user_id is None:
+            doc = await (await self._chat_members(chat_id)).find_one(
+                self.members.scope(chat_id, {'invite_link': link}), {'user_id': 1})
+            user_id = self.members.user_id(doc) if doc else None
+            self._cache_invite_owner(link, user_id)
+        return user_id
+
+    async def get_invite_by_user_id(self, chat_id, user_id):
+        doc = await self._find_member(chat_id, user_id)
+        return doc.get('invite_link') if doc else None
+
+    async def get_captcha_status(self, chat_id, user_id) -> bool:
+        doc = await self._find_member(chat_id, int(user_id))
+        if doc is None:
+            await self.set_captcha_status(chat_id, user_id, False)
+            return False
+        return doc.get('captcha_completed', False)
+
+    async def get_completed_captchas(self, chat_id, user_ids):
+        user_ids = {int(user_id) for user_id in user_ids}
+        members = await self._chat_members(chat_id)
+        docs = [doc async for doc in members.find(self.members.keys(chat_id, user_ids),
+                                                  {'captcha_completed': 1, 'user_id': 1})]
+        missing = user_ids - {self.members.user_id(doc) for doc in docs}
+        legacy = getattr(self.members, 'legacy', None)
+        if missing and legacy:
+            legacy_members = await legacy.indexes.ensure_async(legacy.unindexed(chat_id))
+            docs += [doc async for doc in legacy_members.find(legacy.keys(chat_id, missing), {'captcha_completed': 1})]
+        return {doc.get('user_id', doc['_id']) for doc in docs if doc.get('captcha_completed')}
+
+    async def set_captcha_status(self, chat_id, user_id, status: bool):
+        await self._set_member_fields(chat_id, int(user_id), {'captcha_completed': status})
+
+    async def set_private_chat_id(self, chat_id, user_id, priv_chat_id):
+        await self._set_member_fields(chat_id, int(user_id), {'chat_id': int(priv_chat_id)})
+
+    async def get_private_chat_id(self, chat_id, user_id):
+        doc = await self._find_member(chat_id, int(user_id), {'chat_id': {'$exists': True}})
+        return doc.get('chat_id') if doc else None
+
+    async def set_member_joined(self, chat_id, user_id):
+        await self._set_member_fields(chat_id, int(user_id), {'last_seen': datetime.utcnow(), 'left_at': None})
+
+    async def set_member_left(self, chat_id, user_id):
+        now = datetime.utcnow()
+        await self._set_member_fields(chat_id, int(user_id),
+                                      {'captcha_completed': False, 'last_seen': now, 'left_at': now})
+
+    # handlers
+
+    async def set_default_handlers(self, force: bool = False) -> bool:
+        """Seeds default_handlers in a single bulk write, see Storage.set_default_handlers.
+        """
+        handlers = self._handlers_to_seed(await self.meta.find_one({'_id': DEFAULT_HANDLERS_META_ID}) or {}, force)
+        if handlers is None:
+            return False
+        await self.default_handlers.bulk_write(
+            [UpdateOne({'_id': key}, {'$set': value}, upsert=True) for key, value in handlers.items()],
+            ordered=False)
+        await self.meta.replace_one({'_id': DEFAULT_HANDLERS_META_ID}, {'hash': self.commands_hash()}, upsert=True)
+        self.invalidate_handlers()
+        return True
+
+    async def get_text_by_handler(self, key: str):
+        return (await self.get_handler(key))['text']
+
+    async def get_handler(self, key: str) -> dict:
+        """Returns a default handler's document, read through the in-process handler cache.
+
+        :param key: _id of the handler
+        :return: the handler document
+        """
+        handler = self._cached_handler(key)
+        if handler is None:
+            handler = self._cache_handler(key, await self.default_handlers.find_one({'_id': key}))
+        return handler
+
+    async def get_handlers(self) -> List[dict]:
+        return list((await self.refresh_handlers()).values())
+
+    async def refresh_handlers(self) -> dict:
+        return self._cache_handlers(await self.default_handlers.find().to_list(None))
+
+    async def set_handler_description(self, command: str, description: str):
+        await self._upsert_handler(command, 'delay', description)
+
+    async def set_handler_enabled(self, command, on):
+        await self._upsert_handler(command, 'enabled', on)
+
+    async def set_handler_type(self, command: str, handler_type: str):
+        await self._upsert_handler(command, 'type', handler_type)
+
+    async def set_handler_delay(self, command: str, timeout_in_sec: int):
+        await self._upsert_handler(command, 'delay', timeout_in_sec)
+
+    async def set_handler_parse_mode(self, command: str, parse_mode: str):
+        await self._upsert_handler(command, 'parse_mode', parse_mode)
+
+    async def _upsert_handler(self, command: str, key: str, value):
+        await self.handlers.update_one({'_id': command}, {'$set': {key: value}}, upsert=True)
+        self.invalidate_handlers([command])
+
+    async def get_admins(self) -> List[dict]:
+        return await self.admins.find().to_list(None)
+
+    # chat settings
+
+    async def _chat_setting(self, chat_id, key: str):
+        doc = await self.chat_settings_coll[str(chat_id)].find_one({key: {'$exists': True}})
+        return doc.get(key) if doc else None
+
+    async def get_lounge_by_chat_id(self, chat_id):
+        return await self._chat_setting(chat_id, 'lounge_id')
+
+    async def get_mod_by_chat_id(self, chat_id):
+        return await self._chat_setting(chat_id, 'mod_id')
+
+    async def set_lounge_id_by_chat_id(self, chat_id, lounge_id):
+        await self.chat_settings_coll[str(chat_id)].update_one({'lounge_id': {'$exists': True}},
+                                                                {'$set': {'lounge_id': int(lounge_id)}}, upsert=True)
+
+    # captcha deadlines
+
+    async def set_deadline(self, key: str, action: str, due: datetime, data: dict, instance: str = None):
+        await self.deadlines.replace_one({'_id': key}, {'action': action, 'due': due, 'data': data,
+                                                         'instance': instance}, upsert=True)
+
+    async def get_deadlines(self, instance: str = None) -> List[dict]:
+        return await self.deadlines.find({'instance': instance}).sort('due', ASCENDING).to_list(None)
+
+    async def remove_deadlines(self, keys: List[str]):
+        if keys:
+            await self.deadlines.delete_many({'_id': {'$in': keys}})
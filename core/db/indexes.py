@@ -0,0 +1,69 @@
+import logging
+import threading
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.collection import Collection
+
+"""Indexes of every per-chat members collection, serving the invite link lookups made on joins,
+the leaderboard's scan for members with references and compaction's scan for members who left
+"""
+CHAT_MEMBERS_INDEXES = [
+    IndexModel([('invite_link', ASCENDING)], name='invite_link'),
+    IndexModel([('refs_size', ASCENDING)], name='refs_size'),
+    IndexModel([('left_at', ASCENDING)], name='left_at'),
+]
+
+"""Indexes of the referrals collection, serving the invitee lookup made on leaves
+and the referrals of an inviter
+"""
+REFERRAL_INDEXES = [
+    IndexModel([('group_id', ASCENDING), ('invitee', ASCENDING), ('at', DESCENDING)], name='group_invitee'),
+    IndexModel([('group_id', ASCENDING), ('inviter', ASCENDING)], name='group_inviter'),
+]
+
+
+class IndexManager:
+    """Ensures a set of indexes exists on collections the first time they are touched, and remembers which
+    collections it already took care of, so every later access costs a set lookup instead of a round trip.
+    """
+
+    def __init__(self, indexes=None):
+        self.log = logging.getLogger('samaritan.indexmanager')
+        self.indexes = indexes if indexes else CHAT_MEMBERS_INDEXES
+        self._ensured = set()
+        self._lock = threading.Lock()
+
+    def ensure(self, collection: Collection) -> Collection:
+        """Creates the managed indexes on a collection, unless that was done before.
+
+        :param collection: Collection to index
+        :return: the collection
+        """
+        key = collection.full_name
+        if key in self._ensured:
+            return collection
+        with self._lock:
+            if key not in self._ensured:
+                collection.create_indexes(self.indexes)
+                self._ensured.add(key)
+                self.log.debug('Ensured indexes on %s', key)
+        return collection
+
+    async def ensure_async(self, collection):
+        """Like ensure, for collections of pymongo's AsyncMongoClient. Concurrent first calls may both create
+        the indexes, which is harmless.
+        """
+        key = collection.full_name
+        if key not in self._ensured:
+            await collection.create_indexes(self.indexes)
+            self._ensured.add(key)
+            self.log.debug('Ensured indexes on %s', key)
+        return collection
+
+    def forget(self, collection: Collection):
+        """Makes the next ensure on a collection create its indexes again, e.g. after it was dropped.
+        """
+        self._ensured.discard(collection.full_name)
+
+    def __len__(self):
+        return len(self._ensured)
@@ -0,0 +1,60 @@
+import threading
+import time
+from bisect import bisect_left, insort
+from typing import Dict, List, Optional, Tuple
+
+"""Seconds a cached leaderboard is served before it is reloaded, picking up referrals counted by other instances
+"""
+LEADERBOARD_TTL = 300
+
+
+class Leaderboard:
+    """Contest scores of a chat, kept ranked as they change. Members are ordered by points, descending,
+    ties by user id, so the top k are a slice and a member's rank is a binary search.
+    """
+
+    def __init__(self, scores: Dict[int, int] = None, ttl: float = LEADERBOARD_TTL):
+        self.expires = time.monotonic() + ttl
+        self._scores = {}
+        self._ranked = []
+        self._lock = threading.Lock()
+        for user_id, pts in (scores or {}).items():
+            if pts > 0:
+                self._scores[user_id] = pts
+                self._ranked.append((-pts, user_id))
+        self._ranked.sort()
+
+    def update(self, user_id: int, delta: int):
+        """Adds delta to a member's points. Members dropping to zero points leave the leaderboard.
+        """
+        with self._lock:
+            pts = self._scores.get(user_id, 0)
+            if pts:
+                del self._ranked[bisect_left(self._ranked, (-pts, user_id))]
+            pts = max(0, pts + delta)
+            if pts:
+                self._scores[user_id] = pts
+                insort(self._ranked, (-pts, user_id))
+            else:
+                self._scores.pop(user_id, None)
+
+    def top(self, k: int) -> List[Tuple[int, int]]:
+        """Returns the k best members as (user_id, pts).
+        """
+        with self._lock:
+            return [(user_id, -pts) for pts, user_id in self._ranked[:k]]
+
+    def rank(self, user_id: int) -> Optional[Tuple[int, int]]:
+        """Returns a member's 1-based rank and points, or None if they have no points.
+        """
+        with self._lock:
+            pts = self._scores.get(user_id)
+            if not pts:
+                return None
+            return bisect_left(self._ranked, (-pts, user_id)) + 1, pts
+
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires
+
+    def __len__(self):
+        return len(self._ranked)
@@ -0,0 +1,223 @@
+import logging
+from typing import Dict, Iterable, List, Optional
+
+from pymongo import ASCENDING, IndexModel, UpdateOne
+from pymongo.collection import Collection
+from pymongo.database import Database
+
+from core.db.indexes import IndexManager, CHAT_MEMBERS_INDEXES
+
+"""Member storage layouts: a collection per chat, a single collection keyed by (group_id, user_id),
+or the single collection while members are migrated to it, falling back to the per chat collections for
+members that have not been migrated yet
+"""
+PER_CHAT = 'per_chat'
+UNIFIED = 'unified'
+MIGRATING = 'migrating'
+
+"""Indexes of the unified members collection, shared by all chats
+"""
+UNIFIED_MEMBERS_INDEXES = [
+    IndexModel([('group_id', ASCENDING), ('user_id', ASCENDING)], name='group_user', unique=True,
+               partialFilterExpression={'user_id': {'$type': 'number'}}),
+    IndexModel([('group_id', ASCENDING), ('invite_link', ASCENDING)], name='group_invite_link'),
+    IndexModel([('group_id', ASCENDING), ('refs_size', ASCENDING)], name='group_refs_size'),
+    IndexModel([('group_id', ASCENDING), ('left_at', ASCENDING)], name='group_left_at'),
+]
+
+"""Members copied per bulk write by migrate_members
+"""
+MIGRATION_BATCH = 1000
+
+log = logging.getLogger('samaritan.members')
+
+
+class PerChatMembers:
+    """Members of each chat in their own collection of the chats_members database, keyed by user id.
+    """
+
+    def __init__(self, chats_db: Database):
+        self.chats_db = chats_db
+        self.indexes = IndexManager(CHAT_MEMBERS_INDEXES)
+
+    def collection(self, chat_id) -> Collection:
+        return self.indexes.ensure(self.unindexed(chat_id))
+
+    def unindexed(self, chat_id) -> Collection:
+        return self.chats_db[str(chat_id)]
+
+    def key(self, chat_id, user_id) -> dict:
+        return {'_id': int(user_id)}
+
+    def scope(self, chat_id, query: dict) -> dict:
+        return query
+
+    def user_id(self, doc: dict):
+        return doc['_id']
+
+    def find_member(self, chat_id, user_id, query: dict = None) -> Optional[dict]:
+        return self.collection(chat_id).find_one({**self.key(chat_id, user_id), **(query or {})})
+
+    def keys(self, chat_id, user_ids: Iterable[int]) -> dict:
+        return {'_id': {'$in': list(user_ids)}}
+
+    def find_members(self, chat_id, user_ids: Iterable[int], projection: dict) -> List[dict]:
+        return list(self.collection(chat_id).find(self.keys(chat_id, user_ids), projection))
+
+    def stats(self) -> Dict[int, dict]:
+        stats = {}
+        for name in self.chats_db.list_collection_names():
+            if name.lstrip('-').isdigit():
+                for doc in self.chats_db[name].aggregate(_stats_pipeline(None)):
+                    stats[int(name)] = doc
+        return stats
+
+
+class UnifiedMembers:
+    """Members of all chats in a single collection, keyed by (group_id, user_id) with indexes shared by
+    all chats. With fallback set, members not found are looked up in the per chat layout they are
+    migrated from.
+    """
+
+    def __init__(self, main_db: Database, chats_db: Database, fallback: bool = False):
+        self.members = main_db['members']
+        self.indexes = IndexManager(UNIFIED_MEMBERS_INDEXES)
+        self.legacy = PerChatMembers(chats_db) if fallback else None
+
+    def collection(self, chat_id) -> Collection:
+        return self.indexes.ensure(self.members)
+
+    def unindexed(self, chat_id) -> Collection:
+        return self.members
+
+    def key(self, chat_id, user_id) -> dict:
+        return {'group_id': int(chat_id), 'user_id': int(user_id)}
+
+    def scope(self, chat_id, query: dict) -> dict:
+        return {'group_id': int(chat_id), **query}
+
+    def user_id(self, doc: dict):
+        return doc.get('user_id')
+
+    def find_member(self, chat_id, user_id, query: dict = None) -> Optional[dict]:
+        doc = self.collection(chat_id).find_one({**self.key(chat_id, user_id), **(query or {})})
+        if doc is None and self.legacy:
+            doc = self.legacy.find_member(chat_id, user_id, query)
+        return doc
+
+    def keys(self, chat_id, user_ids: Iterable[int]) -> dict:
+        return {'group_id': int(chat_id), 'user_id': {'$in': list(user_ids)}}
+
+    def find_members(self, chat_id, user_ids: Iterable[int], projection: dict) -> List[dict]:
+        user_ids = set(user_ids)
+        docs = list(self.collection(chat_id).find(self.keys(chat_id, user_ids), {**projection, 'user_id': 1}))
+        missing = user_ids - {doc['user_id'] for doc in docs}
+        if missing and self.legacy:
+            docs += [{**doc, 'user_id': doc['_id']} for doc in self.legacy.find_members(chat_id, missing, projection)]
+        return docs
+
+    def stats(self) -> Dict[int, dict]:
+        return {doc['_id']: doc for doc in self.members.aggregate(_stats_pipeline('$group_id'))}
+
+
+def _stats_pipeline(group_by) -> list:
+    return [{'$group': {'_id': group_by,
+                        'members': {'$sum': 1},
+                        'left': {'$sum': {'$cond': [{'$gt': ['$left_at', None]}, 1, 0]}},
+                        'size': {'$sum': {'$bsonSize': '$$ROOT'}}}},
+            {'$project': {'_id': 1, 'members': 1, 'left': 1, 'size': 1}}]
+
+
+def member_layout(layout: str, main_db: Database, chats_db: Database):
+    """Returns the member storage for a configured layout.
+    """
+    if layout == PER_CHAT:
+        return PerChatMembers(chats_db)
+    elif layout == UNIFIED:
+        return UnifiedMembers(main_db, chats_db)
+    elif layout == MIGRATING:
+        return UnifiedMembers(main_db, chats_db, fallback=True)
+    raise ValueError(f'Unknown members layout: {layout}')
+
+
+def migrate_members(main_db: Database, chats_db: Database, batch: int = MIGRATION_BATCH) -> int:
+    """Copies the per chat member collections into the unified collection, while the bot keeps running on the
+    MIGRATING layout. Values written to the unified collection since the switch win over the copied ones,
+    and reference counters are recounted from the referral edges, so the migration can be run, interrupted
+    and run again at any time. The per chat collections are left in place.
+
+    :param main_db: Database of the unified collection
+    :param chats_db: Database of the per chat collections
+    :param batch: Members copied per bulk write
+    :return: Number of members copied
+    """
+    unified = UnifiedMembers(main_db, chats_db)
+    members = unified.collection(None)
+    copied = 0
+    for name in chats_db.list_collection_names():
+        try:
+            group_id = int(name)
+        except ValueError:
+            continue
+        requests = []
+        for doc in chats_db[name].find():
+            request = _merge_member(group_id, doc)
+            if request:
+                requests.append(request)
+            if len(requests) == batch:
+                members.bulk_write(requests, ordered=False)
+                copied += len(requests)
+                requests = []
+        if requests:
+            members.bulk_write(requests, ordered=False)
+            copied += len(requests)
+        _recount_refs(members, main_db['referrals'], group_id)
+        log.info('Migrated members of %s, %s members copied so far', group_id, copied)
+    return copied
+
+
+def _recount_refs(members: Collection, referrals: Collection, group_id: int):
+    # referrals made while the link's owner was not migrated yet counted on a document without a user,
+    # and have no inviter, both are fixed up from the owner's document
+    counts = referrals.aggregate([{'$match': {'group_id': group_id}},
+                                  {'$group': {'_id': '$invite_link', 'refs_size': {'$sum': 1}}}])
+    for count in counts:
+        owner = members.find_one_and_update(
+            {'group_id': group_id, 'invite_link': count['_id'], 'user_id': {'$type': 'number'}},
+            {'$set': {'refs_size': count['refs_size']}})
+        if owner:
+            members.delete_many({'group_id': group_id, 'invite_link': count['_id'], 'user_id': None})
+            referrals.update_many({'group_id': group_id, 'invite_link': count['_id'], 'inviter': None},
+                                  {'$set': {'inviter': owner['user_id']}})
+
+
+def _merge_member(group_id: int, doc: dict) -> Optional[UpdateOne]:
+    user_id = doc.pop('_id')
+    if not isinstance(user_id, int):
+        # members upserted by an unknown invite link have no user, they are matched by their link instead
+        if not doc.get('invite_link'):
+            return None
+        key, user_id = {'group_id': group_id, 'invite_link': doc['invite_link']}, None
+    else:
+        key = {'group_id': group_id, 'user_id': user_id}
+    fields = {field: {'$ifNull': ['$' + field, {'$literal': value}]} for field, value in doc.items()}
+    fields.update(user_id={'$ifNull': ['$user_id', {'$literal': user_id}]})
+    return UpdateOne(key, [{'$set': fields}], upsert=True)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from pymongo import MongoClient
+
+    from core.utils.utils import read_api, setup_log
+
+    parser = argparse.ArgumentParser(description='Copies per chat members into the unified members collection. '
+                                                 'Run while the bot runs with the migrating members layout, '
+                                                 'then switch it to the unified layout.')
+    parser.add_argument('--db-api-path', default='mongo_api', help='file holding the MongoDB connection string')
+    parser.add_argument('--batch', type=int, default=MIGRATION_BATCH, help='members copied per bulk write')
+    args = parser.parse_args()
+    setup_log(logging.INFO)
+    client = MongoClient(read_api(args.db_api_path))
+    print(migrate_members(client['main'], client['chats_members'], args.batch), 'members copied')
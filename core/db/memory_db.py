@@ -0,0 +1,209 @@
+import copy
+import heapq
+import json
+import threading
+from collections import defaultdict
+from datetime import datetime
+from typing import List
+
+from core.db.storage import Storage
+
+
+class MemoryConn(Storage):
+    """Storage in plain dicts of the running process, for tests and benchmarks, or a bot that may forget
+    everything on restart. Every call is a dict operation, nothing is written anywhere.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.members = defaultdict(dict)
+        self.referrals = defaultdict(list)
+        self.handlers = {}
+        self.default_handlers = {}
+        self.admins = []
+        self.meta = {}
+        self.chat_settings = defaultdict(dict)
+        self.deadlines = {}
+        self.alerts = {}
+        self.invite_owners = {}
+        self._orphan_refs = defaultdict(int)
+        self._lock = threading.RLock()
+        self.set_default_handlers()
+
+    # members and referrals
+
+    def _member(self, chat_id, user_id) -> dict:
+        return self.members[int(chat_id)].setdefault(int(user_id), {'refs_size': 0})
+
+    def set_invite_link_by_id(self, chat_id, link, user_id):
+        """Sets a member's invite link. Referrals counted on the link before its owner was known are moved
+        to the owner.
+        """
+        with self._lock:
+            member = self._member(chat_id, user_id)
+            member['invite_link'] = link
+            self.invite_owners[(int(chat_id), link)] = int(user_id)
+            orphans = self._orphan_refs.pop((int(chat_id), link), 0)
+            member['refs_size'] += orphans
+        if orphans:
+            self._update_leaderboard(chat_id, int(user_id), orphans)
+
+    def get_user_by_invite(self, chat_id, link):
+        return self.invite_owners.get((int(chat_id), link))
+
+    def get_invite_by_user_id(self, chat_id, user_id):
+        return self.members[int(chat_id)].get(int(user_id), {}).get('invite_link')
+
+    def set_new_ref(self, chat_id, link, new_ref_user_id):
+        with self._lock:
+            inviter = self.get_user_by_invite(chat_id, link)
+            self.referrals[(int(chat_id), int(new_ref_user_id))].append(
+                {'inviter': inviter, 'invite_link': link, 'at': datetime.utcnow()})
+            if inviter is None:
+                self._orphan_refs[(int(chat_id), link)] += 1
+            else:
+                self._member(chat_id, inviter)['refs_size'] += 1
+        self._update_leaderboard(chat_id, inviter, 1)
+
+    def remove_ref(self, chat_id, user_id):
+        with self._lock:
+            edges = self.referrals.get((int(chat_id), int(user_id)))
+            if not edges:
+                return
+            edge = edges.pop()
+            if not edges:
+                del self.referrals[(int(chat_id), int(user_id))]
+            inviter = self.get_user_by_invite(chat_id, edge['invite_link'])
+            if inviter is None:
+                if self._orphan_refs.get((int(chat_id), edge['invite_link'])):
+                    self._orphan_refs[(int(chat_id), edge['invite_link'])] -= 1
+            else:
+                member = self._member(chat_id, inviter)
+                member['refs_size'] = max(0, member['refs_size'] - 1)
+        self._update_leaderboard(chat_id, inviter, -1)
+
+    def get_members_pts(self, chat_id, limit: int = 0):
+        with self._lock:
+            pts = [{'id': user_id, 'pts': member['refs_size']}
+                   for user_id, member in self.members[int(chat_id)].items() if member['refs_size'] > 0]
+            pts += [{'id': None, 'pts': refs_size}
+                    for (group_id, link), refs_size in self._orphan_refs.items()
+                    if group_id == int(chat_id) and refs_size > 0]
+        if limit:
+            return heapq.nlargest(limit, pts, key=lambda m: m['pts'])
+        return sorted(pts, key=lambda m: m['pts'], reverse=True)
+
+    def get_captcha_status(self, chat_id, user_id) -> bool:
+        with self._lock:
+            return self._member(chat_id, user_id).setdefault('captcha_completed', False)
+
+    def get_completed_captchas(self, chat_id, user_ids):
+        members = self.members[int(chat_id)]
+        return {int(user_id) for user_id in user_ids if members.get(int(user_id), {}).get('captcha_completed')}
+
+    def set_captcha_status(self, chat_id, user_id, status: bool):
+        with self._lock:
+            self._member(chat_id, user_id)['captcha_completed'] = status
+
+    def set_private_chat_id(self, chat_id, user_id, priv_chat_id):
+        with self._lock:
+            self._member(chat_id, user_id)['chat_id'] = int(priv_chat_id)
+
+    def get_private_chat_id(self, chat_id, user_id):
+        return self.members[int(chat_id)].get(int(user_id), {}).get('chat_id')
+
+    def set_member_joined(self, chat_id, user_id):
+        with self._lock:
+            self._member(chat_id, user_id).update(last_seen=datetime.utcnow(), left_at=None)
+
+    def set_member_left(self, chat_id, user_id):
+        now = datetime.utcnow()
+        with self._lock:
+            self._member(chat_id, user_id).update(captcha_completed=False, last_seen=now, left_at=now)
+
+    def member_stats(self):
+        """See Storage.member_stats. Sizes are those of the members serialized as JSON.
+        """
+        with self._lock:
+            return {chat_id: {'members': len(members),
+                              'left': sum(1 for member in members.values() if member.get('left_at')),
+                              'size': sum(len(json.dumps(member, default=str)) for member in members.values())}
+                    for chat_id, members in self.members.items() if members}
+
+    def _prune_members(self, chat_id, cutoff: datetime, batch: int) -> int:
+        with self._lock:
+            members = self.members[int(chat_id)]
+            stale = [user_id for user_id, member in members.items()
+                     if member.get('left_at') and member['left_at'] < cutoff and not member.get('captcha_completed')
+                     and not member['refs_size'] and not member.get('invite_link')]
+            for user_id in stale:
+                del members[user_id]
+        return len(stale)
+
+    # handlers
+
+    def _find_default_handler(self, key: str):
+        handler = self.default_handlers.get(key)
+        return copy.deepcopy(handler) if handler is not None else None
+
+    def _find_default_handlers(self):
+        return copy.deepcopy(list(self.default_handlers.values()))
+
+    def _write_default_handlers(self, handlers: dict):
+        with self._lock:
+            for key, value in handlers.items():
+                self.default_handlers.setdefault(key, {'_id': key}).update(copy.deepcopy(value))
+
+    def _upsert_handler(self, command: str, key: str, value):
+        with self._lock:
+            self.handlers.setdefault(command, {'_id': command})[key] = value
+        self.invalidate_handlers([command])
+
+    def get_meta(self, key: str) -> dict:
+        return dict(self.meta.get(key, {}))
+
+    def set_meta(self, key: str, value: dict):
+        self.meta[key] = dict(value)
+
+    def get_admins(self):
+        return list(self.admins)
+
+    # chat settings
+
+    def get_lounge_by_chat_id(self, chat_id):
+        return self.chat_settings[int(chat_id)].get('lounge_id')
+
+    def get_mod_by_chat_id(self, chat_id):
+        return self.chat_settings[int(chat_id)].get('mod_id')
+
+    def set_lounge_id_by_chat_id(self, chat_id, lounge_id):
+        self.chat_settings[int(chat_id)]['lounge_id'] = int(lounge_id)
+
+    # captcha deadlines
+
+    def set_deadline(self, key: str, action: str, due: datetime, data: dict, instance: str = None):
+        self.deadlines[key] = {'_id': key, 'action': action, 'due': due, 'data': data, 'instance': instance}
+
+    def get_deadlines(self, instance: str = None):
+        with self._lock:
+            return sorted((d for d in self.deadlines.values() if d['instance'] == instance), key=lambda d: d['due'])
+
+    def remove_deadlines(self, keys: List[str]):
+        with self._lock:
+            for key in keys:
+                self.deadlines.pop(key, None)
+
+    # price alerts
+
+    def set_alert(self, key: str, alert: dict):
+        with self._lock:
+            self.alerts[key] = dict(alert, _id=key)
+
+    def get_alerts(self):
+        with self._lock:
+            return list(self.alerts.values())
+
+    def remove_alerts(self, keys: List[str]):
+        with self._lock:
+            for key in keys:
+                self.alerts.pop(key, None)
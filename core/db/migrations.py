@@ -0,0 +1,88 @@
+import logging
+from typing import Callable, List
+
+from core.db.indexes import IndexManager, CHAT_MEMBERS_INDEXES
+
+"""_id of the meta document holding the schema version of the database
+"""
+SCHEMA_META_ID = 'schema'
+
+log = logging.getLogger('samaritan.migrations')
+
+
+class Migration:
+    """A single, numbered step of the database schema. Steps are applied in order and exactly once.
+    """
+
+    def __init__(self, version: int, description: str, apply: Callable):
+        self.version = version
+        self.description = description
+        self.apply = apply
+
+
+MIGRATIONS: List[Migration] = []
+
+
+def migration(version: int, description: str):
+    """Registers the decorated function, called with the MongoConn, as the migration to the given version.
+    """
+    def register(apply: Callable):
+        if any(m.version == version for m in MIGRATIONS):
+            raise ValueError(f'Duplicate migration version: {version}')
+        MIGRATIONS.append(Migration(version, description, apply))
+        MIGRATIONS.sort(key=lambda m: m.version)
+        return apply
+    return register
+
+
+def schema_version(db) -> int:
+    meta = db.meta.find_one({'_id': SCHEMA_META_ID})
+    return meta.get('version', 0) if meta else 0
+
+
+def migrate(db, target: int = None) -> int:
+    """Applies every pending migration up to target, recording the version after each step,
+    so an interrupted run continues where it stopped.
+
+    :param db: MongoConn to migrate
+    :param target: Version to migrate to, defaults to the latest
+    :return: the schema version after migrating
+    """
+    version = schema_version(db)
+    for m in MIGRATIONS:
+        if m.version <= version or (target is not None and m.version > target):
+            continue
+        log.info('Migrating database to version %s: %s', m.version, m.description)
+        m.apply(db)
+        db.meta.update_one({'_id': SCHEMA_META_ID}, {'$set': {'version': m.version}}, upsert=True)
+        version = m.version
+    return version
+
+
+@migration(1, 'index the existing chat members collections')
+def _index_chat_members(db):
+    indexes = IndexManager(CHAT_MEMBERS_INDEXES)
+    for name in db.chat_members_coll.list_collection_names():
+        indexes.ensure(db.chat_members_coll[name])
+
+
+@migration(2, 'move the refs arrays of members into referral edges')
+def _explode_refs(db):
+    collections = [(db.chat_members_coll[name], int(name)) for name in db.chat_members_coll.list_collection_names()
+                   if name.lstrip('-').isdigit()]
+    collections.append((db.main_db['members'], None))
+    for members, group_id in collections:
+        for doc in members.find({'refs': {'$exists': True}}):
+            inviter = doc.get('user_id') if group_id is None else doc['_id']
+            edges = [{'group_id': doc['group_id'] if group_id is None else group_id,
+                      'inviter': inviter if isinstance(inviter, int) else None,
+                      'invite_link': doc.get('invite_link'),
+                      'invitee': invitee,
+                      'at': None} for invitee in doc['refs']]
+            if edges:
+                db.referrals.insert_many(edges, ordered=False)
+            members.update_one({'_id': doc['_id']},
+                               {'$set': {'refs_size': len(doc['refs'])}, '$unset': {'refs': ''}})
+        for index in ('refs', 'group_refs'):
+            if index in members.index_information():
+                members.drop_index(index)
@@ -1,92 +1,153 @@
-from pymongo import MongoClient
+from datetime import datetime
+from typing import Dict, List
 
-from core.default_commands import commands
+from bson import ObjectId
+from pymongo import MongoClient, ASCENDING, DESCENDING, UpdateOne
 
+from core.db.indexes import IndexManager, REFERRAL_INDEXES
+from core.db.members import member_layout, PER_CHAT
+from core.db.migrations import migrate
+from core.db.storage import Storage
+from core.db.write_behind import WriteBehindQueue
 
-class MongoConn:
+
+class MongoConn(Storage):
 
     def __init__(self,
-                 path: str = None):
+                 path: str = None,
+                 write_behind: WriteBehindQueue = None,
+                 members_layout: str = PER_CHAT):
+        super().__init__()
+        self.write_behind = write_behind
+        self.members_layout = members_layout
         self._init_conn(path)
 
     def set_invite_link_by_id(self, chat_id, link, user_id):
-        self._chat_members(chat_id).update_one({'_id': user_id},
+        self._chat_members(chat_id).update_one(self.members.key(chat_id, user_id),
                                                {'$set': {'invite_link': link}}, upsert=True)
+        self._cache_invite_owner(link, int(user_id))
 
     def set_new_ref(self, chat_id, link, new_ref_user_id):
-        new_ref_user_id = int(new_ref_user_id)
-        self._chat_members(chat_id).update_one({'invite_link': link}, {'$push': {'refs': new_ref_user_id},
-                                                                       '$inc': {'refs_size': 1}}, upsert=True)
+        """Records a referral as its own edge document, and increments the inviter's reference counter.
+        """
+        edge = {'group_id': int(chat_id),
+                'inviter': self.get_user_by_invite(chat_id, link),
+                'invite_link': link,
+                'invitee': int(new_ref_user_id),
+                'at': datetime.utcnow()}
+        if self.write_behind is not None:
+            # keyed by invitee, so remove_ref flushes only when this invitee's edge is still queued
+            self.write_behind.update(self.referrals, {'_id': ObjectId()}, {'$setOnInsert': edge}, upsert=True,
+                                     key={'group_id': edge['group_id'], 'invitee': edge['invitee']})
+        else:
+            self.referrals.insert_one(edge)
+        self._update_member(chat_id, self.members.scope(chat_id, {'invite_link': link}),
+                            {'$inc': {'refs_size': 1}}, upsert=True)
+        self._update_leaderboard(chat_id, edge['inviter'], 1)
+
+    def get_members_pts(self, chat_id, limit: int = 0):
+        """Returns the members with references, best first, sorted by the refs_size index.
 
-    def get_members_pts(self, chat_id):
-        c = self._chat_members(chat_id).find({'refs_size': {'$gt': 0}})
+        :param chat_id: Chat of the contest
+        :param limit: Number of members to return, 0 for all
+        """
+        c = self._chat_members(chat_id).find(self.members.scope(chat_id, {'refs_size': {'$gt': 0}}),
+                                             {'refs_size': 1, 'user_id': 1})
         lst = []
-        for doc in c:
-            print(doc)
-            lst.append({'id': doc['_id'], 'pts': len(doc['refs'])})
+        for doc in c.sort('refs_size', DESCENDING).limit(limit):
+            lst.append({'id': self.members.user_id(doc), 'pts': doc['refs_size']})
         return lst
 
+    def get_user_by_invite(self, chat_id, link):
+        """Returns the user an invite link belongs to, links never change their owner so they are cached.
+        """
+        user_id = self._cached_invite_owner(link)
+        if user_id is None:
+            doc = self._chat_members(chat_id).find_one(self.members.scope(chat_id, {'invite_link': link}),
+                                                       {'user_id': 1})
+            user_id = self.members.user_id(doc) if doc else None
+            self._cache_invite_owner(link, user_id)
+        return user_id
+
     def get_invite_by_user_id(self, chat_id, user_id):
-        c = self._chat_members(chat_id).find_one({'_id': user_id})
+        c = self.members.find_member(chat_id, user_id)
         if c:
             c = c.get('invite_link', None)
         return c
 
     def remove_ref(self, chat_id, user_id):
-        user_id = int(user_id)
-        self._chat_members(chat_id).find_one_and_update({'refs': user_id, 'refs_size': {'$gt': 0}},
-                                                        {'$pull': {'refs': user_id},
-                                                         '$inc': {'refs_size': -1}})
-
-    def set_default_handlers(self):
-        for key, value in commands.items():
-            for inner_key, inner_val in value.items():
-                self.default_handlers.update_one({'_id': key},
-                                                 {'$set': {
-                                                     inner_key: inner_val
-                                                 }}, upsert=True)
-
-    def get_text_by_handler(self, key: str):
-        try:
-            #  text = self.handlers.find_one({'_id': key})['text']
-            text = self.default_handlers.find_one({'_id': key})['text']
-        except TypeError:
-            try:
-                text = self.default_handlers.find_one({'_id': key})['text']
-            except TypeError:
-                raise KeyError(f'key {key} does not exist in default handlers.')
+        """Deletes the latest referral of a user who left, and decrements the inviter's reference counter.
+        """
+        query = {'group_id': int(chat_id), 'invitee': int(user_id)}
+        if self.write_behind is not None and self.write_behind.has_pending(self.referrals, query):
+            # the latest referral is still waiting to be written
+            self.write_behind.flush()
+        edge = self.referrals.find_one_and_delete(query, sort=[('at', DESCENDING)])
+        if edge:
+            self._update_member(chat_id, self.members.scope(chat_id, {'invite_link': edge['invite_link'],
+                                                                      'refs_size': {'$gt': 0}}),
+                                {'$inc': {'refs_size': -1}})
+            inviter = edge['inviter']
+            if inviter is None:
+                inviter = self.get_user_by_invite(chat_id, edge['invite_link'])
+            self._update_leaderboard(chat_id, inviter, -1)
 
-        return text
+    def _find_default_handler(self, key: str):
+        return self.default_handlers.find_one({'_id': key})
 
-    def get_admins(self):
-        return self.admins.find()
+    def _find_default_handlers(self):
+        return self.default_handlers.find()
 
-    def set_handler_description(self, command: str, description: str):
-        self._upsert_handler(command, 'delay', description)
+    def _write_default_handlers(self, handlers: dict):
+        self.default_handlers.bulk_write(
+            [UpdateOne({'_id': key}, {'$set': value}, upsert=True) for key, value in handlers.items()],
+            ordered=False)
 
-    def set_handler_enabled(self, command, on):
-        self._upsert_handler(command, 'enabled', on)
+    def get_meta(self, key: str) -> dict:
+        return self.meta.find_one({'_id': key}) or {}
+
+    def set_meta(self, key: str, value: dict):
+        self.meta.replace_one({'_id': key}, value, upsert=True)
+
+    def get_admins(self):
+        return self.admins.find()
 
     def get_captcha_status(self, chat_id, user_id) -> bool:
         user_id = int(user_id)
+        if self.write_behind is not None:
+            pending, status = self.write_behind.pending_field(self._chat_members(chat_id),
+                                                              self.members.key(chat_id, user_id),
+                                                              'captcha_completed')
+            if pending:
+                return status
         try:
-            return self._chat_members(chat_id).find_one({'_id': user_id}).get('captcha_completed', False)
+            return self.members.find_member(chat_id, user_id).get('captcha_completed', False)
 
         except (KeyError, AttributeError, TypeError):
             self.set_captcha_status(user_id=user_id, chat_id=chat_id, status=False)
             return False
 
-    def set_handler_type(self, command: str, handler_type: str):
-        self._upsert_handler(command, 'type', handler_type)
-
-    def set_handler_delay(self, command: str, timeout_in_sec: int):
-        self._upsert_handler(command, 'delay', timeout_in_sec)
-
-    def set_handler_parse_mode(self, command: str, parse_mode: str):
-        self._upsert_handler(command, 'parse_mode', parse_mode)
+    def get_completed_captchas(self, chat_id, user_ids):
+        user_ids = {int(user_id) for user_id in user_ids}
+        completed = set()
+        if self.write_behind is not None:
+            for user_id in list(user_ids):
+                pending, status = self.write_behind.pending_field(self._chat_members(chat_id),
+                                                                  self.members.key(chat_id, user_id),
+                                                                  'captcha_completed')
+                if pending:
+                    user_ids.discard(user_id)
+                    if status:
+                        completed.add(user_id)
+        if user_ids:
+            completed.update(self.members.user_id(doc)
+                             for doc in self.members.find_members(chat_id, user_ids, {'captcha_completed': 1})
+                             if doc.get('captcha_completed'))
+        return completed
 
     def _upsert_handler(self, command: str, key: str, value):
-        self.handlers.update({'_id': command}, {'$set': {key: value}}, upsert=True)
+        self.handlers.update_one({'_id': command}, {'$set': {key: value}}, upsert=True)
+        self.invalidate_handlers([command])
 
     def _init_conn(self, path):
         self.client = MongoClient(path)
@@ -94,51 +155,132 @@ class MongoConn:
         self.chat_members_coll = self.client['chats_members']
         self.chat_settings_coll = self.client['chats_settings']
         self.chat_chats_admins = self.client['chats_admins']
+        self.members = member_layout(self.members_layout, self.main_db, self.chat_members_coll)
         self._init_cols()
 
     def _init_cols(self):
         self.handlers = self.main_db['handlers']
         self.default_handlers = self.main_db['default_handlers']
         self.admins = self.main_db['admins']
+        self.meta = self.main_db['meta']
+        self.deadlines = self.main_db['deadlines']
+        self.deadlines.create_index([('instance', ASCENDING), ('due', ASCENDING)])
+        self.alerts = self.main_db['alerts']
+        self.referrals = IndexManager(REFERRAL_INDEXES).ensure(self.main_db['referrals'])
         self.set_default_handlers()
+        migrate(self)
 
     def set_captcha_status(self, chat_id, user_id, status: bool):
         if isinstance(user_id, str):
             user_id = int(user_id)
-        self._chat_members(chat_id).update_one({'_id': user_id},
-                                               {'$set': {
-                                                   'captcha_completed': status
-                                               }}, upsert=True)
+        self._set_member_fields(chat_id, user_id, {'captcha_completed': status})
+
+    def _set_member_fields(self, chat_id, user_id: int, fields: dict):
+        """Upserts fields of a member, queued on the write-behind queue if there is one.
+        """
+        key = self.members.key(chat_id, user_id)
+        if self.write_behind is not None:
+            self.write_behind.set_fields(self._chat_members(chat_id), key, fields)
+        else:
+            self._chat_members(chat_id).update_one(key, {'$set': fields}, upsert=True)
+
+    def _update_member(self, chat_id, filter: dict, update: dict, upsert: bool = False):
+        """Updates the first member matching filter, queued on the write-behind queue if there is one.
+        """
+        if self.write_behind is not None:
+            self.write_behind.update(self._chat_members(chat_id), filter, update, upsert)
+        else:
+            self._chat_members(chat_id).update_one(filter, update, upsert=upsert)
 
     def _chat_members(self, chat_id):
-        return self.chat_members_coll[str(chat_id)]
+        return self.members.collection(chat_id)
 
     def _chat_settings(self, chat_id):
         return self.chat_settings_coll[str(chat_id)]
 
     def set_private_chat_id(self, chat_id, user_id, priv_chat_id):
-        self._chat_members(chat_id).update_one({'_id': int(user_id)},
-                                               {'$set': {'chat_id': int(priv_chat_id)}}, upsert=True)
+        self._set_member_fields(chat_id, int(user_id), {'chat_id': int(priv_chat_id)})
+
+    def set_member_joined(self, chat_id, user_id):
+        self._set_member_fields(chat_id, int(user_id), {'last_seen': datetime.utcnow(), 'left_at': None})
+
+    def set_member_left(self, chat_id, user_id):
+        now = datetime.utcnow()
+        self._set_member_fields(chat_id, int(user_id), {'captcha_completed': False, 'last_seen': now, 'left_at': now})
+
+    def member_stats(self) -> Dict[int, dict]:
+        return {chat_id: {'members': doc['members'], 'left': doc['left'], 'size': doc['size']}
+                for chat_id, doc in self.members.stats().items()}
+
+    def _prune_members(self, chat_id, cutoff: datetime, batch: int) -> int:
+        members = self._chat_members(chat_id)
+        query = self.members.scope(chat_id, {'left_at': {'$lt': cutoff},
+                                             'captcha_completed': {'$ne': True},
+                                             'refs_size': {'$in': [None, 0]},
+                                             'invite_link': None})
+        pruned = 0
+        while True:
+            ids = [doc['_id'] for doc in members.find(query, {'_id': 1}).limit(batch)]
+            if not ids:
+                return pruned
+            # the query is repeated, members who came back since they were found are kept
+            pruned += members.delete_many({**query, '_id': {'$in': ids}}).deleted_count
 
     def get_private_chat_id(self, chat_id, user_id):
+        if self.write_behind is not None:
+            pending, priv_chat_id = self.write_behind.pending_field(self._chat_members(chat_id),
+                                                                    self.members.key(chat_id, user_id), 'chat_id')
+            if pending:
+                return priv_chat_id
         try:
-            return self._chat_members(chat_id).find_one({
-                '_id': int(user_id),
-                'chat_id': {'$exists': True}}).get('chat_id')
+            return self.members.find_member(chat_id, user_id, {'chat_id': {'$exists': True}}).get('chat_id')
         except (KeyError, AttributeError, TypeError):
             return None
 
+    def _chat_setting(self, chat_id, key: str):
+        doc = self._chat_settings(chat_id).find_one({key: {'$exists': True}})
+        return doc.get(key) if doc else None
+
     def get_lounge_by_chat_id(self, chat_id):
-        try:
-            return self._chat_settings(chat_id).get('lounge_id')
-        except (KeyError, AttributeError, TypeError):
-            return None
+        return self._chat_setting(chat_id, 'lounge_id')
 
     def get_mod_by_chat_id(self, chat_id):
-        try:
-            return self._chat_settings(chat_id).get('mod_id')
-        except (KeyError, AttributeError, TypeError):
-            return None
+        return self._chat_setting(chat_id, 'mod_id')
+
+    def set_deadline(self, key: str, action: str, due: datetime, data: dict, instance: str = None):
+        deadline = {'action': action, 'due': due, 'data': data, 'instance': instance}
+        if self.write_behind is not None:
+            self.write_behind.set_fields(self.deadlines, {'_id': key}, deadline)
+        else:
+            self.deadlines.replace_one({'_id': key}, deadline, upsert=True)
+
+    def get_deadlines(self, instance: str = None):
+        # deadlines journaled before they were scoped have no instance, and are matched by None
+        return self.deadlines.find({'instance': instance}).sort('due', ASCENDING)
+
+    def remove_deadlines(self, keys: List[str]):
+        if not keys:
+            return
+        if self.write_behind is not None and \
+                any(self.write_behind.pending_field(self.deadlines, {'_id': key}, 'due')[0] for key in keys):
+            # a deadline still waiting to be written would come back once it is
+            self.write_behind.flush()
+        self.deadlines.delete_many({'_id': {'$in': keys}})
+
+    def set_alert(self, key: str, alert: dict):
+        self.alerts.replace_one({'_id': key}, alert, upsert=True)
+
+    def get_alerts(self):
+        return self.alerts.find()
+
+    def remove_alerts(self, keys: List[str]):
+        if keys:
+            self.alerts.delete_many({'_id': {'$in': keys}})
 
     def set_lounge_id_by_chat_id(self, chat_id, lounge_id):
-        self._chat_settings(chat_id).update_one({'lounge_id': int(lounge_id)}, upsert=True)
+        self._chat_settings(chat_id).update_one({'lounge_id': {'$exists': True}},
+                                                {'$set': {'lounge_id': int(lounge_id)}}, upsert=True)
+
+    def close(self):
+        super().close()
+        self.client.close()
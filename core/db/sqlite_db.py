@@ -0,0 +1,342 @@
+import json
+import logging
+import sqlite3
+import threading
+from datetime import datetime
+from typing import List
+
+from core.db.storage import Storage
+
+"""Tables and indexes of the SQLite backend, mirroring the unified Mongo layout: members of all chats in one
+table keyed by (group_id, user_id), and one row per referral
+"""
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS members (
+    id INTEGER PRIMARY KEY,
+    group_id INTEGER NOT NULL,
+    user_id INTEGER,
+    captcha_completed INTEGER,
+    chat_id INTEGER,
+    invite_link TEXT,
+    refs_size INTEGER NOT NULL DEFAULT 0
+);
+CREATE UNIQUE INDEX IF NOT EXISTS members_group_user ON members (group_id, user_id);
+CREATE INDEX IF NOT EXISTS members_group_invite_link ON members (group_id, invite_link);
+CREATE INDEX IF NOT EXISTS members_group_refs_size ON members (group_id, refs_size);
+CREATE TABLE IF NOT EXISTS referrals (
+    id INTEGER PRIMARY KEY,
+    group_id INTEGER NOT NULL,
+    inviter INTEGER,
+    invite_link TEXT,
+    invitee INTEGER NOT NULL,
+    at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS referrals_group_invitee ON referrals (group_id, invitee, at DESC);
+CREATE INDEX IF NOT EXISTS referrals_group_inviter ON referrals (group_id, inviter);
+CREATE TABLE IF NOT EXISTS handlers (id TEXT PRIMARY KEY, doc TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS default_handlers (id TEXT PRIMARY KEY, doc TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS admins (id INTEGER PRIMARY KEY, doc TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS meta (id TEXT PRIMARY KEY, doc TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS chat_settings (chat_id INTEGER PRIMARY KEY, lounge_id INTEGER, mod_id INTEGER);
+CREATE TABLE IF NOT EXISTS deadlines (
+    id TEXT PRIMARY KEY,
+    action TEXT NOT NULL,
+    due TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS deadlines_due ON deadlines (due);
+CREATE TABLE IF NOT EXISTS alerts (id TEXT PRIMARY KEY, doc TEXT NOT NULL);
+"""
+
+"""Changes to SCHEMA, applied in order to every database created before them and tracked in its user_version
+"""
+MIGRATIONS = [
+    """
+    ALTER TABLE members ADD COLUMN left_at TEXT;
+    ALTER TABLE members ADD COLUMN last_seen TEXT;
+    CREATE INDEX IF NOT EXISTS members_group_left_at ON members (group_id, left_at);
+    """,
+    """
+    ALTER TABLE deadlines ADD COLUMN instance TEXT;
+    CREATE INDEX IF NOT EXISTS deadlines_instance_due ON deadlines (instance, due);
+    """,
+]
+
+"""Statements prepared once per connection and kept in its statement cache, so every call only binds parameters
+"""
+STATEMENT_CACHE_SIZE = 128
+
+_SET_MEMBER_FIELD = {
+    field: f'INSERT INTO members (group_id, user_id, {field}) VALUES (?, ?, ?) '
+           f'ON CONFLICT (group_id, user_id) DO UPDATE SET {field} = excluded.{field}'
+    for field in ('captcha_completed', 'chat_id', 'invite_link')
+}
+_GET_MEMBER_FIELD = {
+    field: f'SELECT {field} FROM members WHERE group_id = ? AND user_id = ?'
+    for field in ('captcha_completed', 'chat_id', 'invite_link')
+}
+_COMPLETED_CAPTCHAS = 'SELECT user_id FROM members WHERE group_id = ? AND captcha_completed AND user_id IN ({})'
+_GET_USER_BY_INVITE = 'SELECT user_id FROM members WHERE group_id = ? AND invite_link = ? LIMIT 1'
+_INSERT_REFERRAL = 'INSERT INTO referrals (group_id, inviter, invite_link, invitee, at) VALUES (?, ?, ?, ?, ?)'
+_INC_REFS = 'UPDATE members SET refs_size = refs_size + 1 ' \
+            'WHERE id = (SELECT id FROM members WHERE group_id = ? AND invite_link = ? LIMIT 1)'
+_INSERT_REFS = 'INSERT INTO members (group_id, invite_link, refs_size) VALUES (?, ?, 1)'
+_ORPHAN_REFS = 'SELECT id, refs_size FROM members WHERE group_id = ? AND invite_link = ? AND user_id IS NULL'
+_ADD_REFS = 'UPDATE members SET refs_size = refs_size + ? WHERE group_id = ? AND user_id = ?'
+_SET_INVITER = 'UPDATE referrals SET inviter = ? WHERE group_id = ? AND invite_link = ? AND inviter IS NULL'
+_LATEST_REFERRAL = 'SELECT id, inviter, invite_link FROM referrals WHERE group_id = ? AND invitee = ? ' \
+                   'ORDER BY at DESC LIMIT 1'
+_DELETE_REFERRAL = 'DELETE FROM referrals WHERE id = ?'
+_DEC_REFS = 'UPDATE members SET refs_size = refs_size - 1 ' \
+            'WHERE id = (SELECT id FROM members WHERE group_id = ? AND invite_link = ? AND refs_size > 0 LIMIT 1)'
+_MEMBERS_PTS = 'SELECT user_id, refs_size FROM members WHERE group_id = ? AND refs_size > 0 ' \
+               'ORDER BY refs_size DESC LIMIT ?'
+_MERGE_DOC = 'INSERT INTO {} (id, doc) VALUES (?, ?) ' \
+             'ON CONFLICT (id) DO UPDATE SET doc = json_patch(doc, excluded.doc)'
+_GET_SETTING = 'SELECT {} FROM chat_settings WHERE chat_id = ?'
+_MEMBER_JOINED = 'INSERT INTO members (group_id, user_id, last_seen) VALUES (?, ?, ?) ' \
+                 'ON CONFLICT (group_id, user_id) DO UPDATE SET last_seen = excluded.last_seen, left_at = NULL'
+_MEMBER_LEFT = 'INSERT INTO members (group_id, user_id, captcha_completed, last_seen, left_at) ' \
+               'VALUES (?, ?, 0, ?, ?) ON CONFLICT (group_id, user_id) DO UPDATE SET captcha_completed = 0, ' \
+               'last_seen = excluded.last_seen, left_at = excluded.left_at'
+_MEMBER_STATS = 'SELECT group_id, COUNT(*), COUNT(left_at) FROM members GROUP BY group_id'
+_MEMBERS_SIZE = "SELECT SUM(payload) FROM dbstat WHERE name = 'members' OR name LIKE 'members\\_%' ESCAPE '\\'"
+_PRUNE_MEMBERS = 'DELETE FROM members WHERE id IN (SELECT id FROM members WHERE group_id = ? AND left_at < ? ' \
+                 'AND NOT IFNULL(captcha_completed, 0) AND refs_size = 0 AND invite_link IS NULL LIMIT ?)'
+
+
+class SqliteConn(Storage):
+    """Storage in a single SQLite file, for deployments running one instance of the bot. The database runs in
+    WAL mode, so reads never wait for a write, and is shared by all threads through one connection.
+    """
+
+    def __init__(self, path: str = ':memory:'):
+        super().__init__()
+        self.log = logging.getLogger('samaritan.sqlite')
+        self.path = path
+        self._lock = threading.RLock()
+        self._init_conn(path)
+
+    def _init_conn(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+        mode = self.conn.execute('PRAGMA journal_mode = WAL').fetchone()[0]
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+        self.conn.executescript(SCHEMA)
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        for version, script in enumerate(MIGRATIONS[version:], version + 1):
+            self.conn.executescript(f'BEGIN; {script}; PRAGMA user_version = {version}; COMMIT;')
+        self.log.debug('Opened %s in %s journal mode', path, mode)
+        self.set_default_handlers()
+
+    def _one(self, sql: str, params=()):
+        with self._lock:
+            row = self.conn.execute(sql, params).fetchone()
+        return row[0] if row else None
+
+    # members and referrals
+
+    def _set_member_field(self, chat_id, user_id, field: str, value):
+        with self._lock, self.conn:
+            self.conn.execute(_SET_MEMBER_FIELD[field], (int(chat_id), int(user_id), value))
+
+    def set_invite_link_by_id(self, chat_id, link, user_id):
+        """Sets a member's invite link. Referrals counted on the link before its owner was known are moved
+        to the owner.
+        """
+        with self._lock, self.conn:
+            orphan = self.conn.execute(_ORPHAN_REFS, (int(chat_id), link)).fetchone()
+            self.conn.execute(_SET_MEMBER_FIELD['invite_link'], (int(chat_id), int(user_id), link))
+            if orphan:
+                self.conn.execute('DELETE FROM members WHERE id = ?', (orphan[0],))
+                self.conn.execute(_ADD_REFS, (orphan[1], int(chat_id), int(user_id)))
+                self.conn.execute(_SET_INVITER, (int(user_id), int(chat_id), link))
+        self._cache_invite_owner(link, int(user_id))
+        if orphan:
+            self._update_leaderboard(chat_id, int(user_id), orphan[1])
+
+    def get_user_by_invite(self, chat_id, link):
+        """Returns the user an invite link belongs to, links never change their owner so they are cached.
+        """
+        user_id = self._cached_invite_owner(link)
+        if user_id is None:
+            user_id = self._one(_GET_USER_BY_INVITE, (int(chat_id), link))
+            self._cache_invite_owner(link, user_id)
+        return user_id
+
+    def get_invite_by_user_id(self, chat_id, user_id):
+        return self._one(_GET_MEMBER_FIELD['invite_link'], (int(chat_id), int(user_id)))
+
+    def set_new_ref(self, chat_id, link, new_ref_user_id):
+        inviter = self.get_user_by_invite(chat_id, link)
+        with self._lock, self.conn:
+            self.conn.execute(_INSERT_REFERRAL, (int(chat_id), inviter, link, int(new_ref_user_id), _timestamp()))
+            if not self.conn.execute(_INC_REFS, (int(chat_id), link)).rowcount:
+                self.conn.execute(_INSERT_REFS, (int(chat_id), link))
+        self._update_leaderboard(chat_id, inviter, 1)
+
+    def remove_ref(self, chat_id, user_id):
+        with self._lock, self.conn:
+            edge = self.conn.execute(_LATEST_REFERRAL, (int(chat_id), int(user_id))).fetchone()
+            if edge is None:
+                return
+            edge_id, inviter, link = edge
+            self.conn.execute(_DELETE_REFERRAL, (edge_id,))
+            self.conn.execute(_DEC_REFS, (int(chat_id), link))
+        if inviter is None:
+            inviter = self.get_user_by_invite(chat_id, link)
+        self._update_leaderboard(chat_id, inviter, -1)
+
+    def get_members_pts(self, chat_id, limit: int = 0):
+        with self._lock:
+            rows = self.conn.execute(_MEMBERS_PTS, (int(chat_id), limit or -1)).fetchall()
+        return [{'id': user_id, 'pts': pts} for user_id, pts in rows]
+
+    def get_captcha_status(self, chat_id, user_id) -> bool:
+        with self._lock:
+            row = self.conn.execute(_GET_MEMBER_FIELD['captcha_completed'], (int(chat_id), int(user_id))).fetchone()
+        if row is None:
+            self.set_captcha_status(chat_id, user_id, False)
+            return False
+        return bool(row[0])
+
+    def get_completed_captchas(self, chat_id, user_ids):
+        user_ids = [int(user_id) for user_id in user_ids]
+        if not user_ids:
+            return set()
+        sql = _COMPLETED_CAPTCHAS.format(', '.join('?' * len(user_ids)))
+        with self._lock:
+            return {row[0] for row in self.conn.execute(sql, [int(chat_id)] + user_ids)}
+
+    def set_captcha_status(self, chat_id, user_id, status: bool):
+        self._set_member_field(chat_id, user_id, 'captcha_completed', bool(status))
+
+    def set_private_chat_id(self, chat_id, user_id, priv_chat_id):
+        self._set_member_field(chat_id, user_id, 'chat_id', int(priv_chat_id))
+
+    def get_private_chat_id(self, chat_id, user_id):
+        return self._one(_GET_MEMBER_FIELD['chat_id'], (int(chat_id), int(user_id)))
+
+    def set_member_joined(self, chat_id, user_id):
+        with self._lock, self.conn:
+            self.conn.execute(_MEMBER_JOINED, (int(chat_id), int(user_id), _timestamp()))
+
+    def set_member_left(self, chat_id, user_id):
+        now = _timestamp()
+        with self._lock, self.conn:
+            self.conn.execute(_MEMBER_LEFT, (int(chat_id), int(user_id), now, now))
+
+    def member_stats(self):
+        """See Storage.member_stats. Sizes are the payload of the members table and its indexes, shared out
+        by the number of members of each chat, or 0 if SQLite was built without the dbstat table.
+        """
+        with self._lock:
+            rows = self.conn.execute(_MEMBER_STATS).fetchall()
+            try:
+                size = self.conn.execute(_MEMBERS_SIZE).fetchone()[0] or 0
+            except sqlite3.OperationalError:
+                size = 0
+        total = sum(members for _, members, _ in rows) or 1
+        return {group_id: {'members': members, 'left': left, 'size': size * members // total}
+                for group_id, members, left in rows}
+
+    def _prune_members(self, chat_id, cutoff: datetime, batch: int) -> int:
+        pruned = 0
+        while True:
+            with self._lock, self.conn:
+                deleted = self.conn.execute(_PRUNE_MEMBERS, (int(chat_id), _timestamp(cutoff), batch)).rowcount
+            pruned += deleted
+            if deleted < batch:
+                return pruned
+
+    # handlers
+
+    def _find_default_handler(self, key: str):
+        doc = self._one('SELECT doc FROM default_handlers WHERE id = ?', (key,))
+        return {'_id': key, **json.loads(doc)} if doc else None
+
+    def _find_default_handlers(self):
+        with self._lock:
+            rows = self.conn.execute('SELECT id, doc FROM default_handlers').fetchall()
+        return [{'_id': key, **json.loads(doc)} for key, doc in rows]
+
+    def _write_default_handlers(self, handlers: dict):
+        with self._lock, self.conn:
+            self.conn.executemany(_MERGE_DOC.format('default_handlers'),
+                                  [(key, json.dumps(value, default=str)) for key, value in handlers.items()])
+
+    def _upsert_handler(self, command: str, key: str, value):
+        with self._lock, self.conn:
+            self.conn.execute(_MERGE_DOC.format('handlers'), (command, json.dumps({key: value})))
+        self.invalidate_handlers([command])
+
+    def get_meta(self, key: str) -> dict:
+        doc = self._one('SELECT doc FROM meta WHERE id = ?', (key,))
+        return json.loads(doc) if doc else {}
+
+    def set_meta(self, key: str, value: dict):
+        with self._lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO meta (id, doc) VALUES (?, ?)', (key, json.dumps(value)))
+
+    def get_admins(self):
+        with self._lock:
+            rows = self.conn.execute('SELECT doc FROM admins').fetchall()
+        return [json.loads(doc) for doc, in rows]
+
+    # chat settings
+
+    def get_lounge_by_chat_id(self, chat_id):
+        return self._one(_GET_SETTING.format('lounge_id'), (int(chat_id),))
+
+    def get_mod_by_chat_id(self, chat_id):
+        return self._one(_GET_SETTING.format('mod_id'), (int(chat_id),))
+
+    def set_lounge_id_by_chat_id(self, chat_id, lounge_id):
+        with self._lock, self.conn:
+            self.conn.execute('INSERT INTO chat_settings (chat_id, lounge_id) VALUES (?, ?) '
+                              'ON CONFLICT (chat_id) DO UPDATE SET lounge_id = excluded.lounge_id',
+                              (int(chat_id), int(lounge_id)))
+
+    # captcha deadlines
+
+    def set_deadline(self, key: str, action: str, due: datetime, data: dict, instance: str = None):
+        with self._lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO deadlines (id, action, due, data, instance) '
+                              'VALUES (?, ?, ?, ?, ?)', (key, action, _timestamp(due), json.dumps(data), instance))
+
+    def get_deadlines(self, instance: str = None):
+        with self._lock:
+            rows = self.conn.execute('SELECT id, action, due, data FROM deadlines WHERE instance IS ? ORDER BY due',
+                                     (instance,)).fetchall()
+        return [{'_id': key, 'action': action, 'due': datetime.fromisoformat(due), 'data': json.loads(data)}
+                for key, action, due, data in rows]
+
+    def remove_deadlines(self, keys: List[str]):
+        if keys:
+            with self._lock, self.conn:
+                self.conn.executemany('DELETE FROM deadlines WHERE id = ?', [(key,) for key in keys])
+
+    # price alerts
+
+    def set_alert(self, key: str, alert: dict):
+        with self._lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO alerts (id, doc) VALUES (?, ?)', (key, json.dumps(alert)))
+
+    def get_alerts(self):
+        with self._lock:
+            rows = self.conn.execute('SELECT id, doc FROM alerts').fetchall()
+        return [dict(json.loads(doc), _id=key) for key, doc in rows]
+
+    def remove_alerts(self, keys: List[str]):
+        if keys:
+            with self._lock, self.conn:
+                self.conn.executemany('DELETE FROM alerts WHERE id = ?', [(key,) for key in keys])
+
+    def close(self):
+        super().close()
+        with self._lock:
+            self.conn.close()
+
+
+def _timestamp(at: datetime = None) -> str:
+    # timestamps are stored as ISO 8601 text with a fixed precision, so they sort as text
+    return (at or datetime.utcnow()).isoformat(timespec='microseconds')
@@ -0,0 +1,382 @@
+import hashlib
+import json
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set
+
+from core.db.leaderboard import Leaderboard
+from core.default_commands import commands
+
+"""Storage backends: MongoDB, a SQLite file for single node deployments, and process memory for tests and
+benchmarks
+"""
+MONGO = 'mongo'
+SQLITE = 'sqlite'
+MEMORY = 'memory'
+
+"""Seconds between reloads of the handler cache, picking up handler edits made by other instances
+"""
+HANDLER_CACHE_REFRESH_INTERVAL = 60
+
+"""_id of the meta document holding the hash of the seeded default handlers
+"""
+DEFAULT_HANDLERS_META_ID = 'default_handlers'
+
+"""Seconds a member who left is kept, before compaction prunes their record. Members owning an invite link or
+referrals are kept for the contests
+"""
+MEMBER_RETENTION = 30 * 24 * 60 * 60
+
+"""Seconds between compaction runs, and the number of members deleted per batch
+"""
+COMPACTION_INTERVAL = 6 * 60 * 60
+COMPACTION_BATCH = 1000
+
+
+class StorageCaches:
+    """In-process caches kept on top of the database: default handlers, contest leaderboards and the owners of
+    invite links. Only the bookkeeping lives here, the queries filling the caches are made by the storage using
+    them, so Storage and the asyncio AsyncMongoConn share the same caching.
+    """
+
+    def __init__(self):
+        self.handler_cache_hits = 0
+        self.handler_cache_misses = 0
+        self._handler_cache = {}
+        self._leaderboards = {}
+        self._invite_owners = {}
+
+    # handlers
+
+    @staticmethod
+    def commands_hash() -> str:
+        return hashlib.sha256(json.dumps(commands, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _handlers_to_seed(self, meta: dict, force: bool = False) -> Optional[dict]:
+        """Returns the default handlers to write, or None if the hash in meta shows they were seeded already.
+
+        :param meta: Meta document stored under DEFAULT_HANDLERS_META_ID
+        :param force: Seed even if the stored hash matches
+        """
+        if not force and meta.get('hash') == self.commands_hash():
+            return None
+        return {key: value for key, value in commands.items() if value}
+
+    def _cached_handler(self, key: str) -> Optional[dict]:
+        handler = self._handler_cache.get(key)
+        if handler is not None:
+            self.handler_cache_hits += 1
+        else:
+            self.handler_cache_misses += 1
+        return handler
+
+    def _cache_handler(self, key: str, handler: Optional[dict]) -> dict:
+        if handler is None:
+            raise KeyError(f'key {key} does not exist in default handlers.')
+        self._handler_cache[key] = handler
+        return handler
+
+    def _cache_handlers(self, handlers: Iterable[dict]) -> dict:
+        self._handler_cache = {handler['_id']: handler for handler in handlers}
+        return self._handler_cache
+
+    def invalidate_handlers(self, keys: List[str] = None):
+        """Drops handlers from the cache, or the whole cache if no keys are given.
+        """
+        if keys is None:
+            self._handler_cache = {}
+        else:
+            for key in keys:
+                self._handler_cache.pop(key, None)
+
+    def handler_cache_stats(self) -> dict:
+        return {
+            'size': len(self._handler_cache),
+            'hits': self.handler_cache_hits,
+            'misses': self.handler_cache_misses,
+        }
+
+    # leaderboards
+
+    def _cached_leaderboard(self, chat_id) -> Optional[Leaderboard]:
+        """Returns the chat's leaderboard, or None if it has to be loaded.
+        """
+        board = self._leaderboards.get(int(chat_id))
+        return None if board is None or board.expired() else board
+
+    def _cache_leaderboard(self, chat_id, members_pts: Iterable[dict]) -> Leaderboard:
+        board = Leaderboard({m['id']: m['pts'] for m in members_pts if isinstance(m['id'], int)})
+        self._leaderboards[int(chat_id)] = board
+        return board
+
+    def _update_leaderboard(self, chat_id, inviter, delta: int):
+        board = self._leaderboards.get(int(chat_id))
+        if board is not None and inviter is not None:
+            board.update(inviter, delta)
+
+    # invite links, they never change their owner
+
+    def _cached_invite_owner(self, link) -> Optional[int]:
+        return self._invite_owners.get(link)
+
+    def _cache_invite_owner(self, link, user_id):
+        if isinstance(user_id, int):
+            self._invite_owners[link] = user_id
+
+
+class Storage(StorageCaches, ABC):
+    """Everything the bot's components persist: chat members and their referrals, default handlers,
+    chat settings and captcha deadlines. Backends implement the storage primitives, the handler cache and
+    contest leaderboards on top of them are shared.
+    """
+
+    """Write-behind queue of the backend, if it batches its writes
+    """
+    write_behind = None
+
+    # members and referrals
+
+    @abstractmethod
+    def set_invite_link_by_id(self, chat_id, link, user_id):
+        pass
+
+    @abstractmethod
+    def set_new_ref(self, chat_id, link, new_ref_user_id):
+        """Records a referral, and increments the inviter's reference counter.
+        """
+
+    @abstractmethod
+    def remove_ref(self, chat_id, user_id):
+        """Deletes the latest referral of a user who left, and decrements the inviter's reference counter.
+        """
+
+    @abstractmethod
+    def get_members_pts(self, chat_id, limit: int = 0) -> List[dict]:
+        """Returns the members with references as {'id', 'pts'}, best first.
+
+        :param chat_id: Chat of the contest
+        :param limit: Number of members to return, 0 for all
+        """
+
+    @abstractmethod
+    def get_user_by_invite(self, chat_id, link) -> Optional[int]:
+        pass
+
+    @abstractmethod
+    def get_invite_by_user_id(self, chat_id, user_id) -> Optional[str]:
+        pass
+
+    @abstractmethod
+    def get_captcha_status(self, chat_id, user_id) -> bool:
+        pass
+
+    @abstractmethod
+    def get_completed_captchas(self, chat_id, user_ids: Iterable) -> Set[int]:
+        """Returns which of several members of a chat have completed their captcha, in one query.
+        """
+
+    @abstractmethod
+    def set_captcha_status(self, chat_id, user_id, status: bool):
+        pass
+
+    @abstractmethod
+    def set_private_chat_id(self, chat_id, user_id, priv_chat_id):
+        pass
+
+    @abstractmethod
+    def get_private_chat_id(self, chat_id, user_id) -> Optional[int]:
+        pass
+
+    @abstractmethod
+    def set_member_joined(self, chat_id, user_id):
+        """Stamps a member's last_seen, and clears left_at if they had left before.
+        """
+
+    @abstractmethod
+    def set_member_left(self, chat_id, user_id):
+        """Resets a member's captcha status and stamps their left_at, starting their retention period.
+        """
+
+    @abstractmethod
+    def member_stats(self) -> Dict[int, dict]:
+        """Returns the number of members, how many of them left, and the approximate size in bytes of their
+        records, per chat.
+        """
+
+    @abstractmethod
+    def _prune_members(self, chat_id, cutoff: datetime, batch: int) -> int:
+        """Deletes the members of a chat who left before cutoff, have not completed a captcha since and own no
+        invite link or referrals, batch members at a time. Returns the number of members deleted.
+        """
+
+    def compact_members(self, retention: float = MEMBER_RETENTION, batch: int = COMPACTION_BATCH) -> Dict[int, dict]:
+        """Prunes the records of members who left more than retention seconds ago.
+
+        :param retention: Seconds a member who left is kept
+        :param batch: Members deleted per batch
+        :return: member_stats of every chat before and after, and the number of members pruned
+        """
+        if self.write_behind is not None:
+            self.write_behind.flush()
+        cutoff = datetime.utcnow() - timedelta(seconds=retention)
+        before = self.member_stats()
+        pruned = {chat_id: self._prune_members(chat_id, cutoff, batch) for chat_id in before}
+        after = self.member_stats()
+        return {chat_id: {'before': stats,
+                          'after': after.get(chat_id, {'members': 0, 'left': 0, 'size': 0}),
+                          'pruned': pruned[chat_id]}
+                for chat_id, stats in before.items()}
+
+    def get_leaderboard(self, chat_id) -> Leaderboard:
+        """Returns the chat's contest leaderboard. It is loaded once, kept up to date by set_new_ref and
+        remove_ref, and reloaded after it expired.
+        """
+        board = self._cached_leaderboard(chat_id)
+        if board is None:
+            if self.write_behind is not None:
+                self.write_behind.flush()
+            board = self._cache_leaderboard(chat_id, self.get_members_pts(chat_id))
+        return board
+
+    # handlers
+
+    @abstractmethod
+    def _find_default_handler(self, key: str) -> Optional[dict]:
+        pass
+
+    @abstractmethod
+    def _find_default_handlers(self) -> Iterable[dict]:
+        pass
+
+    @abstractmethod
+    def _write_default_handlers(self, handlers: dict):
+        """Upserts default handlers by _id, setting the given fields and keeping any others.
+        """
+
+    @abstractmethod
+    def _upsert_handler(self, command: str, key: str, value):
+        pass
+
+    @abstractmethod
+    def get_meta(self, key: str) -> dict:
+        pass
+
+    @abstractmethod
+    def set_meta(self, key: str, value: dict):
+        pass
+
+    def set_default_handlers(self, force: bool = False) -> bool:
+        """Seeds the default handlers from core.default_commands in a single write. Seeding is skipped when
+        the stored hash shows the commands have not changed since the last seed.
+
+        :param force: Seed even if the stored hash matches
+        :return: Whether the handlers were written
+        """
+        handlers = self._handlers_to_seed(self.get_meta(DEFAULT_HANDLERS_META_ID), force)
+        if handlers is None:
+            return False
+        self._write_default_handlers(handlers)
+        self.set_meta(DEFAULT_HANDLERS_META_ID, {'hash': self.commands_hash()})
+        self.invalidate_handlers()
+        return True
+
+    def get_text_by_handler(self, key: str):
+        return self.get_handler(key)['text']
+
+    def get_handler(self, key: str) -> dict:
+        """Returns a default handler's document, read through the in-process handler cache.
+
+        :param key: _id of the handler
+        :return: the handler document
+        """
+        handler = self._cached_handler(key)
+        if handler is None:
+            handler = self._cache_handler(key, self._find_default_handler(key))
+        return handler
+
+    def get_handlers(self) -> List[dict]:
+        """Returns all default handler documents, reloading the handler cache in a single query.
+        """
+        return list(self.refresh_handlers().values())
+
+    def refresh_handlers(self, ctx=None) -> dict:
+        """Reloads every default handler into the cache, replacing it as a whole, so edits and removals made
+        by other instances are picked up. Can be run as a repeating job.
+
+        :param ctx: CallbackContext, if run from the job queue
+        :return: the new cache
+        """
+        return self._cache_handlers(self._find_default_handlers())
+
+    def set_handler_description(self, command: str, description: str):
+        self._upsert_handler(command, 'delay', description)
+
+    def set_handler_enabled(self, command, on):
+        self._upsert_handler(command, 'enabled', on)
+
+    def set_handler_type(self, command: str, handler_type: str):
+        self._upsert_handler(command, 'type', handler_type)
+
+    def set_handler_delay(self, command: str, timeout_in_sec: int):
+        self._upsert_handler(command, 'delay', timeout_in_sec)
+
+    def set_handler_parse_mode(self, command: str, parse_mode: str):
+        self._upsert_handler(command, 'parse_mode', parse_mode)
+
+    @abstractmethod
+    def get_admins(self) -> Iterable[dict]:
+        pass
+
+    # chat settings
+
+    @abstractmethod
+    def get_lounge_by_chat_id(self, chat_id):
+        pass
+
+    @abstractmethod
+    def get_mod_by_chat_id(self, chat_id):
+        pass
+
+    @abstractmethod
+    def set_lounge_id_by_chat_id(self, chat_id, lounge_id):
+        pass
+
+    # captcha deadlines
+
+    @abstractmethod
+    def set_deadline(self, key: str, action: str, due: datetime, data: dict, instance: str = None):
+        """Journals a deadline, replacing any with the same key.
+
+        :param instance: Instance owning the deadline, None when a single instance runs
+        """
+
+    @abstractmethod
+    def get_deadlines(self, instance: str = None) -> Iterable[dict]:
+        """Returns the deadlines journaled by instance as {'_id', 'action', 'due', 'data'}, earliest first.
+        """
+
+    @abstractmethod
+    def remove_deadlines(self, keys: List[str]):
+        pass
+
+    # price alerts
+
+    @abstractmethod
+    def set_alert(self, key: str, alert: dict):
+        """Stores a price alert, replacing any with the same key.
+        """
+
+    @abstractmethod
+    def get_alerts(self) -> Iterable[dict]:
+        """Returns every price alert, with its key as _id.
+        """
+
+    @abstractmethod
+    def remove_alerts(self, keys: List[str]):
+        pass
+
+    def close(self):
+        """Releases the backend's connections, writing out anything still queued.
+        """
+        if self.write_behind is not None:
+            self.write_behind.stop()
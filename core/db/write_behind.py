@@ -0,0 +1,240 @@
+import atexit
+import itertools
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from typing import Any, Tuple
+
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError, ConnectionFailure
+
+"""Number of pending writes that triggers a flush before the interval is up
+"""
+WRITE_BEHIND_MAX_BATCH = 500
+
+"""Seconds a write may stay pending before it is flushed
+"""
+WRITE_BEHIND_FLUSH_INTERVAL = 0.2
+
+"""Number of recent flushes kept for the latency and batch size metrics
+"""
+WRITE_BEHIND_METRICS_WINDOW = 256
+
+
+class _PendingWrite:
+    __slots__ = ('collection', 'filter', 'update', 'upsert', 'key')
+
+    def __init__(self, collection: Collection, filter: dict, update: dict, upsert: bool, key: tuple = None):
+        self.collection = collection
+        self.filter = filter
+        self.update = update
+        self.upsert = upsert
+        self.key = key
+
+
+class WriteBehindQueue:
+    """Buffers member updates and writes them to Mongo in batches from a background thread.
+    Field updates of the same document are coalesced into a single pending $set, other updates are kept
+    in order. A flush is triggered once max_batch writes are pending, and at least every flush_interval,
+    and sends one ordered bulk_write per collection. Pending field values can be read back with pending_field,
+    so readers see their own writes before they are flushed, and has_pending tells whether an update queued
+    under a key is still unwritten.
+    """
+
+    def __init__(self,
+                 max_batch: int = WRITE_BEHIND_MAX_BATCH,
+                 flush_interval: float = WRITE_BEHIND_FLUSH_INTERVAL):
+        self.log = logging.getLogger('samaritan.writebehind')
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.enqueued = 0
+        self.coalesced = 0
+        self.flushed = 0
+        self.flushes = 0
+        self.errors = 0
+        self._latencies = deque(maxlen=WRITE_BEHIND_METRICS_WINDOW)
+        self._batch_sizes = deque(maxlen=WRITE_BEHIND_METRICS_WINDOW)
+        self._pending = OrderedDict()
+        self._flushing = OrderedDict()
+        # number of keyed updates pending or being flushed, by key
+        self._keyed = Counter()
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._worker = None
+
+    def start(self):
+        """Starts the background flusher, pending writes are flushed on interpreter exit.
+        """
+        if self._worker and self._worker.is_alive():
+            return
+        self._stop.clear()
+        self._worker = threading.Thread(target=self._run, name='write_behind', daemon=True)
+        self._worker.start()
+        atexit.register(self.stop)
+        self.log.info('Write-behind started: { max_batch: %s, flush_interval: %s }',
+                      self.max_batch, self.flush_interval)
+
+    def stop(self):
+        """Stops the background flusher, and flushes what is still pending.
+        """
+        self._stop.set()
+        self._wakeup.set()
+        if self._worker:
+            self._worker.join()
+        self.flush()
+
+    def set_fields(self, collection: Collection, key: dict, fields: dict):
+        """Queues an upserting $set of fields on a document, merged with a pending $set of the same document.
+
+        :param collection: Collection of the document
+        :param key: Equality filter identifying the document
+        :param fields: Fields to set
+        """
+        pending_key = self._key(collection, key)
+        with self._lock:
+            pending = self._pending.get(pending_key)
+            if pending:
+                pending.update['$set'].update(fields)
+                self.coalesced += 1
+            else:
+                self._pending[pending_key] = _PendingWrite(collection, dict(key), {'$set': dict(fields)}, True)
+            self._enqueued()
+
+    def update(self, collection: Collection, filter: dict, update: dict, upsert: bool = False, key: dict = None):
+        """Queues an update of the first document matching filter, applied in order with other such updates.
+
+        :param key: Equality filter has_pending can find the update by, updates with the same key are kept apart
+        """
+        key = self._key(collection, key) if key else None
+        pending = _PendingWrite(collection, filter, update, upsert, key)
+        with self._lock:
+            self._pending[collection.full_name, next(self._seq)] = pending
+            if key:
+                self._keyed[key] += 1
+            self._enqueued()
+
+    def has_pending(self, collection: Collection, key: dict) -> bool:
+        """Tells whether an update queued with a key is pending or being flushed, without scanning the queue.
+        """
+        return self._keyed[self._key(collection, key)] > 0
+
+    def pending_field(self, collection: Collection, key: dict, field: str) -> Tuple[bool, Any]:
+        """Looks up a field set by a pending write.
+
+        :return: Whether the field has a pending value, and the value
+        """
+        key = self._key(collection, key)
+        # writes being flushed right now are not visible in the collection yet either
+        for pending in (self._pending.get(key), self._flushing.get(key)):
+            if pending and field in pending.update['$set']:
+                return True, pending.update['$set'][field]
+        return False, None
+
+    def flush(self):
+        """Writes everything pending. Writes that failed because the server was unreachable are queued again,
+        merged under any newer write of the same document. A write rejected by the server is dropped, the writes
+        after it in its ordered batch are queued again.
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, OrderedDict()
+                self._flushing = batch
+            if not batch:
+                return
+            start = time.perf_counter()
+            by_collection = OrderedDict()
+            for key, pending in batch.items():
+                by_collection.setdefault(pending.collection.full_name, []).append(key)
+            groups = list(by_collection.values())
+            unwritten = OrderedDict()
+            try:
+                for i, keys in enumerate(groups):
+                    try:
+                        batch[keys[0]].collection.bulk_write(
+                            [UpdateOne(batch[k].filter, batch[k].update, upsert=batch[k].upsert) for k in keys],
+                            ordered=True)
+                    except ConnectionFailure as e:
+                        self.errors += 1
+                        unwritten.update((k, batch[k]) for keys in groups[i:] for k in keys)
+                        self.log.warning('Write-behind flush failed, requeueing %s writes: %s', len(unwritten), e)
+                        break
+                    except BulkWriteError as e:
+                        self.errors += 1
+                        # an ordered bulk write stops at its first error
+                        failed = min((error['index'] for error in e.details.get('writeErrors', [])), default=-1)
+                        unwritten.update((k, batch[k]) for k in keys[failed + 1:])
+                        self.log.error('Write-behind dropped a write rejected by the server, requeueing the %s '
+                                       'after it: %s', len(keys) - failed - 1, e.details.get('writeErrors'))
+                if unwritten:
+                    self._requeue(unwritten)
+            finally:
+                self._flushing = OrderedDict()
+                self._forget_keys(batch, unwritten)
+            self.flushes += 1
+            self.flushed += len(batch) - len(unwritten)
+            self._batch_sizes.append(len(batch))
+            self._latencies.append(time.perf_counter() - start)
+            self.log.debug('Write-behind flushed %s writes: %s', len(batch) - len(unwritten), self.stats())
+
+    def stats(self) -> dict:
+        latencies = sorted(self._latencies)
+        return {
+            'depth': len(self._pending),
+            'enqueued': self.enqueued,
+            'coalesced': self.coalesced,
+            'flushed': self.flushed,
+            'flushes': self.flushes,
+            'errors': self.errors,
+            'avg_batch': sum(self._batch_sizes) / len(self._batch_sizes) if self._batch_sizes else 0,
+            'max_batch': max(self._batch_sizes, default=0),
+            'p50_flush_ms': latencies[len(latencies) // 2] * 1e3 if latencies else 0,
+            'max_flush_ms': latencies[-1] * 1e3 if latencies else 0,
+        }
+
+    @staticmethod
+    def _key(collection: Collection, key: dict) -> tuple:
+        return (collection.full_name,) + tuple(sorted(key.items()))
+
+    def _enqueued(self):
+        self.enqueued += 1
+        if len(self._pending) >= self.max_batch:
+            self._wakeup.set()
+
+    def _forget_keys(self, batch: OrderedDict, unwritten: OrderedDict):
+        with self._lock:
+            for key, pending in batch.items():
+                if pending.key and key not in unwritten:
+                    self._keyed[pending.key] -= 1
+                    if not self._keyed[pending.key]:
+                        del self._keyed[pending.key]
+
+    def _requeue(self, batch: OrderedDict):
+        """Puts unwritten writes back in front of the pending ones. A $set of a document queued again in the
+        meantime is merged into the unwritten one, its newer fields winning.
+        """
+        with self._lock:
+            for key, pending in reversed(batch.items()):
+                newer = self._pending.pop(key, None)
+                if newer is not None:
+                    pending.update['$set'].update(newer.update['$set'])
+                    self.coalesced += 1
+                self._pending[key] = pending
+                self._pending.move_to_end(key, last=False)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                self.errors += 1
+                self.log.exception(e)
+
+    def __len__(self):
+        return len(self._pending)
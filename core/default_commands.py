@@ -72,6 +72,7 @@ commands = {
                       '/chart - Poocoin chart\n'
                       '/price - current price on PancakeSwap\n'
                       '/marketcap or /mc - current marketcap of $SAMA\n'
+                      '/alert - get notified when the price moves\n'
                       '\nShilling:\n'
                       '/shillist - list of places to shill\n'
                       '/shill or /shillin - templates for shilling on different platforms\n'
@@ -97,9 +98,9 @@ commands = {
                       '=0xb255cddf7fbaf1cbcc57d16fe2eaffffdbf5a8be',
               'regex': ['pcs', 'pancakeswap'],
               'aliases': ['trade', 'buy']},
-    "price": {'text': '🚀 Current price of $SAMA is: $',
+    "price": {'text': '🚀 Current price of ${symbol} is: $',
               'type': 'util'},
-    "mc": {'text': '🚀 Current market cap of $SAMA is: $',
+    "mc": {'text': '🚀 Current market cap of ${symbol} is: $',
            'type': 'util',
            'aliases': ['mc', 'marketcap']},
     "shillist": {'text': '\n@uniswaptalk\n@gemcollectors\n@cryptoM00NShots\n@gemdiscussion\n@gemtalkc\n@rocketmangem'
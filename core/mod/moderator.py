@@ -2,7 +2,7 @@ from telegram import Update
 from telegram.ext import CallbackContext, CommandHandler, Filters
 
 from core import CALLBACK_DIVIDER
-from core.db import MongoConn
+from core.db import Storage
 from core.mod import only_superadmin
 from core.samaritable import Samaritable
 from core.utils.utils import fallback_chat_id
@@ -11,7 +11,7 @@ from core.utils.utils import fallback_chat_id
 class Moderator(Samaritable):
 
     def __init__(self,
-                 db: MongoConn):
+                 db: Storage):
         super().__init__(db)
 
     @only_superadmin
@@ -1,11 +1,11 @@
 import logging
 from abc import ABC, abstractmethod
-from core.db import MongoConn
+from core.db import Storage
 
 
 class Samaritable(ABC):
     def __init__(self,
-                 db: MongoConn):
+                 db: Storage):
         self.log = self._aggregate_logger()
         self.db = db
 
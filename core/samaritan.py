@@ -23,11 +23,22 @@ from telegram.utils.helpers import (
     DEFAULT_NONE)
 
 from core import *
+from core.alert.alerter import Alerter
+from core.alert.sender import RateLimitedSender
 from core.bitquery.graphcli import GraphQLClient
+from core.bitquery.snapshot import PRICE_TTL
+from core.bitquery.trades import INGEST_INTERVAL, PRICE_WINDOW
 from core.captcha.challenger import Challenger
+from core.captcha.challenge import DEFAULT_RENDERER
+from core.captcha.pool import ChallengePool, POOL_DEPTH, POOL_REFILL_INTERVAL
+from core.captcha.renderer import RenderExecutor, RENDER_WORKERS
+from core.captcha.signing import CallbackSigner
 from core.contest.contestor import Contestor
 from core.contest.inviter import Inviter
-from core.db.mongo_db import MongoConn
+from core.db import connect, MongoConn, MONGO
+from core.db.storage import HANDLER_CACHE_REFRESH_INTERVAL, MEMBER_RETENTION, COMPACTION_INTERVAL
+from core.db.members import PER_CHAT
+from core.db.write_behind import WriteBehindQueue
 from core.samaritable import Samaritable
 from core.utils.utils import (
     read_api,
@@ -47,24 +58,69 @@ class Samaritan(Samaritable):
     def __init__(self,
                  tg_api_path: str = None,
                  db_api_path: str = None,
-                 log_level: logging = logging.INFO):
-        self.db = MongoConn(read_api(db_api_path))
+                 log_level: logging = logging.INFO,
+                 captcha_pool_depth: int = POOL_DEPTH,
+                 captcha_pool_refill_interval: float = POOL_REFILL_INTERVAL,
+                 captcha_renderer: str = DEFAULT_RENDERER,
+                 captcha_render_workers: int = RENDER_WORKERS,
+                 captcha_secret_path: str = None,
+                 instance_id: str = None,
+                 handler_refresh_interval: float = HANDLER_CACHE_REFRESH_INTERVAL,
+                 db_write_behind: bool = True,
+                 members_layout: str = PER_CHAT,
+                 db_backend: str = MONGO,
+                 member_retention: float = MEMBER_RETENTION,
+                 member_compaction_interval: float = COMPACTION_INTERVAL,
+                 price_ttl: float = PRICE_TTL,
+                 price_window: float = PRICE_WINDOW,
+                 trade_ingest_interval: float = INGEST_INTERVAL,
+                 tokens: dict = None,
+                 token_supplies: dict = None):
+        if db_backend == MONGO:
+            self.db = MongoConn(read_api(db_api_path),
+                                write_behind=WriteBehindQueue() if db_write_behind else None,
+                                members_layout=members_layout)
+        else:
+            # the SQLite backend is given its database file directly
+            self.db = connect(db_backend, db_api_path)
         self.updater = Updater(token=read_api(tg_api_path), use_context=True)
         self.dispatcher = self.updater.dispatcher
         super().__init__(self.db)
         setup_log(log_level=log_level)
-        self.graphql = GraphQLClient(self.db)
+        self.graphql = GraphQLClient(self.db, price_ttl=price_ttl, price_window=price_window, tokens=tokens,
+                                     supplies=token_supplies)
+        self.trade_ingest_interval = trade_ingest_interval
         self.welcome = (Union[int, str], datetime)
-        self.challenger = Challenger(self.db)
+        self.handler_refresh_interval = handler_refresh_interval
+        self.member_retention = member_retention
+        self.member_compaction_interval = member_compaction_interval
+        self.render_executor = RenderExecutor(workers=captcha_render_workers)
+        self.captcha_pool = ChallengePool(depth=captcha_pool_depth,
+                                          refill_interval=captcha_pool_refill_interval,
+                                          renderer=captcha_renderer,
+                                          executor=self.render_executor)
+        if captcha_secret_path and not instance_id:
+            # instances sharing the database each recover the deadlines journaled under their id, an id that
+            # changes on redeploy, such as a container's default host name, would leave them behind
+            raise ValueError('Signed captcha callbacks need a stable instance_id, e.g. the hostname set in '
+                             'docker-compose.yml')
+        signer = CallbackSigner(read_api(captcha_secret_path)) if captcha_secret_path else None
+        self.challenger = Challenger(self.db, self.captcha_pool, self.render_executor,
+                                     signer=signer, instance=instance_id)
         self.inviter = Inviter(self.db)
         self.contestor = Contestor(self.db)
+        self.alert_sender = RateLimitedSender(self.updater.bot)
+        self.alerter = Alerter(self.db, self.graphql, self.alert_sender)
         self.add_handlers(self.dispatcher)
 
     def gen_handler_attr(self):
         """Generates all handlers, based on their attributes in db.
         :return:
         """
-        for key in self.db.default_handlers.find():
+        for key in self.db.get_handlers():
+            if not key.get('type'):
+                # text-only handlers, looked up by other components
+                continue
             if key.get('regex'):
                 #  If the handler has regexes, create these as well
                 _handle = self.gen_handler(key, REGEX)
@@ -156,8 +212,8 @@ class Samaritan(Samaritable):
         :return: None
         """
         self.gen_handler_attr()
-        for key in self.db.default_handlers.find():
-            handler_type = key['type']
+        for key in self.db.get_handlers():
+            handler_type = key.get('type')
             if handler_type not in [COMMAND, TIMED, REGEX]:
                 continue
             elif handler_type == COMMAND or handler_type == TIMED:
@@ -168,10 +224,10 @@ class Samaritan(Samaritable):
                 self.add_regex_handler(dp, key)
 
     def add_command_handler(self, dp, key):
-        dp.add_handler(CommandHandler(key['aliases'], getattr(self, self.get_handler_name(key))))
+        dp.add_handler(CommandHandler(key.get('aliases', key['_id']), getattr(self, self.get_handler_name(key))))
 
     def add_regex_handler(self, dp, key, aliases=None):
-        aliases = aliases if aliases else key['aliases']
+        aliases = aliases if aliases else key.get('aliases', [key['_id']])
         dp.add_handler(MessageHandler(gen_filter(aliases), getattr(self, self.get_handler_name(key, REGEX))))
 
     @log_entexit
@@ -189,6 +245,7 @@ class Samaritan(Samaritable):
     @log_entexit
     def new_member(self, up: Update, ctx: CallbackContext):
         invite_link = up.chat_member.invite_link
+        self.db.set_member_joined(up.effective_chat.id, up.chat_member.new_chat_member.user.id)
         self.challenger.request_captcha(up, ctx)
 
         if invite_link:
@@ -211,7 +268,7 @@ class Samaritan(Samaritable):
         chat_id = fallback_chat_id(up)
         user_id = fallback_user_id(up)
         self.db.remove_ref(chat_id=chat_id, user_id=user_id)
-        self.db.set_captcha_status(chat_id=chat_id, user_id=user_id, status=False)
+        self.db.set_member_left(chat_id=chat_id, user_id=user_id)
 
     @log_entexit
     def evaluate_membership(self, new_member, old_member):
@@ -245,6 +302,10 @@ class Samaritan(Samaritable):
         return just_joined, just_left
 
     def start_polling(self):
+        self.captcha_pool.start()
+        self.alert_sender.start()
+        if self.db.write_behind is not None:
+            self.db.write_behind.start()
         self.updater.start_polling(allowed_updates=[Update.ALL_TYPES, 'chat_member'])
 
     @staticmethod
@@ -263,7 +324,26 @@ class Samaritan(Samaritable):
         self.inviter.add_handlers(dp)
         self.contestor.add_handlers(dp)
         self.graphql.add_handlers(dp)
+        self.alerter.add_handlers(dp)
         self.add_dp_handlers(dp)
+        if self.handler_refresh_interval:
+            dp.job_queue.run_repeating(self.db.refresh_handlers,
+                                       interval=self.handler_refresh_interval,
+                                       first=self.handler_refresh_interval)
+        if self.member_compaction_interval:
+            dp.job_queue.run_repeating(self.compact_members, interval=self.member_compaction_interval, first=60)
+        if self.trade_ingest_interval:
+            dp.job_queue.run_repeating(self.graphql.refresh_price, interval=self.trade_ingest_interval, first=0)
+
+    def compact_members(self, ctx: CallbackContext = None):
+        """Prunes members who left longer than the retention period ago, logging the storage used per chat.
+        """
+        for chat_id, report in self.db.compact_members(self.member_retention).items():
+            self.log.info('Compacted members of %s: { pruned: %s, members: %s -> %s, left: %s -> %s, '
+                          'bytes: %s -> %s }', chat_id, report['pruned'],
+                          report['before']['members'], report['after']['members'],
+                          report['before']['left'], report['after']['left'],
+                          report['before']['size'], report['after']['size'])
 
     def _format_reference(self, update: Update, prev_msg):
         return f"{self.db.get_text_by_handler('too_fast')}/{str(update.message.chat_id)[4:]}/{str(prev_msg)})"
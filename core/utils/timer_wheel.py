@@ -0,0 +1,130 @@
+import logging
+import threading
+import time
+from datetime import timedelta
+from typing import Callable, Hashable, Union
+
+from telegram.ext import CallbackContext, JobQueue
+
+"""Seconds per wheel tick
+"""
+WHEEL_RESOLUTION = 1.0
+
+"""Number of slots in the wheel, a full turn covers WHEEL_SLOTS * WHEEL_RESOLUTION seconds
+"""
+WHEEL_SLOTS = 512
+
+
+class _Timer:
+    __slots__ = ('key', 'due', 'callback', 'args')
+
+    def __init__(self, key, due: int, callback: Callable, args: tuple):
+        self.key = key
+        self.due = due
+        self.callback = callback
+        self.args = args
+
+
+class TimerWheel:
+    """Hashed timer wheel owning many deadlines behind a single repeating job.
+    Timers are hashed into slots by their due tick, so scheduling and cancelling are O(1)
+    and each tick only visits the slots that have come due. Timers further away than a full turn
+    stay in their slot until the turn they are due in.
+    """
+
+    def __init__(self,
+                 resolution: float = WHEEL_RESOLUTION,
+                 slots: int = WHEEL_SLOTS):
+        self.log = logging.getLogger('samaritan.timerwheel')
+        self.resolution = resolution
+        self.fired = 0
+        self.cancelled = 0
+        self._slots = [{} for _ in range(slots)]
+        self._timers = {}
+        self._origin = time.monotonic()
+        self._cursor = 0
+        self._lock = threading.Lock()
+        self._job = None
+
+    def start(self, job_queue: JobQueue):
+        """Drives the wheel from a single repeating job.
+
+        :param job_queue: JobQueue to run the ticks in
+        """
+        if not self._job:
+            self._job = job_queue.run_repeating(self.tick, interval=self.resolution, first=self.resolution)
+
+    def schedule(self, key: Hashable, delay: Union[timedelta, float], callback: Callable, *args):
+        """Schedules callback(ctx, *args) to run after delay, replacing any timer with the same key.
+
+        :param key: Unique key of the timer, used to cancel it
+        :param delay: Delay as timedelta or seconds
+        :param callback: Callable receiving the tick's CallbackContext and args
+        """
+        if isinstance(delay, timedelta):
+            delay = delay.total_seconds()
+        due = self._now() + max(1, int(-(-delay // self.resolution)))
+        timer = _Timer(key, due, callback, args)
+        with self._lock:
+            self._remove(key)
+            self._slots[due % len(self._slots)][key] = timer
+            self._timers[key] = timer
+
+    def cancel(self, key: Hashable) -> bool:
+        """Cancels a pending timer.
+
+        :param key: Key the timer was scheduled with
+        :return: Whether a timer was pending
+        """
+        with self._lock:
+            removed = self._remove(key)
+            if removed:
+                self.cancelled += 1
+        return removed
+
+    def tick(self, ctx: CallbackContext):
+        """Fires every timer that has come due since the last tick, as one batch.
+
+        :param ctx: CallbackContext passed on to the callbacks
+        """
+        now = self._now()
+        due = []
+        with self._lock:
+            while self._cursor < now:
+                self._cursor += 1
+                slot = self._slots[self._cursor % len(self._slots)]
+                expired = [timer for timer in slot.values() if timer.due <= self._cursor]
+                for timer in expired:
+                    del slot[timer.key]
+                    del self._timers[timer.key]
+                due.extend(expired)
+        if due:
+            self.log.debug('Firing %s timers, %s pending', len(due), len(self._timers))
+        for timer in due:
+            try:
+                timer.callback(ctx, *timer.args)
+            except Exception as e:
+                self.log.exception(e)
+        self.fired += len(due)
+
+    def stats(self) -> dict:
+        return {
+            'pending': len(self._timers),
+            'fired': self.fired,
+            'cancelled': self.cancelled,
+        }
+
+    def _remove(self, key) -> bool:
+        timer = self._timers.pop(key, None)
+        if timer:
+            del self._slots[timer.due % len(self._slots)][key]
+        return timer is not None
+
+    def _now(self) -> int:
+        return int((time.monotonic() - self._origin) / self.resolution)
+
+    def __len__(self):
+        return len(self._timers)
+
+    def __contains__(self, key):
+        return key in self._timers
@@ -114,10 +114,7 @@ def send_image(up: Update, ctx: CallbackContext,
         chat_id = up.effective_chat.id
 
     if isinstance(img, Image):
-        bio = BytesIO()
-        bio.name = 'captcha.jpeg'
-        img.save(bio, 'JPEG')
-        bio.seek(0)
+        bio = encode_image(img)
     else:
         bio = img
 
@@ -131,6 +128,20 @@ def send_image(up: Update, ctx: CallbackContext,
         reply_markup=reply_markup)
 
 
+def encode_image(img: Image, name: str = 'captcha.jpeg') -> BytesIO:
+    """Encodes a pillow image as JPEG into an in-memory file ready for upload.
+
+    :param img: Image to encode
+    :param name: File name reported to telegram
+    :return: BytesIO positioned at the start of the encoded image
+    """
+    bio = BytesIO()
+    bio.name = name
+    img.save(bio, 'JPEG')
+    bio.seek(0)
+    return bio
+
+
 def fallback_user_id(up: Update):
     if up.effective_user.id:
         return int(up.effective_user.id)
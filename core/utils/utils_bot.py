@@ -11,6 +11,18 @@ def format_price(price):
     return '_*'+f"{price:.12f}".replace('.', '\\.')+'*_'
 
 
+def format_age(seconds: float):
+    """Formats the age of stale data as a MarkdownV2 marker, e.g. (as of 3 min ago).
+    """
+    if seconds < 120:
+        age = f'{seconds:.0f} s'
+    elif seconds < 7200:
+        age = f'{seconds / 60:.0f} min'
+    else:
+        age = f'{seconds / 3600:.0f} h'
+    return f' _\\(as of {age} ago\\)_'
+
+
 def gen_filter(aliases: list):
     """Generates a regex expression based on a list of aliases
 
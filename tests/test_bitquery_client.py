@@ -0,0 +1,95 @@
+import time
+
+import pytest
+
+from bench.fakes import LocalGraphQL
+from core.bitquery.client import BitqueryClient, CircuitBreaker, CircuitOpen, QueryFailed
+
+QUERY = '{ ethereum { dexTrades { tradeIndex } } }'
+
+
+@pytest.fixture
+def endpoint():
+    with LocalGraphQL() as endpoint:
+        yield endpoint
+
+
+def client(endpoint, **kwargs):
+    kwargs.setdefault('backoff', 0.01)
+    return BitqueryClient(api_key='test', url=endpoint.url, **kwargs)
+
+
+def test_retries_server_errors(endpoint):
+    endpoint.script = [(503, b'', {}), (502, b'', {})]
+    bitquery = client(endpoint, retries=2)
+    assert bitquery.query(QUERY) == {'data': {'ethereum': {'dexTrades': []}}}
+    assert endpoint.requests == 3
+    assert bitquery.stats()['attempts'] == 3
+
+
+def test_gives_up_after_retries(endpoint):
+    endpoint.script = [(503, b'', {})] * 3
+    with pytest.raises(QueryFailed):
+        client(endpoint, retries=1).query(QUERY)
+    assert endpoint.requests == 2
+
+
+def test_does_not_retry_client_errors(endpoint):
+    endpoint.script = [(401, b'', {})]
+    with pytest.raises(QueryFailed):
+        client(endpoint, retries=2).query(QUERY)
+    assert endpoint.requests == 1
+
+
+def test_read_timeout_bounds_a_hanging_endpoint(endpoint):
+    endpoint.hang = True
+    start = time.monotonic()
+    try:
+        with pytest.raises(QueryFailed):
+            client(endpoint, read_timeout=0.2, retries=0).query(QUERY)
+    finally:
+        endpoint.hang = False
+    assert time.monotonic() - start < 1
+
+
+def test_open_circuit_rejects_without_querying(endpoint):
+    endpoint.script = [(400, b'', {})] * 2
+    bitquery = client(endpoint, retries=0, breaker=CircuitBreaker(threshold=2, reset_timeout=60))
+    for _ in range(2):
+        with pytest.raises(QueryFailed):
+            bitquery.query(QUERY)
+    with pytest.raises(CircuitOpen):
+        bitquery.query(QUERY)
+    assert endpoint.requests == 2
+    assert bitquery.breaker.state == 'open'
+
+
+def test_half_open_trial_success_closes_the_circuit(endpoint):
+    endpoint.script = [(400, b'', {})]
+    bitquery = client(endpoint, retries=0, breaker=CircuitBreaker(threshold=1, reset_timeout=0.1))
+    with pytest.raises(QueryFailed):
+        bitquery.query(QUERY)
+    time.sleep(0.15)
+    assert bitquery.breaker.state == 'half-open'
+    bitquery.query(QUERY)
+    assert bitquery.breaker.state == 'closed'
+
+
+@pytest.mark.parametrize('response', [
+    (200, b'[]', {}),
+    (200, b'not json', {}),
+    (200, b'garbage', {'Content-Encoding': 'gzip'}),
+], ids=['not an object', 'not json', 'undecodable'])
+def test_failed_trial_reopens_the_circuit(endpoint, response):
+    endpoint.script = [(400, b'', {}), response]
+    bitquery = client(endpoint, retries=0, breaker=CircuitBreaker(threshold=1, reset_timeout=0.1))
+    with pytest.raises(QueryFailed):
+        bitquery.query(QUERY)
+    time.sleep(0.15)
+    with pytest.raises(QueryFailed) as raised:
+        bitquery.query(QUERY)
+    assert not isinstance(raised.value, CircuitOpen)
+    assert bitquery.breaker.state == 'open'
+    time.sleep(0.15)
+    bitquery.query(QUERY)
+    assert bitquery.breaker.state == 'closed'
@@ -0,0 +1,86 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from bench.fakes import FakeBot, FakeDb, callback_update, command_update, context
+from core.captcha.challenge import Challenge
+from core.captcha.challenger import Challenger, BUSY_TEXT, EXPIRED_TEXT
+from core.captcha.pool import ChallengePool
+from core.captcha.renderer import RenderExecutor, RenderFailed
+from core.captcha.signing import CallbackSigner
+
+CHAT_ID = -1001
+
+
+class FailingExecutor:
+    """Stands in for a RenderExecutor whose first renders fail the way a pool's can.
+    """
+
+    def __init__(self, failures: int, error: Exception):
+        self.failures = failures
+        self.error = error
+        self.renders = 0
+
+    def render(self, ch) -> bytes:
+        self.renders += 1
+        if self.renders <= self.failures:
+            raise self.error
+        return b'jpeg'
+
+
+def test_pool_keeps_refilling_after_failed_renders():
+    pool = ChallengePool(depth=2, refill_interval=0.01, error_backoff=0.01,
+                         executor=FailingExecutor(2, TimeoutError()))
+    pool.start()
+    try:
+        deadline = time.monotonic() + 5
+        while pool.stats()['size'] < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        pool.stop()
+    assert pool.stats()['size'] == 2
+    assert pool.stats()['errors'] == 2
+
+
+def test_failed_render_is_answered_as_busy():
+    challenger = Challenger(FakeDb(), executor=FailingExecutor(1, RenderFailed('render worker died')))
+    bot = FakeBot()
+    challenger.captcha_deeplink(command_update(1, '/start'), context(bot, [f'captcha_{CHAT_ID}']))
+    assert bot.texts == [BUSY_TEXT]
+
+
+def test_render_timeout_raises_render_failed():
+    executor = RenderExecutor(workers=1, timeout=0.001)
+    try:
+        with pytest.raises(RenderFailed):
+            executor.render(Challenge())
+    finally:
+        executor.shutdown()
+
+
+def test_buttons_of_a_replaced_keyboard_are_rejected():
+    challenger = Challenger(FakeDb(), signer=CallbackSigner('test'))
+    bot = FakeBot()
+    ctx = context(bot, [f'captcha_{CHAT_ID}'])
+    challenger.captcha_deeplink(command_update(1, '/start'), ctx)
+    session = challenger.current_captchas.get(CHAT_ID, 1)
+    first = bot.last_markup
+    wrong = next(button.callback_data for row in first.inline_keyboard[1:] for button in row
+                 if button.text != str(session.answer))
+    message = SimpleNamespace(chat_id=session.priv_chat_id, message_id=session.priv_msg_id, reply_markup=first)
+    answers = []
+
+    def click(data):
+        up = callback_update(1, data, message)
+        up.callback_query.answer = answers.append
+        challenger.captcha_signed_callback(up, ctx)
+
+    click(wrong)
+    assert answers == ['captcha_failed']
+    second = message.reply_markup = bot.last_markup
+    assert second is not first
+
+    click(wrong)
+    assert answers[-1] == EXPIRED_TEXT
+    assert bot.last_markup is second
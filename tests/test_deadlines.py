@@ -0,0 +1,82 @@
+from datetime import timedelta
+
+import pytest
+
+from bench.fakes import FakeBot, SimulatedMongo, context
+from core.captcha.challenger import Challenger, KICK, UNBAN
+from core.db.mongo_db import MongoConn
+from core.db.write_behind import WriteBehindQueue
+
+CHAT_ID = -1001
+
+
+@pytest.fixture
+def mongo():
+    with SimulatedMongo(rtt=0) as mongo:
+        yield mongo
+
+
+def connect(write_behind: bool = True) -> MongoConn:
+    return MongoConn('mongodb://localhost', write_behind=WriteBehindQueue() if write_behind else None)
+
+
+def schedule_kick(challenger: Challenger, user_id: int, delay: timedelta):
+    challenger.schedule_deadline(KICK, delay, chat_id=CHAT_ID, user_id=user_id, priv_chat_id=user_id,
+                                 pub_msg_id=1, priv_msg_id=2)
+
+
+def test_deadlines_are_recovered_after_a_restart(mongo):
+    db = connect()
+    challenger = Challenger(db, instance='a')
+    schedule_kick(challenger, 1, timedelta(minutes=5))
+    challenger.schedule_deadline(UNBAN, timedelta(seconds=-1), chat_id=CHAT_ID, user_id=2)
+    db.close()
+
+    restarted = Challenger(connect(), instance='a')
+    bot = FakeBot()
+    restarted.recover_deadlines(context(bot))
+    assert restarted.deadlines.stats()['pending'] == 1
+    assert bot.calls == 2  # the overdue unban restricted and unbanned the member
+    assert [d['_id'] for d in restarted.db.get_deadlines('a')] == [Challenger.deadline_key(KICK, CHAT_ID, 1)]
+
+
+def test_deadlines_of_other_instances_are_not_recovered(mongo):
+    db = connect()
+    schedule_kick(Challenger(db, instance='a'), 1, timedelta(seconds=-1))
+    schedule_kick(Challenger(db, instance='b'), 2, timedelta(minutes=5))
+    db.write_behind.flush()
+
+    bot = FakeBot()
+    b = Challenger(db, instance='b')
+    b.recover_deadlines(context(bot))
+    assert bot.calls == 0
+    assert b.deadlines.stats()['pending'] == 1
+    assert len(list(db.get_deadlines('a'))) == 1
+
+
+def test_deadlines_go_through_the_write_behind_queue(mongo):
+    db = connect()
+    challenger = Challenger(db)
+    schedule_kick(challenger, 1, timedelta(minutes=5))
+    assert len(db.write_behind) == 1
+    assert list(db.get_deadlines()) == []
+
+    challenger.cancel_deadline(KICK, CHAT_ID, 1)
+    db.write_behind.flush()
+    # the pending deadline was written before it was removed, so it does not come back
+    assert list(db.get_deadlines()) == []
+
+
+def test_overdue_kicks_read_captcha_statuses_in_one_query(mongo, monkeypatch):
+    db = connect()
+    challenger = Challenger(db, instance='a')
+    for user_id in (1, 2, 3):
+        schedule_kick(challenger, user_id, timedelta(seconds=-1))
+    db.set_captcha_status(CHAT_ID, 2, True)
+    db.close()
+
+    restarted = Challenger(connect(), instance='a')
+    monkeypatch.setattr(restarted.db, 'get_captcha_status', lambda *args: pytest.fail('status read per kick'))
+    bot = FakeBot()
+    restarted.recover_deadlines(context(bot))
+    assert len(bot.texts) == 2  # members 1 and 3 were told they failed, member 2 completed the captcha
@@ -0,0 +1,50 @@
+import pytest
+
+from bench.fakes import FakeBot, command_update, context
+from core.alert.alerter import Alerter
+from core.alert.sender import RateLimitedSender
+from core.bitquery.client import QueryFailed
+from core.bitquery.graphcli import GraphQLClient, PRICE_UNAVAILABLE_TEXT
+from core.db.memory_db import MemoryConn
+
+TOKENS = {'SAMA': '0xb255cddf7fbaf1cbcc57d16fe2eaffffdbf5a8be', 'WBNB': '0xbb4cdb9cbd36b01bd1cbaebf2de08d9173bc095c'}
+
+
+@pytest.fixture
+def graphql():
+    return GraphQLClient(MemoryConn(), tokens=TOKENS, supplies={'SAMA': 1000})
+
+
+def command(handler, *args) -> str:
+    bot = FakeBot()
+    handler(command_update(1, '/command'), context(bot, list(args)))
+    return bot.texts[-1]
+
+
+def prices(value):
+    def fetch():
+        if isinstance(value, Exception):
+            raise value
+        return value
+    return fetch
+
+
+def test_price_names_the_token_asked_for(graphql):
+    graphql.price_snapshot.fetch = prices({'SAMA': 0.5, 'WBNB': 300.0})
+    assert command(graphql.price).startswith('🚀 Current price of $SAMA is: $')
+    text = command(graphql.price, 'wbnb')
+    assert text.startswith('🚀 Current price of $WBNB is: $') and '300\\.' in text
+
+
+def test_mc_uses_the_supply_of_its_token(graphql):
+    graphql.price_snapshot.fetch = prices({'SAMA': 0.5, 'WBNB': 300.0})
+    assert command(graphql.mc) == '🚀 Current market cap of $SAMA is: $_*500\\.00*_'
+    assert command(graphql.mc, 'WBNB').startswith('Unknown token WBNB')
+
+
+def test_commands_answer_when_no_price_can_be_fetched(graphql):
+    graphql.price_snapshot.fetch = prices(QueryFailed('Bitquery is down'))
+    assert command(graphql.price) == PRICE_UNAVAILABLE_TEXT
+    assert command(graphql.mc) == PRICE_UNAVAILABLE_TEXT
+    alerter = Alerter(graphql.db, graphql, RateLimitedSender(FakeBot()))
+    assert command(alerter.alert, 'above', '1') == PRICE_UNAVAILABLE_TEXT
@@ -0,0 +1,21 @@
+import pytest
+
+from bench.fakes import SimulatedMongo
+from core.db import mongo_db
+from core.db.mongo_db import MongoConn
+
+URL = 'mongodb://localhost'
+
+
+@pytest.fixture
+def mongo():
+    with SimulatedMongo(rtt=0) as mongo:
+        yield mongo
+
+
+def test_members_still_in_the_chat_are_not_stamped_as_left(mongo):
+    client = mongo_db.MongoClient(URL)
+    client['chats_members']['-1001'].insert_one({'_id': 1, 'captcha_completed': False})
+    db = MongoConn(URL)
+    assert 'left_at' not in db.members.find_member(-1001, 1)
+
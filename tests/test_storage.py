@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+
+from bench.fakes import SimulatedMongo
+from core.db import connect, MONGO, SQLITE, MEMORY
+from core.db.async_mongo_db import AsyncMongoConn
+from core.db.write_behind import WriteBehindQueue
+
+CHAT_ID = -1001
+
+
+@pytest.fixture(params=[MONGO, SQLITE, MEMORY])
+def db(request):
+    if request.param == MONGO:
+        with SimulatedMongo(rtt=0):
+            yield connect(MONGO, 'mongodb://localhost')
+    else:
+        yield connect(request.param)
+
+
+def test_lounge_id_is_read_back(db):
+    assert db.get_lounge_by_chat_id(CHAT_ID) is None
+    db.set_lounge_id_by_chat_id(CHAT_ID, 42)
+    db.set_lounge_id_by_chat_id(CHAT_ID, 43)
+    assert db.get_lounge_by_chat_id(CHAT_ID) == 43
+
+
+def test_handlers_are_read_through_the_cache(db):
+    db.invalidate_handlers()
+    text = db.get_text_by_handler('captcha_failed')
+    assert db.get_text_by_handler('captcha_failed') == text
+    assert db.handler_cache_stats() == {'size': 1, 'hits': 1, 'misses': 1}
+    with pytest.raises(KeyError):
+        db.get_handler('no such handler')
+
+
+def test_leaderboard_follows_referrals(db):
+    db.set_invite_link_by_id(CHAT_ID, 'https://t.me/+a', 1)
+    db.set_new_ref(CHAT_ID, 'https://t.me/+a', 2)
+    board = db.get_leaderboard(CHAT_ID)
+    assert board.top(1) == [(1, 1)]
+    db.set_new_ref(CHAT_ID, 'https://t.me/+a', 3)
+    db.remove_ref(CHAT_ID, 2)
+    db.set_new_ref(CHAT_ID, 'https://t.me/+a', 4)
+    assert db.get_leaderboard(CHAT_ID).top(1) == [(1, 2)]
+
+
+def test_async_storage_reads_handlers_through_the_shared_cache():
+    # nothing listens on the port, a cached handler is served without a query
+    adb = AsyncMongoConn('mongodb://localhost:1', server_selection_timeout_ms=100)
+    adb._cache_handlers([{'_id': 'captcha_failed', 'text': 'Wrong answer'}])
+    assert asyncio.run(adb.get_text_by_handler('captcha_failed')) == 'Wrong answer'
+    assert adb.handler_cache_stats() == {'size': 1, 'hits': 1, 'misses': 0}
+
+
+def test_leaving_without_a_queued_referral_does_not_flush():
+    with SimulatedMongo(rtt=0):
+        db = connect(MONGO, 'mongodb://localhost', write_behind=WriteBehindQueue())
+        db.set_invite_link_by_id(CHAT_ID, 'https://t.me/+a', 1)
+        db.set_new_ref(CHAT_ID, 'https://t.me/+a', 2)
+        queued = len(db.write_behind)
+        db.remove_ref(CHAT_ID, 3)
+        assert len(db.write_behind) == queued
+        db.remove_ref(CHAT_ID, 2)
+        # the queued edge was flushed and deleted, the decrement of the inviter is queued again
+        assert db.referrals.count_documents({}) == 0
+        assert len(db.write_behind) == 1
+
+
+def test_completed_captchas_are_read_together(db):
+    db.set_captcha_status(CHAT_ID, 1, True)
+    db.set_captcha_status(CHAT_ID, 2, False)
+    db.set_captcha_status(CHAT_ID - 1, 3, True)
+    assert db.get_completed_captchas(CHAT_ID, [1, '2', 3, 4]) == {1}
+    assert db.get_completed_captchas(CHAT_ID, []) == set()
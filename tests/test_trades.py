@@ -0,0 +1,51 @@
+from bench.trades import SimulatedChain, TOKEN
+from core.bitquery.queries import dex_trades
+from core.bitquery.trades import TradeIngester
+
+
+def ingester(chain: SimulatedChain, page: int = 100, requests: list = None) -> TradeIngester:
+    def fetch(batch):
+        if requests is not None:
+            requests.append(batch['SAMA'])
+        return {'SAMA': chain.fetch(*batch['SAMA'])}
+
+    return TradeIngester(fetch, {'SAMA': TOKEN}, page=page)
+
+
+def test_unpriced_trades_advance_the_cursor():
+    chain = SimulatedChain(2)
+    chain.mine(3)
+    requests = []
+    trades = ingester(chain, requests=requests)
+    trades.ingest()
+    chain.mine(2)
+    for trade in chain.trades[-4:]:
+        trade['sellAmountInUsd'] = trade['buyAmountInUsd'] = 0
+    assert trades.ingest() == {'SAMA': 0}
+    assert trades.stores['SAMA'].last_height == 3
+
+    chain.mine()
+    assert trades.ingest() == {'SAMA': 2}
+    # the unpriced trades of blocks 4 and 5 were not stored, but are not queried again either
+    assert requests[-1] == (5, 0, 100)
+    assert trades.stores['SAMA'].last_height == 6
+
+
+def test_late_trades_of_the_last_block_are_picked_up_once():
+    chain = SimulatedChain(3)
+    chain.mine(2)
+    late = chain.trades.pop()
+    trades = ingester(chain, page=2)
+    assert trades.ingest() == {'SAMA': 5}
+
+    chain.trades.append(late)
+    chain.mine()
+    assert trades.ingest() == {'SAMA': 4}
+    assert trades.ingest() == {'SAMA': 0}
+    store = trades.stores['SAMA']
+    assert list(store.height[:len(store)]) == [1, 1, 1, 2, 2, 2, 3, 3, 3]
+
+
+def test_trades_are_queried_from_the_last_block_on():
+    assert 'height: {gteq: 42}' in dex_trades('t0', TOKEN, 42, 0, 10)
+    assert 'height: {' not in dex_trades('t0', TOKEN, None, 0, 10)
@@ -0,0 +1,81 @@
+import pytest
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+from core.db.write_behind import WriteBehindQueue
+
+
+class FlakyCollection:
+    """Applies the $set and $inc of bulk written UpdateOnes to dicts by _id. The next bulk_write can be made to
+    fail as an unreachable server would, or to reject the write at a given index as an ordered bulk write does.
+    """
+    full_name = 'test.members'
+
+    def __init__(self):
+        self.docs = {}
+        self.fail_connection = False
+        self.reject_index = None
+
+    def bulk_write(self, requests, ordered=True):
+        if self.fail_connection:
+            self.fail_connection = False
+            raise AutoReconnect('server unreachable')
+        for index, request in enumerate(requests):
+            if index == self.reject_index:
+                self.reject_index = None
+                raise BulkWriteError({'writeErrors': [{'index': index, 'code': 2, 'errmsg': 'rejected'}]})
+            doc = self.docs.setdefault(request._filter['_id'], {'_id': request._filter['_id']})
+            doc.update(request._doc.get('$set', {}))
+            for field, delta in request._doc.get('$inc', {}).items():
+                doc[field] = doc.get(field, 0) + delta
+
+
+@pytest.fixture
+def members():
+    return FlakyCollection()
+
+
+def test_failed_flush_is_merged_under_newer_set(members):
+    queue = WriteBehindQueue()
+    queue.set_fields(members, {'_id': 1}, {'chat_id': 555, 'captcha_completed': True})
+    members.fail_connection = True
+    queue.flush()
+    queue.set_fields(members, {'_id': 1}, {'captcha_completed': False})
+    queue.flush()
+    assert members.docs[1] == {'_id': 1, 'chat_id': 555, 'captcha_completed': False}
+    assert len(queue) == 0
+
+
+def test_failed_flush_keeps_order_of_updates(members):
+    queue = WriteBehindQueue()
+    queue.update(members, {'_id': 1}, {'$inc': {'refs_size': 1}}, upsert=True)
+    queue.set_fields(members, {'_id': 2}, {'captcha_completed': True})
+    members.fail_connection = True
+    queue.flush()
+    assert len(queue) == 2
+    queue.flush()
+    assert members.docs == {1: {'_id': 1, 'refs_size': 1}, 2: {'_id': 2, 'captcha_completed': True}}
+
+
+def test_rejected_write_requeues_the_rest_of_its_batch(members):
+    queue = WriteBehindQueue()
+    for user_id in range(4):
+        queue.set_fields(members, {'_id': user_id}, {'captcha_completed': True})
+    members.reject_index = 1
+    queue.flush()
+    assert sorted(members.docs) == [0]
+    assert len(queue) == 2
+    queue.flush()
+    assert sorted(members.docs) == [0, 2, 3]
+    assert queue.stats()['errors'] == 1
+
+
+def test_keyed_update_is_pending_until_written(members):
+    queue = WriteBehindQueue()
+    queue.update(members, {'_id': 1}, {'$set': {'invitee': 7}}, upsert=True, key={'invitee': 7})
+    assert queue.has_pending(members, {'invitee': 7})
+    assert not queue.has_pending(members, {'invitee': 8})
+    members.fail_connection = True
+    queue.flush()
+    assert queue.has_pending(members, {'invitee': 7})
+    queue.flush()
+    assert not queue.has_pending(members, {'invitee': 7})